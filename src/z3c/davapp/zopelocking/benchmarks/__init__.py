@@ -0,0 +1,271 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Benchmarks for the WebDAV locking support.
+
+These are not part of the test suite. Each module in this package is a
+script, for example::
+
+  $ bin/py -m z3c.davapp.zopelocking.benchmarks.movedevents --help
+
+This module holds the setup shared by the benchmarks. It creates a ZODB
+database whose root folder is a site containing a token utility, and it
+registers the global adapters that an application would normally get from
+ZCML, and the event handlers subscribed in the package's configure.zcml.
+"""
+
+import os.path
+import time
+import xml.dom.minidom
+
+import persistent
+import persistent.interfaces
+import transaction
+import ZODB.DB
+import ZODB.FileStorage
+import ZODB.MappingStorage
+import ZODB.interfaces
+
+import zope.component
+import zope.component.event
+import zope.interface
+import zope.annotation.attribute
+import zope.annotation.interfaces
+import zope.app.keyreference.interfaces
+import zope.app.keyreference.persistent
+import zope.locking.adapters
+import zope.locking.interfaces
+import zope.locking.utility
+import zope.security.management
+import zope.security.testing
+import zope.traversing.interfaces
+from zope.component.interfaces import IComponentLookup
+from zope.configuration.name import resolve
+from zope.container.btree import BTreeContainer
+from zope.container.contained import Contained
+from zope.publisher.browser import TestRequest
+from zope.site.site import LocalSiteManager, SiteManagerAdapter, \
+     SiteManagerContainer
+
+import z3c.dav.interfaces
+
+import z3c.davapp.zopelocking
+# The properties module imports the lock manager, which imports it in turn,
+# so it has to be imported first.
+from z3c.davapp.zopelocking import properties
+from z3c.davapp.zopelocking import manager
+
+ROOT_NAME = "z3c.davapp.zopelocking.benchmarks"
+ZOPE_NAMESPACE = "http://namespaces.zope.org/zope"
+
+class Folder(BTreeContainer):
+    zope.interface.implements(zope.annotation.interfaces.IAttributeAnnotatable)
+
+
+class RootFolder(Folder, SiteManagerContainer):
+    zope.interface.implements(zope.traversing.interfaces.IContainmentRoot)
+
+
+class File(persistent.Persistent, Contained):
+    zope.interface.implements(zope.annotation.interfaces.IAttributeAnnotatable)
+
+
+ADAPTERS = (
+    (zope.app.keyreference.persistent.KeyReferenceToPersistent,
+     (persistent.interfaces.IPersistent,),
+     zope.app.keyreference.interfaces.IKeyReference),
+    (zope.app.keyreference.persistent.connectionOfPersistent,
+     (persistent.interfaces.IPersistent,),
+     ZODB.interfaces.IConnection),
+    (zope.annotation.attribute.AttributeAnnotations,
+     (zope.annotation.interfaces.IAttributeAnnotatable,),
+     zope.annotation.interfaces.IAnnotations),
+    (SiteManagerAdapter, (zope.interface.Interface,), IComponentLookup),
+    (zope.locking.adapters.TokenBroker,
+     (zope.interface.Interface,),
+     zope.locking.interfaces.ITokenBroker),
+    (manager.DAVLockmanager,
+     (zope.interface.Interface,),
+     z3c.dav.interfaces.IDAVLockmanager),
+    )
+
+
+def loadHandlers(filename = "configure.zcml"):
+    """
+    Return the (handler, required) pairs of the event handlers subscribed
+    in the ZCML file `filename` of the package, so that the benchmarks run
+    the same handlers as an application including it.
+    """
+    package = z3c.davapp.zopelocking
+    path = os.path.join(os.path.dirname(package.__file__), filename)
+    handlers = []
+    for node in xml.dom.minidom.parse(path).getElementsByTagNameNS(
+        ZOPE_NAMESPACE, "subscriber"):
+        handler = node.getAttribute("handler")
+        if not handler:
+            continue
+        required = tuple([resolve(name, package.__name__)
+                          for name in node.getAttribute("for").split()])
+        handlers.append(
+            (resolve(handler, package.__name__), required or None))
+    return handlers
+
+
+HANDLERS = [(zope.component.event.objectEventNotify, None)] + loadHandlers()
+
+
+def openDatabase(filename = None, address = None):
+    """
+    Open a database on a FileStorage at `filename`, on the ZEO server at the
+    "host:port" `address`, or else in memory.
+    """
+    if address is not None:
+        # ZEO is only needed by the benchmarks that use a server.
+        import ZEO.ClientStorage
+        host, port = address.rsplit(":", 1)
+        storage = ZEO.ClientStorage.ClientStorage((host, int(port)))
+    elif filename is not None:
+        storage = ZODB.FileStorage.FileStorage(filename)
+    else:
+        storage = ZODB.MappingStorage.MappingStorage()
+    return ZODB.DB(storage)
+
+
+def setUp(filename = None, principal_id = "bench", method = "PUT",
+          address = None):
+    """
+    Register the global components, create the database and the site and
+    start an interaction. Returns the database.
+    """
+    gsm = zope.component.getGlobalSiteManager()
+    for factory, required, provided in ADAPTERS:
+        gsm.registerAdapter(factory, required, provided)
+
+    db = openDatabase(filename, address)
+    conn = db.open()
+    dbroot = conn.root()
+    if ROOT_NAME not in dbroot:
+        root = dbroot[ROOT_NAME] = RootFolder()
+        root.setSiteManager(LocalSiteManager(root))
+        sitemanager = root.getSiteManager()
+        utility = sitemanager["default"]["tokenutility"] = \
+                  zope.locking.utility.TokenUtility()
+        sitemanager.registerUtility(
+            utility, zope.locking.interfaces.ITokenUtility)
+        transaction.commit()
+    conn.close()
+
+    for handler, required in HANDLERS:
+        gsm.registerHandler(handler, required)
+
+    login(principal_id, method)
+
+    return db
+
+
+def tearDown(db):
+    logout()
+
+    gsm = zope.component.getGlobalSiteManager()
+    for handler, required in HANDLERS:
+        gsm.unregisterHandler(handler, required)
+    for factory, required, provided in ADAPTERS:
+        gsm.unregisterAdapter(factory, required, provided)
+
+    transaction.abort()
+    db.close()
+
+
+def login(principal_id = "bench", method = "PUT"):
+    """
+    Start a new interaction for the current thread with a request using the
+    HTTP `method`. The lock manager needs the principal and the event
+    handlers need the request method.
+    """
+    participation = TestRequest(environ = {"REQUEST_METHOD": method})
+    participation.setPrincipal(zope.security.testing.Principal(principal_id))
+    # The If header validation annotates the request, zope.publisher makes
+    # requests annotatable in ZCML.
+    zope.interface.alsoProvides(
+        participation, zope.annotation.interfaces.IAttributeAnnotatable)
+    zope.security.management.newInteraction(participation)
+    return participation
+
+
+def logout():
+    if zope.security.management.queryInteraction() is not None:
+        zope.security.management.endInteraction()
+
+
+def getRoot(conn):
+    return conn.root()[ROOT_NAME]
+
+
+def getUtility(root):
+    return root.getSiteManager()["default"]["tokenutility"]
+
+
+def buildTree(folder, breadth, depth, files = None):
+    """
+    Add a tree of folders `depth` levels deep below `folder`, each
+    containing `breadth` sub-folders and `files` files, `files` defaults to
+    `breadth`. Returns the number of objects created.
+    """
+    if files is None:
+        files = breadth
+    count = 0
+    for i in range(files):
+        folder[u"file%d" % i] = File()
+        count += 1
+    if depth > 0:
+        for i in range(breadth):
+            subfolder = folder[u"folder%d" % i] = Folder()
+            count += 1 + buildTree(subfolder, breadth, depth - 1, files)
+    return count
+
+
+class Timer(object):
+    """
+    Collect the wall clock time spent in a number of runs of an operation.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.times = []
+
+    def __call__(self, func, *args, **kw):
+        start = time.time()
+        try:
+            return func(*args, **kw)
+        finally:
+            self.times.append(time.time() - start)
+
+    @property
+    def total(self):
+        return sum(self.times)
+
+    def percentile(self, percent):
+        if not self.times:
+            return 0.0
+        times = sorted(self.times)
+        index = min(len(times) - 1, int(len(times) * percent / 100.0))
+        return times[index]
+
+    def report(self):
+        if not self.times:
+            return "%-40s no runs" % self.name
+        return "%-40s %8d runs %10.3f ms mean %10.3f ms p50 %10.3f ms p99" %(
+            self.name, len(self.times),
+            self.total * 1000 / len(self.times),
+            self.percentile(50) * 1000, self.percentile(99) * 1000)
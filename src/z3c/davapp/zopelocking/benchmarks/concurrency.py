@@ -0,0 +1,281 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Replay a mix of concurrent lock operations and measure the throughput,
+latency and ZODB conflict rate.
+
+Each thread has its own principal and database connection and repeatedly
+picks one of the operations at random: take out a shared or exclusive
+depth infinity lock on one of the folders, refresh or remove one of the
+locks it holds, or add a file below a folder (a PUT, which goes through
+`indirectlyLockObjectOnMovedEvent`). Every operation is committed and
+retried on ConflictError like the publisher would. Lock requests refused
+because somebody else holds a conflicting lock are counted separately.
+"""
+
+import datetime
+import optparse
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+import transaction
+from ZODB.POSException import ConflictError
+import z3c.dav.interfaces
+
+from z3c.davapp.zopelocking import benchmarks
+from z3c.davapp.zopelocking import manager
+
+HOUR = datetime.timedelta(hours = 1)
+
+FIXTURE_NAME = u"concurrency"
+
+DEFAULT_MIX = "exclusive=2,shared=2,refresh=3,unlock=3,put=4"
+
+OPERATIONS = ("exclusive", "shared", "refresh", "unlock", "put")
+
+REFUSED = (z3c.dav.interfaces.DAVException,
+           z3c.dav.interfaces.AlreadyLocked,
+           z3c.dav.interfaces.WebDAVErrors)
+
+def parseMix(mix):
+    """
+    Parse the "operation=weight,..." `mix` into a list with each operation
+    repeated weight times, to choose from at random.
+    """
+    choices = []
+    for item in mix.split(","):
+        name, weight = item.split("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError("Unknown operation %r" % name)
+        choices.extend([name] * int(weight))
+    return choices
+
+
+def buildFixture(db, folders, breadth, depth):
+    conn = db.open()
+    root = benchmarks.getRoot(conn)
+    if FIXTURE_NAME in root:
+        del root[FIXTURE_NAME]
+    fixture = root[FIXTURE_NAME] = benchmarks.Folder()
+    for i in range(folders):
+        folder = fixture[u"folder%d" % i] = benchmarks.Folder()
+        benchmarks.buildTree(folder, breadth, depth)
+    transaction.commit()
+    conn.close()
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.timers = dict([(name, benchmarks.Timer(name))
+                            for name in OPERATIONS])
+        self.conflicts = 0
+        self.refused = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def merge(self, other):
+        for name in OPERATIONS:
+            self.timers[name].times.extend(other.timers[name].times)
+        self.conflicts += other.conflicts
+        self.refused += other.refused
+        self.failed += other.failed
+        self.skipped += other.skipped
+
+
+class Worker(threading.Thread):
+
+    def __init__(self, db, number, choices, operations, folders, retries,
+                 seed):
+        threading.Thread.__init__(self)
+        self.db = db
+        self.number = number
+        self.choices = choices
+        self.operations = operations
+        self.folders = folders
+        self.retries = retries
+        self.random = random.Random(seed + number)
+        self.stats = Stats()
+        # (folder name, locktoken) of the locks held by this worker
+        self.held = []
+        self.files = 0
+        self.error = None
+
+    def run(self):
+        benchmarks.login("bench%d" % self.number)
+        conn = self.db.open()
+        try:
+            for i in range(self.operations):
+                name = self.random.choice(self.choices)
+                self.stats.timers[name](self.attempt, conn, name)
+        except Exception, e:
+            self.error = e
+        transaction.abort()
+        conn.close()
+        benchmarks.logout()
+
+    def attempt(self, conn, name):
+        for i in range(self.retries + 1):
+            try:
+                result = getattr(self, name)(
+                    benchmarks.getRoot(conn)[FIXTURE_NAME])
+                transaction.commit()
+            except ConflictError:
+                transaction.abort()
+                self.stats.conflicts += 1
+                continue
+            except REFUSED:
+                transaction.abort()
+                self.stats.refused += 1
+                return
+            if result is not None:
+                result()
+            return
+        self.stats.failed += 1
+
+    # Each operation returns a function updating the state of the worker
+    # once its transaction has been committed.
+
+    def lock(self, fixture, scope):
+        folder = u"folder%d" % self.random.randrange(self.folders)
+        locktoken = manager.DAVLockmanager(fixture[folder]).lock(
+            scope, u"write", None, HOUR, "infinity")
+        return lambda: self.held.append((folder, locktoken))
+
+    def exclusive(self, fixture):
+        return self.lock(fixture, u"exclusive")
+
+    def shared(self, fixture):
+        return self.lock(fixture, u"shared")
+
+    def refresh(self, fixture):
+        if not self.held:
+            self.stats.skipped += 1
+            return
+        folder, locktoken = self.random.choice(self.held)
+        manager.DAVLockmanager(fixture[folder]).refreshlock(HOUR)
+
+    def unlock(self, fixture):
+        if not self.held:
+            self.stats.skipped += 1
+            return
+        held = self.random.choice(self.held)
+        manager.DAVLockmanager(fixture[held[0]]).unlock(held[1])
+        return lambda: self.held.remove(held)
+
+    def put(self, fixture):
+        if self.held:
+            folder = self.random.choice(self.held)[0]
+        else:
+            folder = u"folder%d" % self.random.randrange(self.folders)
+        name = u"put-%d-%d" % (self.number, self.files)
+        fixture[folder][name] = benchmarks.File()
+        def added():
+            self.files += 1
+        return added
+
+
+def run(db, threads, operations, choices, folders, retries, seed):
+    workers = [Worker(db, number, choices, operations, folders, retries, seed)
+               for number in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+
+    stats = Stats()
+    for worker in workers:
+        if worker.error is not None:
+            raise worker.error
+        stats.merge(worker.stats)
+    return stats, elapsed
+
+
+def main(args = None):
+    parser = optparse.OptionParser(
+        usage = "%prog [options]", description = __doc__.strip())
+    parser.add_option("-t", "--threads", type = "int", default = 8,
+                      help = "number of concurrent clients (default %default)")
+    parser.add_option("-n", "--operations", type = "int", default = 200,
+                      help = "operations per client (default %default)")
+    parser.add_option("-m", "--mix", default = DEFAULT_MIX,
+                      help = "weights of the operations (default %default)")
+    parser.add_option("-c", "--folders", type = "int", default = 10,
+                      help = "number of folders locked by the clients, fewer "
+                             "folders means more contention "
+                             "(default %default)")
+    parser.add_option("-b", "--breadth", type = "int", default = 3,
+                      help = "breadth of the tree in each folder "
+                             "(default %default)")
+    parser.add_option("-d", "--depth", type = "int", default = 2,
+                      help = "depth of the tree in each folder "
+                             "(default %default)")
+    parser.add_option("-r", "--retries", type = "int", default = 3,
+                      help = "retries after a ConflictError, like the "
+                             "publisher (default %default)")
+    parser.add_option("-s", "--seed", type = "int", default = 0,
+                      help = "random seed (default %default)")
+    parser.add_option("-f", "--filestorage", default = None,
+                      help = "path of the FileStorage shared by the clients, "
+                             "a temporary one is used by default")
+    parser.add_option("-z", "--zeo", default = None, metavar = "HOST:PORT",
+                      help = "use the ZEO server at this address instead of "
+                             "a FileStorage")
+    options, args = parser.parse_args(args)
+    choices = parseMix(options.mix)
+
+    tempdir = None
+    filename = options.filestorage
+    if filename is None and options.zeo is None:
+        tempdir = tempfile.mkdtemp()
+        filename = os.path.join(tempdir, "Data.fs")
+
+    db = benchmarks.setUp(filename, address = options.zeo)
+    try:
+        buildFixture(db, options.folders, options.breadth, options.depth)
+        stats, elapsed = run(db, options.threads, options.operations,
+                             choices, options.folders, options.retries,
+                             options.seed)
+    finally:
+        benchmarks.tearDown(db)
+        if tempdir is not None:
+            shutil.rmtree(tempdir)
+
+    total = benchmarks.Timer("all operations")
+    for name in OPERATIONS:
+        total.times.extend(stats.timers[name].times)
+        print stats.timers[name].report()
+    print total.report()
+    print
+    count = len(total.times)
+    attempts = count - stats.skipped - stats.failed + stats.conflicts
+    print "%d operations in %.3f s, %.1f operations/s" %(
+        count, elapsed, count / elapsed)
+    print "%d conflicts in %d attempts (%.1f%%), %d operations gave up " \
+          "after %d retries" %(
+        stats.conflicts, attempts, 100.0 * stats.conflicts / max(attempts, 1),
+        stats.failed, options.retries)
+    print "%d lock requests refused, %d operations skipped" %(
+        stats.refused, stats.skipped)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Measure how much storage and memory the lock state takes.
+
+Each scenario takes out a lock on a tree of folders in a FileStorage, for
+each of the principals sharing it, and then removes them. For each of these
+transactions we report the growth of Data.fs, the number and size of the
+object records written, grouped by class, and how many objects the
+connection had to load. The peak Python heap is also
+reported when the tracemalloc module is available.
+"""
+
+import datetime
+import optparse
+import os
+import shutil
+import tempfile
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import transaction
+import ZODB.utils
+
+from z3c.davapp.zopelocking import benchmarks
+from z3c.davapp.zopelocking import manager
+
+HOUR = datetime.timedelta(hours = 1)
+
+# name -> (scope, depth)
+SCENARIOS = {
+    "exclusive-0": (u"exclusive", "0"),
+    "exclusive-infinity": (u"exclusive", "infinity"),
+    "shared-infinity": (u"shared", "infinity"),
+    }
+
+class Footprint(object):
+    """
+    What one transaction cost.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.filesize = 0
+        # "module.class" -> [records, bytes]
+        self.records = {}
+        self.loaded = 0
+        self.peak = None
+
+    @property
+    def count(self):
+        return sum([records for records, size in self.records.values()])
+
+    @property
+    def size(self):
+        return sum([size for records, size in self.records.values()])
+
+    def report(self, locked):
+        lines = ["%s: %d bytes added to Data.fs, %d records of %d bytes, "
+                 "%d bytes per locked object, %d objects loaded" %(
+                     self.name, self.filesize, self.count, self.size,
+                     self.size / max(locked, 1), self.loaded)]
+        if self.peak is not None:
+            lines.append("  peak Python heap %d bytes" % self.peak)
+        for classname, (records, size) in sorted(
+            self.records.items(), key = lambda item: -item[1][1]):
+            lines.append("  %-60s %6d records %10d bytes" %(
+                classname, records, size))
+        return "\n".join(lines)
+
+
+def measure(footprint, db, conn, func, *args):
+    """
+    Run `func` and commit, filling in `footprint`.
+    """
+    storage = db.storage
+    conn.cacheMinimize()
+    before = storage.getSize()
+    active = conn._cache.cache_non_ghost_count
+    if tracemalloc is not None:
+        tracemalloc.start()
+    try:
+        result = func(*args)
+        # Counted before the commit, which garbage collects the cache.
+        footprint.loaded = conn._cache.cache_non_ghost_count - active
+        transaction.commit()
+        if tracemalloc is not None:
+            footprint.peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        if tracemalloc is not None:
+            tracemalloc.stop()
+    footprint.filesize = storage.getSize() - before
+
+    tid = storage.lastTransaction()
+    iterator = storage.iterator(tid, tid)
+    try:
+        for txn in iterator:
+            for record in txn:
+                if record.data is None:
+                    continue
+                module, classname = ZODB.utils.get_pickle_metadata(
+                    record.data)
+                counts = footprint.records.setdefault(
+                    "%s.%s" % (module, classname), [0, 0])
+                counts[0] += 1
+                counts[1] += len(record.data)
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            close()
+    return result
+
+
+def runScenario(db, name, breadth, depth, principals):
+    """
+    Lock and unlock a new tree. Returns the size of the tree, the number of
+    locked objects and the footprints of the transactions.
+    """
+    scope, lockdepth = SCENARIOS[name]
+    conn = db.open()
+    root = benchmarks.getRoot(conn)
+    tree = root[u"footprint-%s" % name] = benchmarks.Folder()
+    size = 1 + benchmarks.buildTree(tree, breadth, depth)
+    transaction.commit()
+    locked = lockdepth == "0" and 1 or size
+    if scope == u"exclusive":
+        principals = 1
+
+    lockmanager = manager.DAVLockmanager(tree)
+    footprints = []
+    locktokens = []
+    for i in range(principals):
+        benchmarks.logout()
+        benchmarks.login("footprint%d" % i)
+        footprint = Footprint(i and "lock by principal %d" % i or "lock")
+        locktokens.append(measure(
+            footprint, db, conn, lockmanager.lock,
+            scope, u"write", None, HOUR, lockdepth))
+        footprints.append(footprint)
+    for i in range(principals - 1, -1, -1):
+        benchmarks.logout()
+        benchmarks.login("footprint%d" % i)
+        footprint = Footprint(i and "unlock by principal %d" % i or "unlock")
+        measure(footprint, db, conn, lockmanager.unlock, locktokens[i])
+        footprints.append(footprint)
+    benchmarks.logout()
+    benchmarks.login()
+
+    conn.close()
+    return size, locked, footprints
+
+
+def main(args = None):
+    parser = optparse.OptionParser(
+        usage = "%prog [options] [scenario ...]",
+        description = __doc__.strip(),
+        epilog = "The scenarios are %s, all of them are run by default." %
+                 ", ".join(sorted(SCENARIOS)))
+    parser.add_option("-b", "--breadth", type = "int", default = 5,
+                      help = "sub-folders and files in each folder "
+                             "(default %default)")
+    parser.add_option("-d", "--depth", type = "int", default = 3,
+                      help = "depth of the locked tree (default %default)")
+    parser.add_option("-p", "--principals", type = "int", default = 2,
+                      help = "principals sharing the shared locks "
+                             "(default %default)")
+    options, args = parser.parse_args(args)
+    for name in args:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario %s" % name)
+    scenarios = args or sorted(SCENARIOS)
+
+    tempdir = tempfile.mkdtemp()
+    db = benchmarks.setUp(os.path.join(tempdir, "Data.fs"))
+    try:
+        for name in scenarios:
+            size, locked, footprints = runScenario(
+                db, name, options.breadth, options.depth, options.principals)
+            print "%s on %d objects, %d locked" % (name, size, locked)
+            for footprint in footprints:
+                print footprint.report(locked)
+            print
+    finally:
+        benchmarks.tearDown(db)
+        shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    main()
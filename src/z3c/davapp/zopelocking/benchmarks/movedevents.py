@@ -0,0 +1,90 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Measure the bulk add throughput of a site with no active locks, with and
+without the active lock counter that lets `indirectlyLockObjectOnMovedEvent`
+return early.
+"""
+
+import optparse
+import time
+
+import transaction
+
+from z3c.davapp.zopelocking import benchmarks
+from z3c.davapp.zopelocking import counters
+
+def bulkAdd(db, name, count, batch):
+    conn = db.open()
+    root = benchmarks.getRoot(conn)
+    folder = root[name] = benchmarks.Folder()
+    transaction.commit()
+
+    start = time.time()
+    for i in range(count):
+        folder[u"file%d" % i] = benchmarks.File()
+        if i % batch == batch - 1:
+            transaction.commit()
+    transaction.commit()
+    elapsed = time.time() - start
+
+    conn.close()
+    return elapsed
+
+
+def run(db, count, batch):
+    conn = db.open()
+    utility = benchmarks.getUtility(benchmarks.getRoot(conn))
+    # Counting is normally started by the first lock taken out on the site.
+    counters.resetActiveLockCount(utility)
+    transaction.commit()
+    conn.close()
+    withcounter = bulkAdd(db, u"withcounter", count, batch)
+
+    conn = db.open()
+    utility = benchmarks.getUtility(benchmarks.getRoot(conn))
+    delattr(utility, counters.ACTIVE_LOCKS_KEY)
+    transaction.commit()
+    conn.close()
+    withoutcounter = bulkAdd(db, u"withoutcounter", count, batch)
+
+    return withcounter, withoutcounter
+
+
+def main(args = None):
+    parser = optparse.OptionParser(
+        usage = "%prog [options]", description = __doc__.strip())
+    parser.add_option("-n", "--count", type = "int", default = 10000,
+                      help = "number of objects to add (default %default)")
+    parser.add_option("-b", "--batch", type = "int", default = 1000,
+                      help = "objects added per transaction (default %default)")
+    parser.add_option("-f", "--filestorage", default = None,
+                      help = "use a FileStorage at this path instead of a "
+                             "MappingStorage")
+    options, args = parser.parse_args(args)
+
+    db = benchmarks.setUp(options.filestorage)
+    try:
+        withcounter, withoutcounter = run(db, options.count, options.batch)
+    finally:
+        benchmarks.tearDown(db)
+
+    for label, elapsed in (("with active lock counter", withcounter),
+                           ("without active lock counter", withoutcounter)):
+        print "%-30s %8d objects %8.3f s %10.1f objects/s" %(
+            label, options.count, elapsed, options.count / elapsed)
+
+
+if __name__ == "__main__":
+    main()
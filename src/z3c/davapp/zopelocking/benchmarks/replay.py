@@ -0,0 +1,360 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Replay a trace of WebDAV requests against the lock manager.
+
+Each line of the trace describes one request with six fields separated by
+white space, a "-" standing for a field that doesn't apply:
+
+  timestamp method path depth scope locktoken
+
+for example::
+
+  # seconds   method   path          depth scope     locktoken
+  1190000000.0 LOCK     /docs/a.txt   0     exclusive opaquelocktoken:1
+  1190000001.5 PUT      /docs/a.txt   -     -         opaquelocktoken:1
+  1190000002.0 PROPFIND /docs         1     -         -
+  1190000002.5 LOCK     /docs/a.txt   -     -         opaquelocktoken:1
+  1190000003.0 UNLOCK   /docs/a.txt   -     -         opaquelocktoken:1
+
+A LOCK with a locktoken and no scope is a refresh. The folders and files
+named in the trace are created before the replay starts, except for the
+files that are first created by a PUT. The requests are then started at
+the times of the trace divided by the speed up, by a number of threads, and
+the locktokens of the trace are mapped to the locktokens handed out during
+the replay. We report the distribution of the latencies of each method,
+how late the requests started and how much the storage grew.
+"""
+
+import Queue
+import datetime
+import optparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import transaction
+from ZODB.POSException import ConflictError
+import z3c.dav.interfaces
+
+from z3c.davapp.zopelocking import benchmarks
+from z3c.davapp.zopelocking import manager
+from z3c.davapp.zopelocking import properties
+
+HOUR = datetime.timedelta(hours = 1)
+
+FIXTURE_NAME = u"replay"
+
+METHODS = ("LOCK", "UNLOCK", "PROPFIND", "PUT")
+
+REFUSED = (z3c.dav.interfaces.DAVException,
+           z3c.dav.interfaces.AlreadyLocked,
+           z3c.dav.interfaces.WebDAVErrors)
+
+class TraceRequest(object):
+
+    def __init__(self, timestamp, method, path, depth, scope, locktoken):
+        self.timestamp = timestamp
+        self.method = method
+        self.path = path
+        self.depth = depth
+        self.scope = scope
+        self.locktoken = locktoken
+
+
+def parseTrace(lines):
+    requests = []
+    for number, line in enumerate(lines):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        fields = line.split()
+        if len(fields) != 6:
+            raise ValueError("Line %d doesn't have six fields" % (number + 1))
+        fields = [field != "-" and field or None for field in fields]
+        timestamp, method, path, depth, scope, locktoken = fields
+        requests.append(TraceRequest(
+            float(timestamp), method.upper(), path, depth, scope, locktoken))
+    requests.sort(key = lambda request: request.timestamp)
+    return requests
+
+
+def splitPath(path):
+    return [unicode(name) for name in path.split("/") if name]
+
+
+def buildTree(db, requests):
+    """
+    Create the folders and files used by `requests`, returning the number
+    of objects created.
+    """
+    folders = set([()])
+    files = set()
+    put = set()
+    for request in requests:
+        names = tuple(splitPath(request.path))
+        for i in range(len(names)):
+            folders.add(names[:i])
+        if names not in files and names not in folders:
+            if request.method == "PUT":
+                put.add(names)
+            elif names not in put:
+                files.add(names)
+    files -= folders
+
+    conn = db.open()
+    root = benchmarks.getRoot(conn)
+    if FIXTURE_NAME in root:
+        del root[FIXTURE_NAME]
+    root[FIXTURE_NAME] = benchmarks.Folder()
+    for names in sorted(folders):
+        if names:
+            parent = traverse(conn, names[:-1])
+            if names[-1] not in parent:
+                parent[names[-1]] = benchmarks.Folder()
+    for names in sorted(files):
+        traverse(conn, names[:-1])[names[-1]] = benchmarks.File()
+    transaction.commit()
+    conn.close()
+    return len(folders) + len(files)
+
+
+def traverse(conn, names):
+    ob = benchmarks.getRoot(conn)[FIXTURE_NAME]
+    for name in names:
+        ob = ob[name]
+    return ob
+
+
+def walk(ob, depth):
+    yield ob
+    if depth in ("1", "infinity") and isinstance(ob, benchmarks.Folder):
+        for subob in ob.values():
+            if depth == "1":
+                yield subob
+            else:
+                for found in walk(subob, depth):
+                    yield found
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.latency = dict([(method, benchmarks.Timer(method))
+                             for method in METHODS])
+        self.lateness = []
+        self.conflicts = 0
+        self.refused = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    def add(self, method, latency, lateness):
+        self.lock.acquire()
+        try:
+            self.latency[method].times.append(latency)
+            self.lateness.append(lateness)
+        finally:
+            self.lock.release()
+
+    def count(self, name):
+        self.lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+        finally:
+            self.lock.release()
+
+
+class Replayer(object):
+
+    def __init__(self, db, threads, retries):
+        self.db = db
+        self.threads = threads
+        self.retries = retries
+        self.stats = Stats()
+        # locktoken in the trace -> locktoken handed out by the replay
+        self.locktokens = {}
+
+    def replay(self, requests, speedup):
+        queue = Queue.Queue()
+        start = time.time() + 0.1
+        first = requests and requests[0].timestamp or 0
+        for request in requests:
+            queue.put((start + (request.timestamp - first) / speedup,
+                       request))
+        workers = []
+        for number in range(self.threads):
+            queue.put(None)
+            worker = threading.Thread(target = self.work, args = (queue,))
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+        return time.time() - start
+
+    def work(self, queue):
+        conn = self.db.open()
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
+                scheduled, request = item
+                delay = scheduled - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                started = time.time()
+                self.attempt(conn, request)
+                finished = time.time()
+                if request.method in METHODS:
+                    self.stats.add(request.method, finished - scheduled,
+                                   max(started - scheduled, 0))
+        finally:
+            transaction.abort()
+            conn.close()
+            benchmarks.logout()
+
+    def attempt(self, conn, request):
+        handler = getattr(self, request.method, None)
+        if request.method not in METHODS or handler is None:
+            self.stats.count("skipped")
+            return
+        benchmarks.logout()
+        participation = benchmarks.login("replay", request.method)
+        for i in range(self.retries + 1):
+            try:
+                result = handler(conn, request, participation)
+                transaction.commit()
+            except ConflictError:
+                transaction.abort()
+                self.stats.count("conflicts")
+                continue
+            except KeyError:
+                # Not created yet by a PUT earlier in the trace.
+                transaction.abort()
+                self.stats.count("skipped")
+                return
+            except REFUSED:
+                transaction.abort()
+                self.stats.count("refused")
+                return
+            if result is not None:
+                result()
+            return
+
+    # Each handler returns None or a function to call once its transaction
+    # has been committed.
+
+    def LOCK(self, conn, request, participation):
+        ob = traverse(conn, splitPath(request.path))
+        lockmanager = manager.DAVLockmanager(ob)
+        if request.locktoken is not None and request.scope is None:
+            if request.locktoken not in self.locktokens:
+                self.stats.count("skipped")
+                return
+            lockmanager.refreshlock(HOUR)
+            return
+        locktoken = lockmanager.lock(
+            unicode(request.scope or "exclusive"), u"write", None, HOUR,
+            request.depth or "infinity")
+        if request.locktoken is not None:
+            def mapLocktoken():
+                self.locktokens[request.locktoken] = locktoken
+            return mapLocktoken
+
+    def UNLOCK(self, conn, request, participation):
+        locktoken = self.locktokens.get(request.locktoken, None)
+        if locktoken is None:
+            self.stats.count("skipped")
+            return
+        ob = traverse(conn, splitPath(request.path))
+        manager.DAVLockmanager(ob).unlock(locktoken)
+        def forgetLocktoken():
+            self.locktokens.pop(request.locktoken, None)
+        return forgetLocktoken
+
+    def PROPFIND(self, conn, request, participation):
+        ob = traverse(conn, splitPath(request.path))
+        for subob in walk(ob, request.depth or "infinity"):
+            activelocks = properties.DAVLockdiscovery(
+                subob, participation).lockdiscovery
+            for activelock in activelocks or ():
+                rendered = (activelock.lockscope, activelock.depth,
+                            activelock.owner, activelock.timeout)
+
+    def PUT(self, conn, request, participation):
+        names = splitPath(request.path)
+        parent = traverse(conn, names[:-1])
+        if names[-1] in parent:
+            parent[names[-1]]._p_changed = True
+        else:
+            # Goes through indirectlyLockObjectOnMovedEvent
+            parent[names[-1]] = benchmarks.File()
+
+
+def main(args = None):
+    parser = optparse.OptionParser(
+        usage = "%prog [options] trace", description = __doc__.strip())
+    parser.add_option("-s", "--speedup", type = "float", default = 1.0,
+                      help = "replay the trace this many times faster "
+                             "(default %default)")
+    parser.add_option("-t", "--threads", type = "int", default = 4,
+                      help = "number of concurrent requests "
+                             "(default %default)")
+    parser.add_option("-r", "--retries", type = "int", default = 3,
+                      help = "retries after a ConflictError, like the "
+                             "publisher (default %default)")
+    parser.add_option("-f", "--filestorage", default = None,
+                      help = "path of the FileStorage, a temporary one is "
+                             "used by default")
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("a trace file is required")
+    requests = parseTrace(open(args[0]))
+
+    tempdir = None
+    filename = options.filestorage
+    if filename is None:
+        tempdir = tempfile.mkdtemp()
+        filename = os.path.join(tempdir, "Data.fs")
+
+    db = benchmarks.setUp(filename)
+    try:
+        objects = buildTree(db, requests)
+        before = db.storage.getSize()
+        replayer = Replayer(db, options.threads, options.retries)
+        elapsed = replayer.replay(requests, options.speedup)
+        growth = db.storage.getSize() - before
+    finally:
+        benchmarks.tearDown(db)
+        if tempdir is not None:
+            shutil.rmtree(tempdir)
+
+    stats = replayer.stats
+    for method in METHODS:
+        print stats.latency[method].report()
+    lateness = benchmarks.Timer("started late by")
+    lateness.times = stats.lateness
+    print lateness.report()
+    print
+    print "%d requests on %d objects replayed in %.3f s, %.1f requests/s" %(
+        len(requests), objects, elapsed, len(requests) / max(elapsed, 1e-9))
+    print "%d conflicts, %d refused, %d skipped" %(
+        stats.conflicts, stats.refused, stats.skipped)
+    print "storage grew by %d bytes" % growth
+
+
+if __name__ == "__main__":
+    main()
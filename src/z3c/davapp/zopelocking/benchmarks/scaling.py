@@ -0,0 +1,214 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Measure how the lock operations scale with the size of the locked tree.
+
+A tree of folders is built for each depth given, and the lock manager
+operations are timed on its root folder. For each operation we report the
+mean time at each size and the exponent k of the best fit of time ~ n ** k,
+where n is the number of objects in the tree. An exponent above the
+--max-exponent limit is reported as a regression and the script exits with
+status 1.
+"""
+
+import datetime
+import math
+import optparse
+import sys
+
+import transaction
+import zope.component
+import zope.locking.interfaces
+from zope.publisher.browser import TestRequest
+
+from z3c.davapp.zopelocking import benchmarks
+from z3c.davapp.zopelocking import indirecttokens
+from z3c.davapp.zopelocking import manager
+from z3c.davapp.zopelocking import properties
+
+HOUR = datetime.timedelta(hours = 1)
+
+OPERATIONS = (
+    "lock exclusive depth 0",
+    "lock shared depth 0",
+    "lock exclusive depth infinity",
+    "lock shared depth infinity",
+    "refreshlock",
+    "lockdiscovery (whole tree)",
+    "unlock depth 0",
+    "unlock depth infinity",
+    "removeEndedTokens",
+    )
+
+def walk(ob):
+    yield ob
+    if isinstance(ob, benchmarks.Folder):
+        for subob in ob.values():
+            for found in walk(subob):
+                yield found
+
+
+def committed(func, *args):
+    # The cost of storing the lock state is part of each operation.
+    result = func(*args)
+    transaction.commit()
+    return result
+
+
+def lockdiscovery(tree, request):
+    for ob in walk(tree):
+        activelocks = properties.DAVLockdiscovery(ob, request).lockdiscovery
+        for activelock in activelocks or ():
+            # Read what gets rendered for PROPFIND.
+            rendered = (activelock.lockscope, activelock.depth,
+                        activelock.owner, activelock.timeout)
+
+
+def endWithoutCleanup(token):
+    # End the token without the removeEndedTokens subscriber, so that it can
+    # be timed on its own.
+    gsm = zope.component.getGlobalSiteManager()
+    gsm.unregisterHandler(indirecttokens.removeEndedTokens)
+    try:
+        token.end()
+    finally:
+        gsm.registerHandler(indirecttokens.removeEndedTokens)
+
+
+def measureTree(tree, timers, repeat):
+    lockmanager = manager.DAVLockmanager(tree)
+    utility = zope.component.getUtility(
+        zope.locking.interfaces.ITokenUtility, context = tree)
+    request = TestRequest()
+
+    for i in range(repeat):
+        for scope in (u"exclusive", u"shared"):
+            locktoken = timers["lock %s depth 0" % scope](
+                committed, lockmanager.lock, scope, u"write", None, HOUR, "0")
+            timers["unlock depth 0"](
+                committed, lockmanager.unlock, locktoken)
+
+        for scope in (u"exclusive", u"shared"):
+            locktoken = timers["lock %s depth infinity" % scope](
+                committed, lockmanager.lock,
+                scope, u"write", None, HOUR, "infinity")
+            timers["refreshlock"](committed, lockmanager.refreshlock, HOUR)
+            timers["lockdiscovery (whole tree)"](lockdiscovery, tree, request)
+            timers["unlock depth infinity"](
+                committed, lockmanager.unlock, locktoken)
+
+        lockmanager.lock(u"exclusive", u"write", None, HOUR, "infinity")
+        transaction.commit()
+        token = utility.get(tree)
+        endWithoutCleanup(token)
+        timers["removeEndedTokens"](
+            committed, indirecttokens.removeEndedTokens,
+            token, zope.locking.interfaces.TokenEndedEvent(token))
+
+
+def exponent(sizes, times):
+    """
+    The slope of the least squares fit of log(time) against log(size).
+    """
+    points = [(math.log(size), math.log(max(elapsed, 1e-9)))
+              for size, elapsed in zip(sizes, times)]
+    if len(points) < 2:
+        return 0.0
+    meanx = sum([x for x, y in points]) / len(points)
+    meany = sum([y for x, y in points]) / len(points)
+    sxx = sum([(x - meanx) ** 2 for x, y in points])
+    if not sxx:
+        return 0.0
+    sxy = sum([(x - meanx) * (y - meany) for x, y in points])
+    return sxy / sxx
+
+
+def run(db, breadth, depths, repeat):
+    """
+    Time the operations on a tree of each of the `depths`. Returns the list
+    of tree sizes and a mapping of each operation to its list of timers.
+    """
+    sizes = []
+    results = dict([(name, []) for name in OPERATIONS])
+    for depth in depths:
+        conn = db.open()
+        root = benchmarks.getRoot(conn)
+        name = u"tree%d-%d" % (breadth, depth)
+        tree = root[name] = benchmarks.Folder()
+        sizes.append(1 + benchmarks.buildTree(tree, breadth, depth))
+        transaction.commit()
+
+        timers = dict([(op, benchmarks.Timer(op)) for op in OPERATIONS])
+        measureTree(tree, timers, repeat)
+        for op in OPERATIONS:
+            results[op].append(timers[op])
+
+        del root[name]
+        transaction.commit()
+        conn.close()
+    return sizes, results
+
+
+def main(args = None):
+    parser = optparse.OptionParser(
+        usage = "%prog [options]", description = __doc__.strip())
+    parser.add_option("-b", "--breadth", type = "int", default = 4,
+                      help = "sub-folders and files in each folder "
+                             "(default %default)")
+    parser.add_option("-d", "--depths", default = "1,2,3,4",
+                      help = "comma separated depths of the trees to "
+                             "measure (default %default)")
+    parser.add_option("-r", "--repeat", type = "int", default = 5,
+                      help = "runs of each operation per tree "
+                             "(default %default)")
+    parser.add_option("-k", "--max-exponent", type = "float", default = 1.5,
+                      help = "largest acceptable scaling exponent "
+                             "(default %default)")
+    parser.add_option("-f", "--filestorage", default = None,
+                      help = "use a FileStorage at this path instead of a "
+                             "MappingStorage")
+    options, args = parser.parse_args(args)
+    depths = [int(depth) for depth in options.depths.split(",")]
+
+    db = benchmarks.setUp(options.filestorage)
+    try:
+        sizes, results = run(db, options.breadth, depths, options.repeat)
+    finally:
+        benchmarks.tearDown(db)
+
+    print "%-32s %s %8s" %(
+        "objects", " ".join(["%10d" % size for size in sizes]), "exponent")
+    regressions = []
+    for op in OPERATIONS:
+        means = [timer.total / max(len(timer.times), 1)
+                 for timer in results[op]]
+        k = exponent(sizes, means)
+        flag = ""
+        if k > options.max_exponent:
+            regressions.append(op)
+            flag = " !"
+        print "%-32s %s %8.2f%s" %(
+            op, " ".join(["%8.2fms" % (mean * 1000) for mean in means]),
+            k, flag)
+
+    if regressions:
+        print
+        print "Scaling worse than n ** %.2f: %s" %(
+            options.max_exponent, ", ".join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Time complete WebDAV requests through the publisher.
+
+This uses the functional test layer and fixtures of `ftests.py`, so the
+timings include the XML parsing, the security checks, the If header
+validation and the rendering of `{DAV:}lockdiscovery`. Each scenario is
+run a number of times under cProfile and the most expensive functions are
+printed, or the profiles are saved for use with the pstats module.
+"""
+
+import cProfile
+import optparse
+import os
+import pstats
+
+import transaction
+from zope.app.folder.folder import Folder
+from z3c.dav.ftests.dav import Resource
+
+from z3c.davapp.zopelocking import benchmarks
+from z3c.davapp.zopelocking import ftests
+
+LOCKINFO = """<?xml version="1.0" encoding="utf-8" ?>
+<D:lockinfo xmlns:D="DAV:">
+  <D:lockscope><D:%s/></D:lockscope>
+  <D:locktype><D:write/></D:locktype>
+  <D:owner>
+    <D:href>http://example.org/~ejw/contact.html</D:href>
+  </D:owner>
+</D:lockinfo>"""
+
+PROPFIND = """<?xml version="1.0" encoding="utf-8" ?>
+<D:propfind xmlns:D="DAV:">
+  <D:prop><D:lockdiscovery/></D:prop>
+</D:propfind>"""
+
+SCENARIOS = (
+    "LOCK depth 0",
+    "UNLOCK depth 0",
+    "LOCK depth infinity",
+    "refresh LOCK with If header",
+    "PROPFIND lockdiscovery depth 1",
+    "UNLOCK depth infinity",
+    )
+
+class WebDAVBenchmark(ftests.LOCKTestCase):
+    """
+    Publishes the requests, reusing the set up of the LOCK tests.
+    """
+
+    def __init__(self, profile = True):
+        ftests.LOCKTestCase.__init__(self, "runTest")
+        self.timers = dict([(name, benchmarks.Timer(name))
+                            for name in SCENARIOS])
+        self.profiles = dict([(name, profile and cProfile.Profile() or None)
+                              for name in SCENARIOS])
+
+    def runTest(self):
+        pass
+
+    def buildTree(self, breadth, depth):
+        def fill(folder, depth):
+            for i in range(breadth):
+                folder[u"r%d" % i] = Resource(
+                    "resource %d" % i, contentType = "text/plain")
+            if depth > 0:
+                for i in range(breadth):
+                    folder[u"c%d" % i] = Folder()
+                    fill(folder[u"c%d" % i], depth - 1)
+        self.getRootFolder()[u"bench"] = Folder()
+        fill(self.getRootFolder()[u"bench"], depth)
+        transaction.commit()
+
+    def request(self, scenario, path, env, body = "", status = 200):
+        env = dict(env)
+        env["CONTENT_LENGTH"] = len(body)
+        if body:
+            env["CONTENT_TYPE"] = "text/xml"
+        profile = self.profiles[scenario]
+        if profile is not None:
+            profile.enable()
+        try:
+            response = self.timers[scenario](
+                self.publish, path, basic = "mgr:mgrpw", env = env,
+                request_body = body)
+        finally:
+            if profile is not None:
+                profile.disable()
+        if response.getStatus() != status:
+            raise AssertionError("%s %s returned %d" %(
+                env["REQUEST_METHOD"], path, response.getStatus()))
+        return response
+
+    def lock(self, scenario, path, depth):
+        response = self.request(
+            scenario, path, {"REQUEST_METHOD": "LOCK", "DEPTH": depth,
+                             "TIMEOUT": "Second-3600"},
+            LOCKINFO % "exclusive")
+        return response.getHeader("lock-token")[1:-1]
+
+    def unlock(self, scenario, path, locktoken):
+        self.request(scenario, path, {"REQUEST_METHOD": "UNLOCK",
+                                      "LOCK_TOKEN": "<%s>" % locktoken},
+                     status = 204)
+
+    def run(self, repeat):
+        for i in range(repeat):
+            locktoken = self.lock("LOCK depth 0", "/bench/r0", "0")
+            self.unlock("UNLOCK depth 0", "/bench/r0", locktoken)
+
+            locktoken = self.lock("LOCK depth infinity", "/bench", "infinity")
+            self.request("refresh LOCK with If header", "/bench/r0",
+                         {"REQUEST_METHOD": "LOCK",
+                          "TIMEOUT": "Second-3600",
+                          "IF": "(<%s>)" % locktoken})
+            self.request("PROPFIND lockdiscovery depth 1", "/bench",
+                         {"REQUEST_METHOD": "PROPFIND", "DEPTH": "1"},
+                         PROPFIND, status = 207)
+            self.unlock("UNLOCK depth infinity", "/bench", locktoken)
+
+
+def main(args = None):
+    parser = optparse.OptionParser(
+        usage = "%prog [options]", description = __doc__.strip())
+    parser.add_option("-b", "--breadth", type = "int", default = 5,
+                      help = "sub-collections and resources in each "
+                             "collection (default %default)")
+    parser.add_option("-d", "--depth", type = "int", default = 2,
+                      help = "depth of the locked tree (default %default)")
+    parser.add_option("-r", "--repeat", type = "int", default = 20,
+                      help = "runs of each scenario (default %default)")
+    parser.add_option("-l", "--limit", type = "int", default = 15,
+                      help = "functions printed for each profile "
+                             "(default %default)")
+    parser.add_option("-o", "--output", default = None, metavar = "DIR",
+                      help = "save the profiles in this directory instead "
+                             "of printing them")
+    parser.add_option("-n", "--no-profile", action = "store_false",
+                      dest = "profile", default = True,
+                      help = "only time the requests")
+    options, args = parser.parse_args(args)
+
+    layer = ftests.davlayer
+    layer.setUp()
+    try:
+        benchmark = WebDAVBenchmark(options.profile)
+        benchmark.setUp()
+        try:
+            benchmark.buildTree(options.breadth, options.depth)
+            benchmark.run(options.repeat)
+        finally:
+            benchmark.tearDown()
+    finally:
+        layer.tearDown()
+
+    for name in SCENARIOS:
+        print benchmark.timers[name].report()
+    if not options.profile:
+        return
+    for i, name in enumerate(SCENARIOS):
+        stats = pstats.Stats(benchmark.profiles[name])
+        if options.output is not None:
+            stats.dump_stats(os.path.join(options.output, "%d-%s.prof" %(
+                i, "-".join(name.lower().split()))))
+            continue
+        print
+        print name
+        stats.sort_stats("cumulative").print_stats(options.limit)
+
+
+if __name__ == "__main__":
+    main()
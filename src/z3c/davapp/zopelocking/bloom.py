@@ -0,0 +1,372 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+An optional Bloom filter of the objects that have been locked.
+
+Most objects are not locked, and the filter can tell us so without looking
+in the token utility. The filter is stored on the token utility, with its
+bits split into small persistent buckets, so that adding an object only
+writes the one bucket holding all of its bits. Objects are added to it
+every time a token is registered but they are never removed, so the filter
+needs rebuilding from time to time to keep the false positive rate down.
+
+The filter isn't maintained until `enableLockFilter` has been called for a
+token utility.
+"""
+
+import binascii
+import hashlib
+import struct
+
+import persistent
+import zope.component
+import zope.locking.interfaces
+from ZODB.POSException import ConflictError
+
+import cache
+
+FILTER_KEY = "_z3c_davapp_lockfilter"
+
+# Roughly a 1% false positive rate for 100,000 locked objects.
+DEFAULT_BITS = 2 ** 20
+DEFAULT_HASHES = 7
+
+# The size of the record written when an object is added to the filter.
+BUCKET_BITS = 4096
+
+class LockFilterBucket(persistent.Persistent):
+    """
+    Some of the bits of a lock filter, stored as a string.
+
+      >>> bucket = LockFilterBucket(1024)
+      >>> bucket.set([3, 10])
+      >>> bucket.isSet([3, 10]), bucket.isSet([3, 11])
+      (True, False)
+      >>> state = bucket.__getstate__()
+      >>> type(state['_bits']), len(state['_bits'])
+      (<type 'str'>, 128)
+
+    Concurrent additions to a bucket never conflict, the bits are merged.
+
+      >>> old = LockFilterBucket(1024)
+      >>> committed = LockFilterBucket(1024)
+      >>> committed.set([1])
+      >>> new = LockFilterBucket(1024)
+      >>> new.set([2])
+      >>> merged = LockFilterBucket(1)
+      >>> merged.__setstate__(old._p_resolveConflict(
+      ...    old.__getstate__(), committed.__getstate__(),
+      ...    new.__getstate__()))
+      >>> merged.isSet([1, 2])
+      True
+
+    But buckets of different sizes can't be merged.
+
+      >>> old._p_resolveConflict(old.__getstate__(),
+      ...    LockFilterBucket(2048).__getstate__(),
+      ...    new.__getstate__()) #doctest:+ELLIPSIS
+      Traceback (most recent call last):
+      ...
+      ConflictError: ...
+
+    """
+
+    def __init__(self, size = BUCKET_BITS):
+        self._bits = bytearray((size + 7) // 8)
+
+    def __getstate__(self):
+        state = dict(super(LockFilterBucket, self).__getstate__())
+        state["_bits"] = str(state["_bits"])
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        state["_bits"] = bytearray(state["_bits"])
+        super(LockFilterBucket, self).__setstate__(state)
+
+    def clear(self):
+        self._bits = bytearray(len(self._bits))
+
+    def set(self, indexes):
+        bits = self._bits
+        for index in indexes:
+            bits[index >> 3] |= 1 << (index & 7)
+        self._p_changed = True
+
+    def isSet(self, indexes):
+        bits = self._bits
+        for index in indexes:
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+    def _p_resolveConflict(self, oldState, committedState, newState):
+        committed = committedState["_bits"]
+        new = newState["_bits"]
+        if len(committed) != len(new):
+            raise ConflictError
+        merged = long(binascii.hexlify(committed), 16) | \
+                 long(binascii.hexlify(new), 16)
+        state = dict(newState)
+        state["_bits"] = binascii.unhexlify("%0*x" %(len(new) * 2, merged))
+        return state
+
+
+class LockFilter(persistent.Persistent):
+    """
+    A blocked Bloom filter of the oids of the locked objects. All the bits
+    of an oid are in one bucket.
+
+      >>> from ZODB.utils import p64
+      >>> lockfilter = LockFilter(1024, 3)
+      >>> lockfilter.add('db', p64(1))
+      >>> lockfilter.mightContain('db', p64(1))
+      True
+      >>> lockfilter.mightContain('db', p64(2))
+      False
+      >>> lockfilter.mightContain('db2', p64(1))
+      False
+
+    The bits are split into buckets of `BUCKET_BITS` bits.
+
+      >>> len(LockFilter(DEFAULT_BITS)._buckets)
+      256
+      >>> len(lockfilter._buckets)
+      1
+
+    """
+
+    def __init__(self, size = DEFAULT_BITS, hashes = DEFAULT_HASHES):
+        self.size = size
+        self.hashes = hashes
+        count = max(1, (size + BUCKET_BITS - 1) // BUCKET_BITS)
+        self._buckets = tuple([LockFilterBucket(BUCKET_BITS)
+                               for i in range(count)])
+
+    def clear(self):
+        for bucket in self._buckets:
+            bucket.clear()
+
+    def _locate(self, database_name, oid):
+        digest = hashlib.md5("%s:%s" %(database_name, oid)).digest()
+        h1, h2 = struct.unpack(">QQ", digest)
+        bucket = self._buckets[h1 % len(self._buckets)]
+        step = (h2 >> 32) | 1
+        return bucket, [(h2 + i * step) % BUCKET_BITS
+                        for i in range(self.hashes)]
+
+    def add(self, database_name, oid):
+        bucket, indexes = self._locate(database_name, oid)
+        bucket.set(indexes)
+
+    def mightContain(self, database_name, oid):
+        bucket, indexes = self._locate(database_name, oid)
+        return bucket.isSet(indexes)
+
+
+def _key(ob):
+    jar = getattr(ob, "_p_jar", None)
+    oid = getattr(ob, "_p_oid", None)
+    if jar is None or oid is None:
+        return None
+    return jar.db().database_name, oid
+
+
+def enableLockFilter(utility, size = DEFAULT_BITS, hashes = DEFAULT_HASHES):
+    """
+    Start maintaining a Bloom filter of the locked objects for `utility`.
+    This can also be used to rebuild the filter. Returns False if some of
+    the locked objects can't be added to the filter, in which case the
+    filter isn't used.
+
+      >>> import transaction
+      >>> import persistent.interfaces
+      >>> import ZODB.interfaces
+      >>> import zope.app.keyreference.interfaces
+      >>> from zope.app.keyreference.persistent import \\
+      ...    KeyReferenceToPersistent, connectionOfPersistent
+      >>> from zope.container.btree import BTreeContainer
+      >>> from zope.locking import utility, tokens
+
+      >>> gsm = zope.component.getGlobalSiteManager()
+      >>> gsm.registerAdapter(KeyReferenceToPersistent,
+      ...    (persistent.interfaces.IPersistent,),
+      ...    zope.app.keyreference.interfaces.IKeyReference)
+      >>> gsm.registerAdapter(connectionOfPersistent,
+      ...    (persistent.interfaces.IPersistent,), ZODB.interfaces.IConnection)
+      >>> gsm.registerHandler(addStartedToken)
+
+      >>> root = conn.root()
+      >>> folder = root['folder'] = BTreeContainer()
+      >>> for i in range(3):
+      ...     folder['file%d' % i] = BTreeContainer()
+      >>> util = root['util'] = utility.TokenUtility()
+      >>> transaction.commit()
+
+      >>> token = util.register(
+      ...    tokens.ExclusiveLock(folder['file0'], 'michael'))
+
+    Until the filter is enabled we have to look in the utility.
+
+      >>> mightBeLocked(util, folder['file1'])
+      True
+
+      >>> enableLockFilter(util, 4 * BUCKET_BITS, 3)
+      True
+      >>> mightBeLocked(util, folder['file0'])
+      True
+      >>> mightBeLocked(util, folder['file1'])
+      False
+
+    New tokens are added to the filter as they are registered.
+
+      >>> token = util.register(
+      ...    tokens.ExclusiveLock(folder['file1'], 'michael'))
+      >>> mightBeLocked(util, folder['file1'])
+      True
+      >>> mightBeLocked(util, folder['file2'])
+      False
+
+    Rebuilding the filter forgets the objects that are no longer locked.
+
+      >>> token.end()
+      >>> enableLockFilter(util, 4 * BUCKET_BITS, 3)
+      True
+      >>> mightBeLocked(util, folder['file1'])
+      False
+
+    Adding an object to the filter only writes one bucket.
+
+      >>> transaction.commit()
+      >>> token = util.register(
+      ...    tokens.ExclusiveLock(folder['file2'], 'michael'))
+      >>> lockfilter = getattr(util, FILTER_KEY)
+      >>> lockfilter._p_changed
+      False
+      >>> len([bucket for bucket in lockfilter._buckets if bucket._p_changed])
+      1
+      >>> transaction.commit()
+
+    A registration that didn't see the filter being enabled or resized
+    conflicts with it.
+
+      >>> from ZODB.POSException import ConflictError
+      >>> tm = transaction.TransactionManager()
+      >>> conn2 = db.open(transaction_manager = tm)
+      >>> util2 = conn2.root()['util']
+      >>> folder2 = conn2.root()['folder']
+      >>> enableLockFilter(util, 8 * BUCKET_BITS, 3)
+      True
+      >>> transaction.commit()
+      >>> token2 = util2.register(
+      ...    tokens.ExclusiveLock(folder2['file1'], 'michael'))
+      >>> try:
+      ...     tm.commit()
+      ... except ConflictError:
+      ...     print "Conflict"
+      Conflict
+      >>> tm.abort()
+      >>> conn2.close()
+
+    We can't say anything about objects that are not in the database.
+
+      >>> mightBeLocked(util, Demo())
+      True
+
+    Cleanup.
+
+      >>> transaction.abort()
+      >>> gsm.unregisterAdapter(KeyReferenceToPersistent,
+      ...    (persistent.interfaces.IPersistent,),
+      ...    zope.app.keyreference.interfaces.IKeyReference)
+      True
+      >>> gsm.unregisterAdapter(connectionOfPersistent,
+      ...    (persistent.interfaces.IPersistent,), ZODB.interfaces.IConnection)
+      True
+      >>> gsm.unregisterHandler(addStartedToken)
+      True
+
+    """
+    lockfilter = getattr(utility, FILTER_KEY, None)
+    if lockfilter is not None and lockfilter.size == size and \
+           lockfilter.hashes == hashes:
+        # Rebuild the filter in place, so that objects added to it by
+        # concurrent transactions are merged into the new filter.
+        lockfilter.clear()
+    else:
+        lockfilter = LockFilter(size, hashes)
+    # Tokens registered by a transaction that committed since this one
+    # started are missing from the filter, and so are the tokens of a
+    # transaction that didn't see the new filter. Conflict with both: every
+    # registration changes the tokens epoch of the utility and reads the
+    # utility, which we write here.
+    jar = getattr(utility, "_p_jar", None)
+    epoch = getattr(utility, cache.TOKENS_EPOCH_KEY, None)
+    if jar is not None and getattr(epoch, "_p_oid", None) is not None:
+        jar.readCurrent(epoch)
+    utility._p_changed = True
+    for token in utility:
+        key = _key(token.context)
+        if key is None:
+            disableLockFilter(utility)
+            return False
+        lockfilter.add(*key)
+    setattr(utility, FILTER_KEY, lockfilter)
+    return True
+
+
+def disableLockFilter(utility):
+    if getattr(utility, FILTER_KEY, None) is not None:
+        delattr(utility, FILTER_KEY)
+
+
+def getToken(utility, ob):
+    """
+    The same as utility.get(ob) except that the filter is checked first.
+    """
+    if not mightBeLocked(utility, ob):
+        return None
+    return utility.get(ob)
+
+
+def mightBeLocked(utility, ob):
+    """
+    Returns False if `ob` is definitely not locked by a token registered
+    with `utility`.
+    """
+    lockfilter = getattr(utility, FILTER_KEY, None)
+    if lockfilter is None:
+        return True
+    key = _key(ob)
+    if key is None:
+        return True
+    return lockfilter.mightContain(*key)
+
+
+@zope.component.adapter(zope.locking.interfaces.ITokenStartedEvent)
+def addStartedToken(event):
+    utility = event.object.utility
+    jar = getattr(utility, "_p_jar", None)
+    if jar is not None and utility._p_oid is not None:
+        # Conflict with the filter being enabled or resized.
+        jar.readCurrent(utility)
+    lockfilter = getattr(utility, FILTER_KEY, None)
+    if lockfilter is None:
+        return
+    key = _key(event.object.context)
+    if key is None:
+        # We would give the wrong answer for this object.
+        disableLockFilter(utility)
+        return
+    lockfilter.add(*key)
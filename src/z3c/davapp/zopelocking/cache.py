@@ -0,0 +1,229 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+A process wide cache of the token lookups made by read requests.
+
+Every time a token is registered or ended with a token utility we change a
+counter stored on the utility, the tokens epoch. This is internal to the
+utility, unlike the lock epochs kept on the content for clients by the
+counters module. The serial of the counter, that is the id of
+the last transaction to change it, tells us whether the tokens of the
+utility have changed. When ZODB tells a connection that another transaction
+changed the counter it reloads it and so sees the new serial. As long as the
+serial is the same the cached lookups are still valid and we can skip the
+token utility's BTrees.
+
+Only objects stored in the database are cached, as they are identified by
+their oid.
+"""
+
+from BTrees.Length import Length
+import zope.component
+import zope.locking.interfaces
+
+import bloom
+import sweeper
+
+TOKENS_EPOCH_KEY = "_z3c_davapp_tokensepoch"
+
+# When the cache holds this many lookups it is emptied.
+MAX_ENTRIES = 10000
+
+# (database name, utility oid, object oid) -> (serial, token oid or None)
+_tokens = {}
+
+def clear():
+    _tokens.clear()
+
+
+def getToken(utility, ob):
+    """
+    The same as utility.get(ob), looking in the cache first.
+
+      >>> import transaction
+      >>> import persistent.interfaces
+      >>> import ZODB.interfaces
+      >>> import zope.app.keyreference.interfaces
+      >>> from zope.app.keyreference.persistent import \\
+      ...    KeyReferenceToPersistent, connectionOfPersistent
+      >>> from zope.container.btree import BTreeContainer
+      >>> from zope.locking import utility, tokens
+
+      >>> gsm = zope.component.getGlobalSiteManager()
+      >>> gsm.registerAdapter(KeyReferenceToPersistent,
+      ...    (persistent.interfaces.IPersistent,),
+      ...    zope.app.keyreference.interfaces.IKeyReference)
+      >>> gsm.registerAdapter(connectionOfPersistent,
+      ...    (persistent.interfaces.IPersistent,), ZODB.interfaces.IConnection)
+      >>> gsm.registerHandler(changeEpoch)
+      >>> gsm.registerHandler(changeEpochOnEndedToken)
+
+      >>> root = conn.root()
+      >>> folder = root['folder'] = BTreeContainer()
+      >>> folder['file'] = BTreeContainer()
+      >>> util = root['util'] = utility.TokenUtility()
+      >>> transaction.commit()
+
+    Nothing is cached until the first token is registered with the utility,
+    since the read requests don't write to the database.
+
+      >>> getToken(util, folder) is None
+      True
+      >>> len(_tokens)
+      0
+
+      >>> token = util.register(tokens.ExclusiveLock(folder, 'michael'))
+
+    We don't use the cache in the transaction that changed the tokens, since
+    the serial doesn't change until the transaction is committed.
+
+      >>> getToken(util, folder) is token
+      True
+      >>> len(_tokens)
+      0
+
+      >>> transaction.commit()
+      >>> getToken(util, folder) is token
+      True
+      >>> getToken(util, folder['file']) is None
+      True
+      >>> len(_tokens)
+      2
+
+    Now the token utility isn't used to find the tokens.
+
+      >>> locks = util._locks
+      >>> util._locks = None
+      >>> getToken(util, folder) is token
+      True
+      >>> getToken(util, folder['file']) is None
+      True
+      >>> util._locks = locks
+      >>> transaction.abort()
+
+    Changing the tokens invalidates the cache. Here we use an other
+    connection to make sure that we are told about it by the database.
+
+      >>> tm = transaction.TransactionManager()
+      >>> conn2 = db.open(transaction_manager = tm)
+      >>> folder2 = conn2.root()['folder']
+      >>> util2 = conn2.root()['util']
+      >>> token2 = util2.register(
+      ...    tokens.ExclusiveLock(folder2['file'], 'michael'))
+      >>> tm.commit()
+      >>> conn2.close()
+
+      >>> transaction.commit() # see the changes
+      >>> getToken(util, folder['file']) is not None
+      True
+
+    Ended tokens are not returned.
+
+      >>> token.end()
+      >>> transaction.commit()
+      >>> getToken(util, folder) is None
+      True
+
+    Content that isn't stored in the database isn't cached.
+
+      >>> len(_tokens)
+      2
+      >>> getToken(util, Demo()) is None
+      True
+      >>> len(_tokens)
+      2
+
+    Cleanup.
+
+      >>> clear()
+      >>> gsm.unregisterAdapter(KeyReferenceToPersistent,
+      ...    (persistent.interfaces.IPersistent,),
+      ...    zope.app.keyreference.interfaces.IKeyReference)
+      True
+      >>> gsm.unregisterAdapter(connectionOfPersistent,
+      ...    (persistent.interfaces.IPersistent,), ZODB.interfaces.IConnection)
+      True
+      >>> gsm.unregisterHandler(changeEpoch)
+      True
+      >>> gsm.unregisterHandler(changeEpochOnEndedToken)
+      True
+
+    """
+    if not bloom.mightBeLocked(utility, ob):
+        return None
+    key = _key(utility, ob)
+    if key is None:
+        return utility.get(ob)
+    epoch = getattr(utility, TOKENS_EPOCH_KEY, None)
+    if epoch is None:
+        return utility.get(ob)
+    if epoch._p_oid is None:
+        # Created by the current transaction.
+        return utility.get(ob)
+    # Make sure that we have the serial of the current state.
+    epoch._p_activate()
+    if epoch._p_changed:
+        # Changed by the current transaction.
+        return utility.get(ob)
+    serial = epoch._p_serial
+
+    cached = _tokens.get(key, None)
+    if cached is not None and cached[0] == serial:
+        if cached[1] is None:
+            return None
+        token = ob._p_jar.get(cached[1])
+        if zope.locking.interfaces.IEndable.providedBy(token) and token.ended:
+            # Timed out, leave the clean up to a write transaction.
+            sweeper.noticeEndedToken(token)
+            return None
+        return token
+
+    token = utility.get(ob)
+    if token is not None and getattr(token, "_p_oid", None) is None:
+        return token
+    if len(_tokens) >= MAX_ENTRIES:
+        _tokens.clear()
+    _tokens[key] = (serial, token is not None and token._p_oid or None)
+    return token
+
+
+def _key(utility, ob):
+    jar = getattr(ob, "_p_jar", None)
+    if jar is None or getattr(utility, "_p_jar", None) is not jar or \
+           ob._p_oid is None or utility._p_oid is None:
+        return None
+    return (jar.db().database_name, utility._p_oid, ob._p_oid)
+
+
+@zope.component.adapter(zope.locking.interfaces.ITokenStartedEvent)
+def changeEpoch(event):
+    changeUtilityEpoch(event.object.utility)
+
+
+def changeUtilityEpoch(utility):
+    """
+    The tokens of `utility` have changed without an event, for example
+    when the utility dropped expired tokens.
+    """
+    epoch = getattr(utility, TOKENS_EPOCH_KEY, None)
+    if epoch is None:
+        setattr(utility, TOKENS_EPOCH_KEY, Length(1))
+    else:
+        epoch.change(1)
+
+
+@zope.component.adapter(zope.locking.interfaces.IEndableToken,
+                        zope.locking.interfaces.ITokenEndedEvent)
+def changeEpochOnEndedToken(object, event):
+    changeEpoch(event)
@@ -0,0 +1,297 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Where the time of each lock operation goes.
+
+Once `enable` has been called each lock, unlock and refresh, each container
+event validated against the locks and each clean up of an ended lock
+records how long it spent in each of its phases:
+
+  checks      flushing the deferred clean ups and checking the lock limits
+              and the conflicts before registering anything
+  keyref      resolving the key reference of the object to find its token
+  conflicts   looking for the locks held below a depth infinity lock
+  register    registering the root and indirect tokens
+  traversal   walking the locked subtree, not counting the conflicts and
+              register phases that happen on the way
+  ifheader    matching the If header of the request
+  teardown    ending the lock and removing its indirect tokens
+  counters    maintaining the counters and indexes of the locks
+
+The operations of a request are added to the `COSTS_KEY` annotation of the
+request, and listed in the X-Lock-Costs response header if asked for. The
+operations slower than the threshold are logged, with the path of the
+resource, the depth, the number of objects visited and the phases.
+Operations started by another operation, like the clean up done while
+unlocking, are counted as part of it.
+"""
+
+import logging
+import threading
+import time
+
+import zope.security.management
+import zope.publisher.interfaces.http
+import zope.traversing.api
+
+COSTS_KEY = "z3c.davapp.zopelocking.costs"
+
+HEADER = "X-Lock-Costs"
+
+logger = logging.getLogger("z3c.davapp.zopelocking.costs")
+
+# (threshold in seconds or None, whether to set the response header), or
+# None when nothing is recorded.
+_settings = None
+
+_local = threading.local()
+
+def enable(threshold = None, header = False):
+    """
+    Start recording the cost of the lock operations, logging the ones that
+    take at least `threshold` seconds and listing them in the response
+    header if `header` is true.
+    """
+    global _settings
+    _settings = (threshold, header)
+    _refresh()
+
+
+def disable():
+    global _settings
+    _settings = None
+    _local.current = None
+    _refresh()
+
+
+def _refresh():
+    # The instrumentation module imports this one.
+    import instrumentation
+    instrumentation.refresh()
+
+
+def isEnabled():
+    return _settings is not None
+
+
+def current():
+    """
+    The `OperationCosts` of the operation being recorded in this thread.
+    """
+    return getattr(_local, "current", None)
+
+
+def begin(operation, context, depth = None):
+    """
+    Start recording `operation` on `context`. Returns the value to pass to
+    `end`, None if we are not recording or if this is part of another
+    operation.
+    """
+    if _settings is None or current() is not None:
+        return None
+    costs = _local.current = OperationCosts(operation, context, depth)
+    return costs
+
+
+def end(costs):
+    if costs is None:
+        return
+    costs.elapsed = time.time() - costs.started
+    _local.current = None
+    if _settings is None:
+        return
+    threshold, header = _settings
+
+    request = getRequest()
+    if request is not None:
+        operations = request.annotations.setdefault(COSTS_KEY, [])
+        operations.append(costs)
+        if header:
+            request.response.setHeader(
+                HEADER, ", ".join([operation.summary()
+                                   for operation in operations]))
+
+    if threshold is not None and costs.elapsed >= threshold:
+        logger.warning("Slow %s of %s, depth %s: %.3f s, %d objects "
+                       "visited (%s)", costs.operation, costs.path(),
+                       costs.depth, costs.elapsed, costs.visited,
+                       costs.phasesSummary())
+
+
+def start():
+    """
+    Start timing a phase, returns the value to pass to `stop`.
+    """
+    costs = current()
+    if costs is None:
+        return None
+    return time.time(), dict(costs.phases)
+
+
+def stop(phase, started, exclude = ()):
+    """
+    Add the time since `started` to `phase`, less the time spent meanwhile
+    in the phases listed in `exclude`.
+    """
+    costs = current()
+    if started is None or costs is None:
+        return
+    now, before = started
+    spent = time.time() - now
+    for name in exclude:
+        spent -= costs.phases.get(name, 0) - before.get(name, 0)
+    costs.add(phase, spent)
+
+
+def visit(count = 1):
+    costs = current()
+    if costs is not None:
+        costs.visited += count
+
+
+def getRequest():
+    # This is an hack to get at the current request object
+    interaction = zope.security.management.queryInteraction()
+    if interaction is None:
+        return None
+    for participation in interaction.participations:
+        if zope.publisher.interfaces.http.IHTTPRequest.providedBy(
+            participation):
+            return participation
+    return None
+
+
+class OperationCosts(object):
+    """
+    The time spent in each phase of one lock operation.
+
+      >>> import datetime
+      >>> import zope.component
+      >>> import zope.interface
+      >>> import zope.locking.interfaces
+      >>> from zope.locking import utility
+      >>> from zope.locking.adapters import TokenBroker
+      >>> from zope.annotation.attribute import AttributeAnnotations
+      >>> from manager import DAVLockmanager
+      >>> from indirecttokens import removeEndedTokens
+
+      >>> util = utility.TokenUtility()
+      >>> conn.add(util) # add to persistent database
+      >>> gsm = zope.component.getGlobalSiteManager()
+      >>> gsm.registerUtility(util, zope.locking.interfaces.ITokenUtility)
+      >>> gsm.registerAdapter(TokenBroker, (zope.interface.Interface,),
+      ...    zope.locking.interfaces.ITokenBroker)
+      >>> gsm.registerAdapter(AttributeAnnotations)
+      >>> gsm.registerHandler(removeEndedTokens)
+
+      >>> folder = DemoFolder(None, u'folder')
+      >>> folder['sub'] = DemoFolder()
+      >>> folder['sub']['file'] = Demo()
+      >>> folder['file'] = Demo()
+
+    Nothing is recorded until we enable it.
+
+      >>> request = getRequest()
+      >>> locktoken = DAVLockmanager(folder).lock(u'exclusive', u'write',
+      ...    u'Michael', datetime.timedelta(seconds = 3600), 'infinity')
+      >>> DAVLockmanager(folder).unlock(locktoken)
+      >>> COSTS_KEY in request.annotations
+      False
+
+      >>> import logging
+      >>> class PrintHandler(logging.Handler):
+      ...     def emit(self, record):
+      ...         print record.args[:3]
+      >>> handler = PrintHandler()
+      >>> logger.addHandler(handler)
+
+      >>> enable(threshold = 0, header = True)
+      >>> locktoken = DAVLockmanager(folder).lock(u'exclusive', u'write',
+      ...    u'Michael', datetime.timedelta(seconds = 3600), 'infinity')
+      ('lock', u'/folder', 'infinity')
+      >>> DAVLockmanager(folder).unlock(locktoken)
+      ('unlock', u'/folder', None)
+
+      >>> lock, unlock = request.annotations[COSTS_KEY]
+      >>> lock.operation, lock.visited
+      ('lock', 3)
+      >>> sorted(lock.phases)
+      ['checks', 'conflicts', 'counters', 'register', 'traversal']
+      >>> sorted(unlock.phases)
+      ['checks', 'keyref', 'teardown']
+
+    Each operation is summarized in the response header.
+
+      >>> header = request.response.getHeader(HEADER)
+      >>> [summary.split()[:2] for summary in header.split(', ')]
+      [['lock', '/folder'], ['unlock', '/folder']]
+
+    Only the operations at least as slow as the threshold are logged.
+
+      >>> enable(threshold = 3600)
+      >>> locktoken = DAVLockmanager(folder).lock(u'exclusive', u'write',
+      ...    u'Michael', datetime.timedelta(seconds = 3600), '0')
+      >>> len(request.annotations[COSTS_KEY])
+      3
+
+    Cleanup.
+
+      >>> disable()
+      >>> logger.removeHandler(handler)
+      >>> gsm.unregisterUtility(util, zope.locking.interfaces.ITokenUtility)
+      True
+      >>> gsm.unregisterAdapter(TokenBroker, (zope.interface.Interface,),
+      ...    zope.locking.interfaces.ITokenBroker)
+      True
+      >>> gsm.unregisterAdapter(AttributeAnnotations)
+      True
+      >>> gsm.unregisterHandler(removeEndedTokens)
+      True
+
+    """
+
+    def __init__(self, operation, context, depth = None):
+        self.operation = operation
+        self.context = context
+        self.depth = depth
+        self.started = time.time()
+        self.elapsed = None
+        # phase -> seconds
+        self.phases = {}
+        self.visited = 0
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def path(self):
+        try:
+            return zope.traversing.api.getPath(self.context)
+        except TypeError:
+            # Not located
+            return repr(self.context)
+
+    def phasesSummary(self):
+        return " ".join(["%s=%.1fms" % (phase, seconds * 1000)
+                         for phase, seconds in sorted(self.phases.items())])
+
+    def summary(self):
+        summary = "%s %s %.1fms" % (self.operation, self.path(),
+                                    (self.elapsed or 0) * 1000)
+        if self.depth is not None:
+            summary += " depth=%s" % self.depth
+        if self.visited:
+            summary += " visited=%d" % self.visited
+        if self.phases:
+            summary += " " + self.phasesSummary()
+        return summary
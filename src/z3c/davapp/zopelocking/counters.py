@@ -0,0 +1,772 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Cheap counters describing the lock state of a site.
+
+The counters are maintained by event subscribers as tokens are started and
+ended, and they are stored in `BTrees.Length.Length` objects so that
+concurrent transactions changing them never conflict. There is one counter
+of all the lock roots on the token utility, and every annotatable object
+counts the lock roots at or below it in the content tree. The objects for
+which `enableLockEpochs` has been called also keep a lock epoch counter,
+which goes up every time a lock at or below them changes. Their lock epoch
+adds up the counters of their parents too, so that it also changes with
+the depth infinity locks of the parents. The counts are allowed to
+over count - a token that silently times out is never ended and so never
+decremented until `resetActiveLockCount` rebuilds the counts - but they must
+never under count, since a count of zero is used to skip lock checks
+altogether.
+"""
+
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+import zope.component
+import zope.annotation.interfaces
+import zope.container.interfaces
+import zope.lifecycleevent.interfaces
+import zope.locking.interfaces
+
+import interfaces
+
+ACTIVE_LOCKS_KEY = "_z3c_davapp_activelocks"
+PRINCIPAL_LOCKS_KEY = "_z3c_davapp_principallocks"
+SUBTREE_LOCKS_KEY = "z3c.davapp.zopelocking.subtreelocks"
+SUBTREE_SIZE_KEY = "z3c.davapp.zopelocking.subtreesize"
+SUBTREE_MIN_SIZE_KEY = "z3c.davapp.zopelocking.subtreeminsize"
+SUBTREE_SIZES_KEY = "_z3c_davapp_subtreesizes"
+LOCK_EPOCH_KEY = "z3c.davapp.zopelocking.lockepoch"
+
+# Smaller subtrees are cheap to count again, so their size isn't cached and
+# counting a tree for the first time doesn't write to all its containers.
+MIN_CACHED_SIZE = 100
+
+def countRootTokens(utility):
+    """
+    Count the tokens currently registered with `utility` that are not
+    indirect tokens. This walks every token and so should only be used to
+    initialize or repair a counter.
+    """
+    count = 0
+    for token in utility:
+        if not interfaces.IIndirectToken.providedBy(token):
+            count += 1
+    return count
+
+
+def startCounting(utility):
+    """
+    Start maintaining the counters for `utility`, taking into account the
+    lock roots that are already registered.
+    """
+    count = 0
+    for token in utility:
+        if not interfaces.IIndirectToken.providedBy(token):
+            changeSubtreeLockCount(token.context, 1)
+            count += 1
+    setattr(utility, ACTIVE_LOCKS_KEY, Length(count))
+    return count
+
+
+def activeLockCount(utility):
+    """
+    Return the number of lock roots registered with `utility`, or None if
+    the counter isn't being maintained yet. This never writes to the
+    database.
+    """
+    counter = getattr(utility, ACTIVE_LOCKS_KEY, None)
+    if counter is None:
+        return None
+    return counter()
+
+
+def resetActiveLockCount(utility, top = None):
+    """
+    Recount the lock roots registered with `utility`, and rebuild the
+    subtree lock counts at or below `top`. This is needed to forget about
+    tokens that have silently timed out. `top` defaults to the top of the
+    content tree containing the utility and the lock roots.
+    """
+    counter = getattr(utility, ACTIVE_LOCKS_KEY, None)
+    if counter is None:
+        counter = Length(0)
+        setattr(utility, ACTIVE_LOCKS_KEY, counter)
+    roots = [token.context for token in utility
+             if not interfaces.IIndirectToken.providedBy(token)]
+    if top is None:
+        tops = [_top(ob) for ob in [utility] + roots]
+    else:
+        tops = [top]
+    rebuildSubtreeLockCounts(roots, tops)
+    counter.set(len(roots))
+    return len(roots)
+
+
+def _top(ob):
+    while getattr(ob, "__parent__", None) is not None:
+        ob = ob.__parent__
+    return ob
+
+
+def rebuildSubtreeLockCounts(roots, tops):
+    """
+    Set the subtree lock counts at or below each of the objects in `tops` to
+    the number of objects in `roots` at or below them. Only the subtrees
+    with a count are visited.
+    """
+    # id(ob) -> [ob, count] for all the objects at or above a lock root.
+    counts = {}
+    for ob in roots:
+        while ob is not None:
+            counts.setdefault(id(ob), [ob, 0])[1] += 1
+            ob = getattr(ob, "__parent__", None)
+    visited = {}
+    for top in tops:
+        _clearSubtreeLockCounts(top, counts, visited)
+    for ob, count in counts.values():
+        annotations = zope.annotation.interfaces.IAnnotations(ob, None)
+        if annotations is None:
+            continue
+        counter = annotations.get(SUBTREE_LOCKS_KEY, None)
+        if counter is None:
+            annotations[SUBTREE_LOCKS_KEY] = Length(count)
+        elif counter() != count:
+            counter.set(count)
+
+
+def _clearSubtreeLockCounts(ob, counts, visited):
+    # Zero the counts of the objects that are not above any lock root.
+    if id(ob) in visited:
+        return
+    visited[id(ob)] = True
+    annotations = zope.annotation.interfaces.IAnnotations(ob, None)
+    if annotations is not None:
+        counter = annotations.get(SUBTREE_LOCKS_KEY, None)
+        if counter is None or counter() == 0:
+            # Nothing was ever counted below here.
+            return
+        if id(ob) not in counts:
+            counter.set(0)
+    if zope.container.interfaces.IReadContainer.providedBy(ob):
+        for subob in ob.values():
+            _clearSubtreeLockCounts(subob, counts, visited)
+
+
+def subtreeLockCount(utility, ob):
+    """
+    Return the number of lock roots at or below `ob`. None is returned when
+    we don't know, either because the counters for `utility` are not being
+    maintained yet or because `ob` can't be annotated. This never writes to
+    the database.
+    """
+    if getattr(utility, ACTIVE_LOCKS_KEY, None) is None:
+        return None
+    annotations = zope.annotation.interfaces.IAnnotations(ob, None)
+    if annotations is None:
+        return None
+    counter = annotations.get(SUBTREE_LOCKS_KEY, None)
+    if counter is None:
+        return 0
+    return counter()
+
+
+def changeSubtreeLockCount(ob, delta):
+    """
+    Add `delta` to the subtree lock count of `ob` and all its parents.
+    """
+    while ob is not None:
+        annotations = zope.annotation.interfaces.IAnnotations(ob, None)
+        if annotations is not None:
+            counter = annotations.get(SUBTREE_LOCKS_KEY, None)
+            if counter is not None:
+                counter.change(delta)
+            elif delta > 0:
+                annotations[SUBTREE_LOCKS_KEY] = Length(delta)
+        ob = getattr(ob, "__parent__", None)
+
+
+def moveSubtreeLockCount(utility, event):
+    """
+    Move the subtree lock count of the object of the IObjectMovedEvent
+    `event` from its old parents to its new parents.
+    """
+    if event.oldParent is event.newParent:
+        return
+    count = subtreeLockCount(utility, event.object)
+    if not count:
+        return
+    if event.oldParent is not None:
+        changeSubtreeLockCount(event.oldParent, -count)
+    if event.newParent is not None:
+        changeSubtreeLockCount(event.newParent, count)
+    # The lock roots below the object have new URLs. Moving an unlocked
+    # subtree leaves the epochs alone.
+    if event.oldParent is not None:
+        changeLockEpoch(event.oldParent)
+    changeLockEpoch(event.object)
+
+
+@zope.component.adapter(zope.lifecycleevent.interfaces.IObjectCopiedEvent)
+def clearSubtreeLockCountsOnCopiedEvent(event):
+    """
+    The copy of a locked subtree isn't locked, since the tokens stay with
+    the original, but it carries the subtree lock counts of the original.
+    Throw them away before the copy is added, otherwise its new parents
+    would count locks that don't exist.
+    """
+    _clearCopiedSubtreeLockCounts(event.object)
+
+
+def _clearCopiedSubtreeLockCounts(ob):
+    annotations = zope.annotation.interfaces.IAnnotations(ob, None)
+    if annotations is not None:
+        if SUBTREE_LOCKS_KEY not in annotations:
+            # Nothing below was counted either.
+            return
+        del annotations[SUBTREE_LOCKS_KEY]
+    if zope.container.interfaces.IReadContainer.providedBy(ob):
+        for subob in ob.values():
+            _clearCopiedSubtreeLockCounts(subob)
+
+
+def iterLockedDescendants(utility, ob):
+    """
+    Generate the (object, token) pairs for the lock roots strictly below
+    `ob`. Subtrees whose count says that they contain no lock roots are never
+    visited. Nothing is generated when we don't know the count for `ob`.
+    """
+    count = subtreeLockCount(utility, ob)
+    if not count:
+        return
+    token = utility.get(ob)
+    if token is not None and not interfaces.IIndirectToken.providedBy(token):
+        count -= 1
+    if count > 0:
+        for found in _iterLockedDescendants(utility, ob):
+            yield found
+
+
+def _iterLockedDescendants(utility, container):
+    if not zope.container.interfaces.IReadContainer.providedBy(container):
+        return
+    for subob in container.values():
+        if subtreeLockCount(utility, subob) == 0:
+            continue
+        token = utility.get(subob)
+        if token is not None and \
+               not interfaces.IIndirectToken.providedBy(token):
+            yield subob, token
+        for found in _iterLockedDescendants(utility, subob):
+            yield found
+
+
+def principalLockCount(utility, principal_id):
+    """
+    Return the number of WebDAV locks held by `principal_id`.
+    """
+    principals = getattr(utility, PRINCIPAL_LOCKS_KEY, None)
+    if principals is None:
+        return 0
+    counter = principals.get(principal_id, None)
+    if counter is None:
+        return 0
+    return counter()
+
+
+def changePrincipalLockCount(utility, principal_id, delta):
+    principals = getattr(utility, PRINCIPAL_LOCKS_KEY, None)
+    if principals is None:
+        if delta <= 0:
+            return
+        principals = OOBTree()
+        setattr(utility, PRINCIPAL_LOCKS_KEY, principals)
+    counter = principals.get(principal_id, None)
+    if counter is not None:
+        counter.change(delta)
+    elif delta > 0:
+        principals[principal_id] = Length(delta)
+
+
+def subtreeSize(ob):
+    """
+    Return the cached number of objects below `ob`, or None if it hasn't been
+    cached.
+    """
+    annotations = zope.annotation.interfaces.IAnnotations(ob, None)
+    if annotations is None:
+        return None
+    counter = annotations.get(SUBTREE_SIZE_KEY, None)
+    if counter is None:
+        return None
+    return counter()
+
+
+def subtreeSizesCached(utility):
+    """
+    Return True if subtree sizes have ever been cached for the content
+    locked through `utility`, so that they need to be kept up to date.
+    """
+    return getattr(utility, SUBTREE_SIZES_KEY, False)
+
+
+def countDescendants(ob, limit = None, utility = None):
+    """
+    Return the number of objects below `ob`, using the cached subtree sizes.
+    If `limit` is given we stop counting once we know that there are more
+    than `limit` objects and return a number greater than `limit`, so the
+    cost is bounded by `limit`. The sizes counted are only cached when the
+    token `utility` is given, which is then marked so that the sizes are
+    kept up to date. A subtree that was too big to count completely caches
+    the number of objects counted as a lower bound of its size.
+    """
+    size = subtreeSize(ob)
+    if size is not None:
+        return size
+    annotations = zope.annotation.interfaces.IAnnotations(ob, None)
+    if limit is not None and annotations is not None:
+        minsize = annotations.get(SUBTREE_MIN_SIZE_KEY, 0)
+        if minsize > limit:
+            return minsize
+    if not zope.container.interfaces.IReadContainer.providedBy(ob):
+        return 0
+    count = 0
+    for subob in ob.values():
+        sublimit = limit
+        if limit is not None:
+            sublimit = limit - count - 1
+        count += 1 + countDescendants(subob, sublimit, utility)
+        if limit is not None and count > limit:
+            if count >= MIN_CACHED_SIZE:
+                _cacheSize(utility, annotations, SUBTREE_MIN_SIZE_KEY, count)
+            return count
+    if count >= MIN_CACHED_SIZE and \
+           _cacheSize(utility, annotations, SUBTREE_SIZE_KEY, Length(count)) \
+           and SUBTREE_MIN_SIZE_KEY in annotations:
+        del annotations[SUBTREE_MIN_SIZE_KEY]
+    return count
+
+
+def _cacheSize(utility, annotations, key, value):
+    if utility is None or annotations is None:
+        return False
+    if not subtreeSizesCached(utility):
+        setattr(utility, SUBTREE_SIZES_KEY, True)
+    annotations[key] = value
+    return True
+
+
+def changeSubtreeSize(ob, delta):
+    """
+    Add `delta` to the cached subtree size of `ob` and all its parents. Only
+    sizes that have already been cached are changed.
+    """
+    while ob is not None:
+        annotations = zope.annotation.interfaces.IAnnotations(ob, None)
+        if annotations is not None:
+            counter = annotations.get(SUBTREE_SIZE_KEY, None)
+            if counter is not None:
+                counter.change(delta)
+        ob = getattr(ob, "__parent__", None)
+
+
+def forgetSubtreeSize(ob):
+    """
+    Throw away the cached subtree sizes of `ob` and all its parents, so
+    that they are counted again when needed.
+    """
+    while ob is not None:
+        annotations = zope.annotation.interfaces.IAnnotations(ob, None)
+        if annotations is not None:
+            for key in (SUBTREE_SIZE_KEY, SUBTREE_MIN_SIZE_KEY):
+                if key in annotations:
+                    del annotations[key]
+        ob = getattr(ob, "__parent__", None)
+
+
+def _lockEpochCounter(ob):
+    annotations = zope.annotation.interfaces.IAnnotations(ob, None)
+    if annotations is None:
+        return None
+    return annotations.get(LOCK_EPOCH_KEY, None)
+
+
+def lockEpoch(ob):
+    """
+    Return the lock epoch of `ob`, or None if no epoch is kept for `ob`.
+    The epoch is the sum of the counters kept by `ob` and its parents, so
+    it changes when a lock at or below `ob` changes, and when a lock on one
+    of its parents changes, which covers `ob` if it is a depth infinity
+    lock. Moving `ob` changes its parents, and so its epoch. This never
+    writes to the database.
+    """
+    counter = _lockEpochCounter(ob)
+    if counter is None:
+        return None
+    epoch = counter()
+    ob = getattr(ob, "__parent__", None)
+    while ob is not None:
+        counter = _lockEpochCounter(ob)
+        if counter is not None:
+            epoch += counter()
+        ob = getattr(ob, "__parent__", None)
+    return epoch
+
+
+def changeLockEpoch(ob):
+    """
+    Increase the lock epochs kept by `ob` and its parents, after a lock on
+    `ob` has been taken out, refreshed or removed. The epochs are never
+    created here, so concurrent changes never conflict.
+    """
+    while ob is not None:
+        annotations = zope.annotation.interfaces.IAnnotations(ob, None)
+        if annotations is not None:
+            counter = annotations.get(LOCK_EPOCH_KEY, None)
+            if counter is not None:
+                counter.change(1)
+        ob = getattr(ob, "__parent__", None)
+
+
+def enableLockEpochs(ob):
+    """
+    Start keeping a lock epoch for `ob` and all the containers below it that
+    can be annotated. This writes to all of them, so it should be run once
+    outside of the requests taking out locks, for example when setting up a
+    site. Returns the number of epochs created.
+    """
+    created = 0
+    annotations = zope.annotation.interfaces.IAnnotations(ob, None)
+    if annotations is not None and LOCK_EPOCH_KEY not in annotations:
+        annotations[LOCK_EPOCH_KEY] = Length(0)
+        created += 1
+    if zope.container.interfaces.IReadContainer.providedBy(ob):
+        for subob in ob.values():
+            if zope.container.interfaces.IReadContainer.providedBy(subob):
+                created += enableLockEpochs(subob)
+    return created
+
+
+@zope.component.adapter(zope.container.interfaces.IObjectMovedEvent)
+def enableLockEpochsOnMovedEvent(event):
+    """
+    Containers added to or moved into a container keeping a lock epoch get
+    their own epochs up front, rather than when they are first locked.
+    """
+    # The containers below one keeping an epoch keep their own, so we only
+    # need to look at the new parent and not at all its parents.
+    ob = event.object
+    if event.newParent is None or \
+           not zope.container.interfaces.IReadContainer.providedBy(ob) or \
+           _lockEpochCounter(event.newParent) is None or \
+           _lockEpochCounter(ob) is not None:
+        return
+    enableLockEpochs(ob)
+
+
+@zope.component.adapter(zope.locking.interfaces.ITokenStartedEvent)
+def countStartedToken(event):
+    """
+    Subscriber for ITokenStartedEvent.
+
+      >>> import datetime
+      >>> from zope.locking import utility
+      >>> from zope.locking.tokens import ExclusiveLock, SharedLock
+      >>> import indirecttokens
+
+      >>> zope.component.provideHandler(countStartedToken)
+      >>> zope.component.provideHandler(countEndedToken)
+
+      >>> util = utility.TokenUtility()
+      >>> conn.add(util) # add to persistent database
+
+    Until a token is started the counter isn't maintained, so we can't tell
+    if anything is locked.
+
+      >>> activeLockCount(util) is None
+      True
+
+      >>> demofolder = DemoFolder()
+      >>> demofolder['demo'] = Demo()
+      >>> roottoken = util.register(
+      ...    ExclusiveLock(demofolder, 'michael', datetime.timedelta(hours=1)))
+      >>> activeLockCount(util)
+      1
+
+    Indirect tokens are never counted since they always share a root token
+    which has been counted already.
+
+      >>> indirect = util.register(
+      ...    indirecttokens.IndirectToken(demofolder['demo'], roottoken))
+      >>> activeLockCount(util)
+      1
+
+      >>> file = Demo()
+      >>> sharedtoken = util.register(SharedLock(file, ('michael', 'john')))
+      >>> activeLockCount(util)
+      2
+
+    Removing one principal from a shared lock doesn't end it, removing the
+    last does.
+
+      >>> sharedtoken.remove(('john',))
+      >>> activeLockCount(util)
+      2
+      >>> sharedtoken.remove(('michael',))
+      >>> activeLockCount(util)
+      1
+
+    Ending an indirect token ends its root.
+
+      >>> indirect.end()
+      >>> activeLockCount(util)
+      0
+
+    The count can be rebuilt from the tokens in the utility.
+
+      >>> roottoken = util.register(ExclusiveLock(file, 'michael'))
+      >>> resetActiveLockCount(util)
+      1
+      >>> roottoken.end()
+      >>> activeLockCount(util)
+      0
+
+    Subtree lock counts
+    -------------------
+
+    Annotatable objects count the lock roots at or below them.
+
+      >>> from zope.annotation.interfaces import IAttributeAnnotatable
+      >>> from zope.annotation.attribute import AttributeAnnotations
+      >>> zope.component.provideAdapter(AttributeAnnotations)
+
+      >>> class Folder(DemoFolder):
+      ...     zope.interface.implements(IAttributeAnnotatable)
+
+      >>> top = Folder()
+      >>> top['sub'] = Folder()
+      >>> top['sub']['file'] = Demo()
+      >>> top['other'] = Folder()
+      >>> top['other']['file'] = Demo()
+
+      >>> subtreeLockCount(util, top)
+      0
+
+    We don't know anything about the objects that can't be annotated.
+
+      >>> subtreeLockCount(util, DemoFolder()) is None
+      True
+
+      >>> filetoken = util.register(
+      ...    ExclusiveLock(top['sub']['file'], 'michael'))
+      >>> subtreeLockCount(util, top['sub']['file'])
+      1
+      >>> subtreeLockCount(util, top['sub'])
+      1
+      >>> subtreeLockCount(util, top)
+      1
+      >>> subtreeLockCount(util, top['other'])
+      0
+
+    Only the lock roots below an object are generated, the rest of the tree
+    is never visited.
+
+      >>> [ob is top['sub']['file'] for ob, token in
+      ...  iterLockedDescendants(util, top)]
+      [True]
+      >>> list(iterLockedDescendants(util, top['other']))
+      []
+
+    When an object is moved its count moves with it.
+
+      >>> from zope.container.contained import ObjectMovedEvent
+      >>> moved = top['sub']
+      >>> del top['sub']
+      >>> top['other']['moved'] = moved
+      >>> moveSubtreeLockCount(util, ObjectMovedEvent(
+      ...    moved, top, 'sub', top['other'], 'moved'))
+      >>> subtreeLockCount(util, top['other'])
+      1
+      >>> subtreeLockCount(util, top)
+      1
+
+      >>> filetoken.end()
+      >>> subtreeLockCount(util, top['other'])
+      0
+      >>> subtreeLockCount(util, top)
+      0
+
+    A lock that silently times out is never taken off the counts, until they
+    are reset.
+
+      >>> import zope.locking.utils
+      >>> expiring = util.register(ExclusiveLock(
+      ...    top['other']['file'], 'michael', datetime.timedelta(hours = 1)))
+      >>> oldNow = zope.locking.utils.now
+      >>> def hackNow():
+      ...     return oldNow() + datetime.timedelta(hours = 2)
+      >>> zope.locking.utils.now = hackNow
+      >>> filetoken = util.register(
+      ...    ExclusiveLock(top['other']['moved']['file'], 'michael'))
+      >>> zope.locking.utils.now = oldNow
+      >>> activeLockCount(util), subtreeLockCount(util, top)
+      (2, 2)
+      >>> subtreeLockCount(util, top['other']['file'])
+      1
+
+      >>> resetActiveLockCount(util, top)
+      1
+      >>> subtreeLockCount(util, top), subtreeLockCount(util, top['other'])
+      (1, 1)
+      >>> subtreeLockCount(util, top['other']['file'])
+      0
+      >>> subtreeLockCount(util, top['other']['moved'])
+      1
+      >>> [ob is top['other']['moved']['file'] for ob, token in
+      ...  iterLockedDescendants(util, top)]
+      [True]
+
+      >>> filetoken.end()
+      >>> subtreeLockCount(util, top)
+      0
+
+    A copy of a locked subtree isn't locked, so the counts copied with it
+    are thrown away before it is added.
+
+      >>> import copy
+      >>> from zope.lifecycleevent import ObjectCopiedEvent
+      >>> from zope.container.contained import ObjectAddedEvent
+      >>> filetoken = util.register(
+      ...    ExclusiveLock(top['other']['moved']['file'], 'michael'))
+      >>> copied = copy.deepcopy(top['other']['moved'])
+      >>> subtreeLockCount(util, copied), subtreeLockCount(util, copied['file'])
+      (1, 1)
+      >>> clearSubtreeLockCountsOnCopiedEvent(
+      ...    ObjectCopiedEvent(copied, top['other']['moved']))
+      >>> subtreeLockCount(util, copied), subtreeLockCount(util, copied['file'])
+      (0, 0)
+      >>> top['copied'] = copied
+      >>> moveSubtreeLockCount(util, ObjectAddedEvent(copied, top, 'copied'))
+      >>> subtreeLockCount(util, top)
+      1
+      >>> del top['copied']
+      >>> filetoken.end()
+      >>> subtreeLockCount(util, top)
+      0
+
+    Lock epochs
+    -----------
+
+    Annotatable objects can also keep a lock epoch counter, which goes up
+    whenever a lock at or below them changes. Changing the locks doesn't
+    create the counters, so that concurrent changes never conflict.
+
+      >>> lockEpoch(top) is None
+      True
+      >>> changeLockEpoch(top['other']['file'])
+      >>> lockEpoch(top) is None
+      True
+      >>> lockEpoch(DemoFolder()) is None
+      True
+
+    They are created up front for a container and the containers below it.
+
+      >>> enableLockEpochs(top)
+      3
+      >>> lockEpoch(top), lockEpoch(top['other'])
+      (0, 0)
+      >>> lockEpoch(top['other']['moved'])
+      0
+      >>> lockEpoch(top['other']['file']) is None
+      True
+
+      >>> changeLockEpoch(top['other']['file'])
+      >>> lockEpoch(top), lockEpoch(top['other'])
+      (1, 2)
+
+    The epoch of an object adds up the counters of its parents, so the
+    epochs of the descendants of a depth infinity lock change with it.
+
+      >>> lockEpoch(top['other']['moved'])
+      2
+      >>> changeLockEpoch(top)
+      >>> lockEpoch(top['other']['moved'])
+      3
+
+    Containers added below a container keeping an epoch get one too.
+
+      >>> from zope.container.contained import ObjectAddedEvent
+      >>> added = top['added'] = Folder()
+      >>> enableLockEpochsOnMovedEvent(ObjectAddedEvent(added, top, 'added'))
+      >>> lockEpoch(added)
+      2
+
+    Moving a locked subtree changes the epochs of its old and new parents,
+    since its lock roots have new URLs. Moving an unlocked one doesn't,
+    but its own epoch changes with its parents.
+
+      >>> filetoken = util.register(
+      ...    ExclusiveLock(top['other']['moved']['file'], 'michael'))
+      >>> moved = top['other']['moved']
+      >>> del top['other']['moved']
+      >>> top['moved'] = moved
+      >>> moveSubtreeLockCount(util, ObjectMovedEvent(
+      ...    moved, top['other'], 'moved', top, 'moved'))
+      >>> lockEpoch(top), lockEpoch(top['other']), lockEpoch(moved)
+      (4, 6, 5)
+
+      >>> lockEpoch(added)
+      4
+      >>> del top['added']
+      >>> top['other']['added'] = added
+      >>> moveSubtreeLockCount(util, ObjectMovedEvent(
+      ...    added, top, 'added', top['other'], 'added'))
+      >>> lockEpoch(top), lockEpoch(top['other']), lockEpoch(added)
+      (4, 6, 6)
+      >>> filetoken.end()
+
+    Cleanup.
+
+      >>> gsm = zope.component.getGlobalSiteManager()
+      >>> gsm.unregisterAdapter(AttributeAnnotations)
+      True
+      >>> gsm.unregisterHandler(countStartedToken)
+      True
+      >>> gsm.unregisterHandler(countEndedToken)
+      True
+
+    """
+    token = event.object
+    if interfaces.IIndirectToken.providedBy(token):
+        return
+    utility = token.utility
+    counter = getattr(utility, ACTIVE_LOCKS_KEY, None)
+    if counter is None:
+        # First token started since we started counting. The token has
+        # already been registered so it is included in this count.
+        startCounting(utility)
+    else:
+        counter.change(1)
+        changeSubtreeLockCount(token.context, 1)
+
+
+@zope.component.adapter(zope.locking.interfaces.IEndableToken,
+                        zope.locking.interfaces.ITokenEndedEvent)
+def countEndedToken(object, event):
+    """subscriber handler for ITokenEndedEvent"""
+    token = event.object
+    if interfaces.IIndirectToken.providedBy(token):
+        return
+    counter = getattr(token.utility, ACTIVE_LOCKS_KEY, None)
+    if counter is not None:
+        counter.change(-1)
+        changeSubtreeLockCount(token.context, -1)
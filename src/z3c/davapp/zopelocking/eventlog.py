@@ -0,0 +1,196 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+The most recent lock events of this process.
+
+The lock manager and the clean up of ended locks record each lock, unlock
+and refresh, each lock cleaned up after it was ended or swept after it
+timed out, and each operation refused because of a conflicting lock or
+failed with a ZODB conflict error. The events are kept in a ring of
+preallocated arrays, so recording one costs the same however busy the
+server is and never allocates memory, and only the last `SIZE` events are
+kept. It is always on.
+"""
+
+import array
+import datetime
+import itertools
+import time
+
+import zope.publisher.browser
+from ZODB.POSException import ConflictError
+from ZODB.utils import oid_repr
+import z3c.dav.interfaces
+
+KINDS = ("lock", "unlock", "refresh", "end", "expiry", "conflict", "error")
+LOCK, UNLOCK, REFRESH, END, EXPIRY, CONFLICT, ERROR = range(len(KINDS))
+
+SIZE = 4096
+
+class EventRing(object):
+    """
+    A fixed number of events, the oldest being overwritten by the newest.
+
+      >>> ring = EventRing(3)
+      >>> ring.dump()
+      []
+      >>> for i in range(4):
+      ...     ring.record(LOCK, 1190000000.0 + i, 1190000000.5 + i,
+      ...                 detail = i)
+      >>> ring.record(EXPIRY, 1190000010.0, 1190000010.25, '\\0' * 7 + '\\1')
+      >>> for event in ring.dump():
+      ...     print event
+      (2, 'lock', 1190000002.0, 0.5, None, 2)
+      (3, 'lock', 1190000003.0, 0.5, None, 3)
+      (4, 'expiry', 1190000010.0, 0.25, '\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x01', 0)
+
+    The lock manager records its operations in the ring of the process.
+
+      >>> import datetime
+      >>> import zope.component
+      >>> import zope.interface
+      >>> import zope.locking.interfaces
+      >>> from zope.locking import utility
+      >>> from zope.locking.adapters import TokenBroker
+      >>> from zope.publisher.browser import TestRequest
+      >>> from manager import DAVLockmanager
+
+      >>> util = utility.TokenUtility()
+      >>> conn.add(util) # add to persistent database
+      >>> gsm = zope.component.getGlobalSiteManager()
+      >>> gsm.registerUtility(util, zope.locking.interfaces.ITokenUtility)
+      >>> gsm.registerAdapter(TokenBroker, (zope.interface.Interface,),
+      ...    zope.locking.interfaces.ITokenBroker)
+
+      >>> ring = resize(8)
+      >>> file = Demo()
+      >>> hour = datetime.timedelta(seconds = 3600)
+      >>> locktoken = DAVLockmanager(file).lock(u'exclusive', u'write',
+      ...    u'Michael', hour, '0')
+      >>> DAVLockmanager(file).refreshlock(hour)
+      >>> try:
+      ...     DAVLockmanager(file).lock(u'exclusive', u'write', u'Michael',
+      ...                               hour, '0')
+      ... except z3c.dav.interfaces.AlreadyLocked:
+      ...     print "Already locked"
+      Already locked
+      >>> DAVLockmanager(file).unlock(locktoken)
+      >>> [(kind, detail) for sequence, kind, timestamp, duration, oid, detail
+      ...  in ring.dump()]
+      [('lock', 0), ('refresh', 0), ('conflict', 1), ('unlock', 0)]
+
+    The view lists the events, the most recent first.
+
+      >>> lines = LockEventsView(util, TestRequest())().splitlines()
+      >>> [line.split()[2] for line in lines]
+      [u'unlock', u'conflict', u'refresh', u'lock']
+
+    Cleanup.
+
+      >>> ring = resize(SIZE)
+      >>> gsm.unregisterUtility(util, zope.locking.interfaces.ITokenUtility)
+      True
+      >>> gsm.unregisterAdapter(TokenBroker, (zope.interface.Interface,),
+      ...    zope.locking.interfaces.ITokenBroker)
+      True
+
+    """
+
+    def __init__(self, size = SIZE):
+        self.size = size
+        self.sequences = array.array("l", [-1]) * size
+        self.kinds = array.array("b", [0]) * size
+        self.started = array.array("d", [0.0]) * size
+        self.durations = array.array("d", [0.0]) * size
+        self.details = array.array("l", [0]) * size
+        # The oids of the objects, which already exist.
+        self.oids = [None] * size
+        self._next = itertools.count()
+
+    def record(self, kind, started, ended, oid = None, detail = 0):
+        # Taking the next number is atomic, so each thread has its own slot.
+        sequence = self._next.next()
+        slot = sequence % self.size
+        self.sequences[slot] = -1
+        self.kinds[slot] = kind
+        self.started[slot] = started
+        self.durations[slot] = ended - started
+        self.details[slot] = detail
+        self.oids[slot] = oid
+        self.sequences[slot] = sequence
+
+    def dump(self):
+        """
+        The (sequence, kind, started, duration, oid, detail) of the events
+        in the ring, the oldest first.
+        """
+        events = []
+        for slot in range(self.size):
+            sequence = self.sequences[slot]
+            if sequence >= 0:
+                events.append((sequence, KINDS[self.kinds[slot]],
+                               self.started[slot], self.durations[slot],
+                               self.oids[slot], self.details[slot]))
+        events.sort()
+        return events
+
+
+ring = EventRing()
+
+def resize(size):
+    """
+    Replace the ring of this process with an empty one keeping `size`
+    events, which is returned.
+    """
+    global ring
+    ring = EventRing(size)
+    return ring
+
+
+def start():
+    return time.time()
+
+
+def record(kind, started, error = None, ob = None, detail = 0):
+    """
+    Record the `kind` operation on `ob` started at `started`, that failed
+    with `error` if it isn't None.
+    """
+    if isinstance(error, z3c.dav.interfaces.WebDAVErrors):
+        kind, detail = CONFLICT, len(error.errors)
+    elif isinstance(error, (z3c.dav.interfaces.AlreadyLocked,
+                            ConflictError)):
+        kind, detail = CONFLICT, 1
+    elif error is not None:
+        kind = ERROR
+    ring.record(kind, started, time.time(), getattr(ob, "_p_oid", None),
+                detail)
+
+
+class LockEventsView(zope.publisher.browser.BrowserPage):
+    """
+    The recent lock events of this process as text, the most recent first.
+    """
+
+    def __call__(self):
+        self.request.response.setHeader("content-type", "text/plain")
+        lines = []
+        for sequence, kind, started, duration, oid, detail in reversed(
+            ring.dump()):
+            lines.append(u"%d %s %s %.1fms %s %d" % (
+                sequence,
+                datetime.datetime.utcfromtimestamp(started).isoformat(),
+                kind, duration * 1000, oid is not None and oid_repr(oid) or "-",
+                detail))
+        return u"\n".join(lines)
@@ -0,0 +1,366 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+A table of the expiration times of the tokens registered with a token
+utility.
+
+Asking each token whether it has ended loads every token from the
+database. The token utility already keeps the expiration time of each token
+next to the token in its index, so we copy these into flat arrays: the
+expiration times in seconds since the epoch, whether the token is a lock
+root, and the oid of the token. Finding the expired tokens is then one pass
+over the expiration times, done by numpy if it is installed, and only the
+expired tokens are loaded.
+
+The tables are kept in memory for each process and are rebuilt when the
+tokens epoch of the utility changes, see the cache module. Tokens that
+haven't been committed yet are not in the table.
+"""
+
+import array
+import bisect
+import calendar
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import zope.component
+import zope.locking.interfaces
+import zope.locking.utils
+
+import interfaces
+import cache
+
+NEVER = float("inf")
+
+# (database name, utility oid) -> (serial, table)
+_tables = {}
+
+def clear():
+    _tables.clear()
+
+
+def _timestamp(value):
+    if value is None:
+        return NEVER
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+def now():
+    return _timestamp(zope.locking.utils.now())
+
+
+class ExpiryTable(object):
+    """
+    The expiration times of some tokens, stored column by column.
+
+      >>> table = ExpiryTable([('\\0' * 7 + '\\1', True, 100.0),
+      ...                      ('\\0' * 7 + '\\2', False, 100.0),
+      ...                      ('\\0' * 7 + '\\3', True, NEVER),
+      ...                      ('\\0' * 7 + '\\4', True, 200.0)])
+      >>> len(table)
+      4
+
+    Only the lock roots are returned, indirect tokens end with their root.
+
+      >>> table.expiredOids(150.0)
+      ['\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x01']
+      >>> len(table.expiredOids(1000.0))
+      2
+
+      >>> table.remaining(['\\0' * 7 + '\\1', '\\0' * 7 + '\\3',
+      ...                  '\\0' * 7 + '\\4', 'unknown'], 150.0)
+      [0, None, 50, False]
+
+    The same answers are given without numpy.
+
+      >>> oldnumpy = globals()['numpy']
+      >>> globals()['numpy'] = None
+      >>> table.expiredOids(150.0)
+      ['\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x01']
+      >>> table.remaining(['\\0' * 7 + '\\1', '\\0' * 7 + '\\3',
+      ...                  '\\0' * 7 + '\\4', 'unknown'], 150.0)
+      [0, None, 50, False]
+      >>> globals()['numpy'] = oldnumpy
+
+    """
+
+    def __init__(self, rows):
+        self.expirations = array.array("d")
+        self.roots = array.array("b")
+        oids = []
+        for oid, isroot, expires in rows:
+            oids.append(oid)
+            self.roots.append(isroot and 1 or 0)
+            self.expirations.append(expires)
+        self.oids = "".join(oids)
+        self._sortedOids = None
+
+    def __len__(self):
+        return len(self.expirations)
+
+    def _oid(self, row):
+        return self.oids[row * 8:row * 8 + 8]
+
+    def expiredRows(self, when):
+        """
+        The rows of the lock roots that have expired at `when`.
+        """
+        if not len(self):
+            return []
+        if numpy is not None:
+            expirations = numpy.frombuffer(self.expirations, numpy.float64)
+            roots = numpy.frombuffer(self.roots, numpy.int8)
+            return numpy.flatnonzero(
+                (expirations <= when) & (roots != 0)).tolist()
+        return [row for row, expires in enumerate(self.expirations)
+                if expires <= when and self.roots[row]]
+
+    def expiredOids(self, when):
+        return [self._oid(row) for row in self.expiredRows(when)]
+
+    def remaining(self, oids, when):
+        """
+        The number of seconds left at `when` for each of the tokens in
+        `oids`, None for tokens that don't expire and False for tokens that
+        aren't in the table.
+        """
+        if not len(self):
+            return [False] * len(oids)
+        if self._sortedOids is None:
+            self._sortedOids = sorted(
+                [(self._oid(row), row) for row in range(len(self))])
+        rows = []
+        for oid in oids:
+            pos = bisect.bisect_left(self._sortedOids, (oid,))
+            if pos < len(self._sortedOids) and \
+                   self._sortedOids[pos][0] == oid:
+                rows.append(self._sortedOids[pos][1])
+            else:
+                rows.append(-1)
+        if numpy is not None:
+            expirations = numpy.frombuffer(self.expirations, numpy.float64)
+            left = numpy.maximum(
+                expirations.take([max(row, 0) for row in rows]) - when, 0)
+            left = left.tolist()
+        else:
+            left = [max(self.expirations[max(row, 0)] - when, 0)
+                    for row in rows]
+        result = []
+        for row, seconds in zip(rows, left):
+            if row < 0:
+                result.append(False)
+            elif seconds == NEVER:
+                result.append(None)
+            else:
+                result.append(int(seconds))
+        return result
+
+
+def buildExpiryTable(utility):
+    def rows():
+        for token, principal_ids, expiration in utility._locks.values():
+            # The class of a ghost is known without loading it.
+            oid = getattr(token, "_p_oid", None)
+            if oid is not None:
+                yield (oid,
+                       not interfaces.IIndirectToken.implementedBy(
+                           type(token)),
+                       _timestamp(expiration))
+    return ExpiryTable(rows())
+
+
+def _key(utility):
+    jar = getattr(utility, "_p_jar", None)
+    if jar is None or utility._p_oid is None:
+        return None
+    return (jar.db().database_name, utility._p_oid)
+
+
+def _serial(utility):
+    epoch = getattr(utility, cache.TOKENS_EPOCH_KEY, None)
+    if epoch is None or epoch._p_oid is None:
+        return None
+    epoch._p_activate()
+    if epoch._p_changed:
+        # Changed by the current transaction.
+        return None
+    return epoch._p_serial
+
+
+def getExpiryTable(utility):
+    """
+    The table for the tokens of `utility`, from the cache if the tokens
+    haven't changed.
+
+      >>> import datetime
+      >>> import transaction
+      >>> import persistent.interfaces
+      >>> import ZODB.interfaces
+      >>> import zope.app.keyreference.interfaces
+      >>> from zope.app.keyreference.persistent import \\
+      ...    KeyReferenceToPersistent, connectionOfPersistent
+      >>> from zope.container.btree import BTreeContainer
+      >>> from zope.locking import utility, tokens
+      >>> import indirecttokens
+
+      >>> gsm = zope.component.getGlobalSiteManager()
+      >>> gsm.registerAdapter(KeyReferenceToPersistent,
+      ...    (persistent.interfaces.IPersistent,),
+      ...    zope.app.keyreference.interfaces.IKeyReference)
+      >>> gsm.registerAdapter(connectionOfPersistent,
+      ...    (persistent.interfaces.IPersistent,), ZODB.interfaces.IConnection)
+      >>> gsm.registerHandler(cache.changeEpoch)
+      >>> gsm.registerHandler(cache.changeEpochOnEndedToken)
+      >>> gsm.registerHandler(changeEpochOnExpirationChanged)
+
+      >>> root = conn.root()
+      >>> folder = root['folder'] = BTreeContainer()
+      >>> for name in ('a', 'b', 'c', 'd'):
+      ...     folder[name] = BTreeContainer()
+      >>> util = root['util'] = utility.TokenUtility()
+      >>> transaction.commit()
+      >>> hour = datetime.timedelta(hours = 1)
+      >>> a = util.register(tokens.ExclusiveLock(folder['a'], 'michael', hour))
+      >>> b = util.register(
+      ...    tokens.ExclusiveLock(folder['b'], 'michael', hour * 2))
+      >>> c = util.register(tokens.ExclusiveLock(folder['c'], 'michael'))
+      >>> d = util.register(indirecttokens.IndirectToken(folder['d'], a))
+      >>> transaction.commit()
+
+      >>> table = getExpiryTable(util)
+      >>> len(table)
+      4
+      >>> getExpiryTable(util) is table
+      True
+      >>> list(findExpiredTokens(util))
+      []
+
+    Ninety minutes later the first lock has expired. Only the lock root is
+    returned.
+
+      >>> oldNow = zope.locking.utils.now
+      >>> def hackNow():
+      ...     return oldNow() + datetime.timedelta(minutes = 90)
+      >>> zope.locking.utils.now = hackNow
+
+      >>> [token is a for token in findExpiredTokens(util)]
+      [True]
+
+    The remaining timeouts of many tokens are worked out at once. Indirect
+    tokens have the timeout of their lock root.
+
+      >>> remaining = remainingTimeouts(util, [a, b, c, d])
+      >>> remaining[0], 1790 < remaining[1] <= 1800, remaining[2:]
+      (0, True, [None, 0])
+
+    The sweeper cleans up after the expired locks.
+
+      >>> len(a.annotations[indirecttokens.INDIRECT_INDEX_KEY])
+      1
+      >>> indirecttokens.sweepExpiredTokens(util)
+      >>> len(a.annotations[indirecttokens.INDIRECT_INDEX_KEY])
+      0
+      >>> transaction.commit()
+      >>> findExpiredTokens(util)
+      []
+
+    Refreshing a lock changes the tokens epoch of the utility, so that the
+    table is rebuilt with the new expiration time.
+
+      >>> table = getExpiryTable(util)
+      >>> b.remaining_duration = hour
+      >>> 3590 < remainingTimeouts(util, [b])[0] <= 3600
+      True
+      >>> transaction.commit()
+      >>> getExpiryTable(util) is table
+      False
+      >>> 3590 < remainingTimeouts(util, [b])[0] <= 3600
+      True
+
+    Cleanup.
+
+      >>> zope.locking.utils.now = oldNow
+      >>> clear()
+      >>> gsm.unregisterAdapter(KeyReferenceToPersistent,
+      ...    (persistent.interfaces.IPersistent,),
+      ...    zope.app.keyreference.interfaces.IKeyReference)
+      True
+      >>> gsm.unregisterAdapter(connectionOfPersistent,
+      ...    (persistent.interfaces.IPersistent,), ZODB.interfaces.IConnection)
+      True
+      >>> gsm.unregisterHandler(cache.changeEpoch)
+      True
+      >>> gsm.unregisterHandler(cache.changeEpochOnEndedToken)
+      True
+      >>> gsm.unregisterHandler(changeEpochOnExpirationChanged)
+      True
+
+    """
+    key = _key(utility)
+    serial = _serial(utility)
+    if key is None or serial is None:
+        return buildExpiryTable(utility)
+    cached = _tables.get(key, None)
+    if cached is not None and cached[0] == serial:
+        return cached[1]
+    table = buildExpiryTable(utility)
+    _tables[key] = (serial, table)
+    return table
+
+
+def findExpiredTokens(utility):
+    """
+    The lock roots registered with `utility` that have expired.
+    """
+    jar = getattr(utility, "_p_jar", None)
+    if jar is None:
+        return []
+    expired = []
+    for oid in getExpiryTable(utility).expiredOids(now()):
+        token = jar.get(oid)
+        # The token may have been refreshed by the current transaction.
+        if token.ended:
+            expired.append(token)
+    return expired
+
+
+def remainingTimeouts(utility, tokens):
+    """
+    The number of seconds left before each of `tokens` expires, or None
+    for the tokens that don't expire.
+    """
+    roots = []
+    for token in tokens:
+        if interfaces.IIndirectToken.providedBy(token):
+            token = token.roottoken
+        roots.append(token)
+    remaining = getExpiryTable(utility).remaining(
+        [getattr(token, "_p_oid", None) for token in roots], now())
+    for i, seconds in enumerate(remaining):
+        if seconds is False:
+            # Not in the table yet.
+            duration = roots[i].remaining_duration
+            if duration is not None:
+                duration = max(duration.days * 86400 + duration.seconds, 0)
+            remaining[i] = duration
+    return remaining
+
+
+@zope.component.adapter(zope.locking.interfaces.IEndableToken,
+                        zope.locking.interfaces.IExpirationChangedEvent)
+def changeEpochOnExpirationChanged(object, event):
+    cache.changeEpoch(event)
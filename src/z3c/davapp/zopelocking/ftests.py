@@ -398,6 +398,54 @@ class LOCKTestCase(z3c.dav.ftests.dav.DAVTestCase):
         lockmanager = IDAVLockmanager(self.getRootFolder()["a"]["r2"])
         self.assertEqual(lockmanager.islocked(), True)
 
+    def test_lock_collection_depth_inf_withlockedsubitems(self):
+        self.login()
+        self.createFolderFileStructure()
+
+        for name in ("r2", "r3"):
+            lockmanager = IDAVLockmanager(self.getRootFolder()["a"][name])
+            lockmanager.lock("exclusive", "write", """<D:owner>
+<D:href>http://webdav.org/</D:href></D:owner>""",
+                             duration = datetime.timedelta(100), depth = "0")
+        transaction.commit()
+        self.logout()
+
+        body ="""<?xml version="1.0" encoding="utf-8" ?>
+<D:lockinfo xmlns:D='DAV:'>
+  <D:lockscope><D:exclusive/></D:lockscope>
+  <D:locktype><D:write/></D:locktype>
+  <D:owner>
+    <D:href>http://example.org/~ejw/contact.html</D:href>
+  </D:owner>
+</D:lockinfo>"""
+
+        httpresponse = self.publish(
+            "/a", basic = "mgr:mgrpw",
+            env = {"REQUEST_METHOD": "LOCK",
+                   "DEPTH": "infinity",
+                   "TIMEOUT": "Second-4100000000",
+                   "CONTENT_TYPE": "text/xml"},
+            request_body = body,
+            handle_errors = True)
+
+        etree = z3c.etree.getEngine()
+        xmlbody = etree.fromstring(httpresponse.getBody())
+
+        self.assertEqual(httpresponse.getStatus(), 207)
+
+        # Both locked resources are reported in the one response.
+        statuses = {}
+        for response in xmlbody.findall("{DAV:}response"):
+            statuses[response.findall("{DAV:}href")[0].text] = \
+                response.findall("{DAV:}status")[0].text
+        self.assertEqual(statuses, {
+            "http://localhost/a/": "HTTP/1.1 424 Failed Dependency",
+            "http://localhost/a/r2": "HTTP/1.1 423 Locked",
+            "http://localhost/a/r3": "HTTP/1.1 423 Locked"})
+
+        lockmanager = IDAVLockmanager(self.getRootFolder()["a"])
+        self.assertEqual(lockmanager.islocked(), False)
+
     def test_lock_file_then_propfind(self):
         ## Test that the locking properties get updated correctly whenever a
         ## resource is locked. We do this by performing a PROPFIND on the
@@ -24,6 +24,12 @@ import zope.locking.tokens
 from zope.app.keyreference.interfaces import IKeyReference
 
 import interfaces
+import cache
+import counters
+import expiry
+import instrumentation
+import stats
+import sweeper
 
 INDIRECT_INDEX_KEY = 'zope.app.dav.lockingutils'
 
@@ -439,11 +445,60 @@ def removeEndedTokens(object, event):
     assert zope.locking.interfaces.ITokenEndedEvent.providedBy(event)
     roottoken = event.object
     assert not interfaces.IIndirectToken.providedBy(roottoken)
+    if sweeper.deferCleanup(roottoken):
+        # Don't write to the database during a read request.
+        return
+    instrumentation.call("removeEndedTokens", roottoken.context,
+                         cleanupEndedToken, (roottoken,))
+
+
+def cleanupEndedToken(roottoken):
+    counters.changeLockEpoch(roottoken.context)
+    stats.removeToken(roottoken)
     index = roottoken.annotations.get(INDIRECT_INDEX_KEY, {})
     # read the whole index in memory so that we correctly loop over all the
     # items in this list.
     indexItems = list(index.items())
+    instrumentation.count(instrumentation.TOKENS_REMOVED, len(indexItems))
     for key_ref, token in indexItems:
-        # token has ended so it should be removed via the register method
-        roottoken.utility.register(token)
+        # token has ended so it should be removed via the register method,
+        # unless the utility has already cleaned out the expired token in
+        # which case registering it again would start it.
+        if isRegistered(roottoken.utility, key_ref, token):
+            roottoken.utility.register(token)
         del index[key_ref]
+    return len(indexItems)
+
+
+def isRegistered(utility, key_ref, token):
+    # The utility has no API for finding ended tokens, so look in its index.
+    current = utility._locks.get(key_ref, None)
+    return current is not None and current[0] is token
+
+
+def flushDeferredCleanups(utility):
+    """
+    Clean up after the locks that ended during read requests. This must be
+    called from a transaction that writes to `utility`.
+    """
+    for roottoken in sweeper.popQueuedTokens(utility):
+        if roottoken.ended:
+            instrumentation.call("removeEndedTokens", roottoken.context,
+                                 cleanupEndedToken, (roottoken,))
+
+
+def sweepExpiredTokens(utility):
+    """
+    Clean up after all the locks registered with `utility` that have timed
+    out, which nobody is told about. This must be called from a transaction
+    that writes to `utility`, for example from a sweeper run every so often.
+    """
+    expired = expiry.findExpiredTokens(utility)
+    for roottoken in expired:
+        instrumentation.call("removeExpiredTokens", roottoken.context,
+                             cleanupEndedToken, (roottoken,))
+    if expired:
+        # The utility drops the expired tokens without telling anyone, so
+        # the cached lookups and expiry table would still list them.
+        cache.changeUtilityEpoch(utility)
+    stats.pruneExpired(utility)
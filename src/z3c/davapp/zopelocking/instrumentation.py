@@ -0,0 +1,341 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+The one hook through which the lock operations are instrumented.
+
+The lock manager, the clean up of ended locks, the container event handler
+and the `{DAV:}lockdiscovery` property run each of their operations through
+`call`, and report what they count with `count`. Both are passed on to the
+IOperationObserver objects registered with `register`, which by default
+record the costs, the tracing spans, the metrics and the event log.
+Observers that are turned off are skipped, and when none is active the
+operation is simply called. The active observers are looked up again only
+after `refresh` is called, which the costs, tracing and metrics modules do
+when they are turned on or off.
+"""
+
+import zope.interface
+
+import interfaces
+import costs
+import eventlog
+import metrics
+import tracing
+
+NODES_VISITED = "nodes_visited"
+TOKENS_REGISTERED = "tokens_registered"
+TOKENS_REMOVED = "tokens_removed"
+MOVED_SHORTCUTS = "moved_shortcuts"
+MOVED_CHECKS = "moved_checks"
+
+# The operations cleaning up after ended locks, which return the number of
+# indirect tokens removed.
+CLEANUP_OPERATIONS = ("removeEndedTokens", "removeExpiredTokens")
+# The operations that are only timed, the {DAV:}lockdiscovery property that
+# is found for each resource of a read request, and the registration of the
+# indirect tokens which is part of a lock.
+TIMED_OPERATIONS = ("lockdiscovery", "maybeRecursivelyLockIndirectly")
+
+_observers = []
+
+# The active observers, and those of them interested in the counts, or None
+# when they need to be looked up again.
+_active = None
+_counting = None
+
+def register(observer):
+    """
+    Tell `observer` about the lock operations from now on.
+    """
+    if observer not in _observers:
+        _observers.append(observer)
+        refresh()
+
+
+def unregister(observer):
+    if observer in _observers:
+        _observers.remove(observer)
+        refresh()
+
+
+def refresh():
+    """
+    Look up the active observers again before the next operation, after
+    one of them has been turned on or off.
+    """
+    global _active, _counting
+    _active = _counting = None
+
+
+def _lookup():
+    global _active, _counting
+    active = [observer for observer in _observers if observer.active()]
+    _counting = [observer for observer in active if observer.counts]
+    _active = active
+    return active
+
+
+def call(operation, context, func, args = (), **details):
+    """
+    Call `func` with `args` to run the lock `operation` on `context`,
+    telling the active observers when it begins and ends. Returns what
+    `func` returns.
+
+      >>> class Observer(object):
+      ...     zope.interface.implements(interfaces.IOperationObserver)
+      ...     counts = True
+      ...     def __init__(self, name, active = True):
+      ...         self.name = name
+      ...         self.isActive = active
+      ...     def active(self):
+      ...         return self.isActive
+      ...     def begin(self, operation, context, details):
+      ...         print "begin", self.name, operation, context, details
+      ...         return operation
+      ...     def end(self, state, error, result):
+      ...         print "end", self.name, state, repr(error), result
+      ...     def count(self, name, value):
+      ...         print "count", self.name, name, value
+
+      >>> first = Observer("first")
+      >>> second = Observer("second", active = False)
+      >>> register(first)
+      >>> register(second)
+
+    The observers that are turned off are skipped. The others are told
+    about the operation, and the last to begin is the first to end.
+
+      >>> call("lock", "file", lambda x: x * 2, (21,), depth = "0")
+      begin first lock file {'depth': '0'}
+      end first lock None 42
+      42
+
+    Turning an observer on or off is only noticed after `refresh`.
+
+      >>> second.isActive = True
+      >>> count(NODES_VISITED, 3)
+      count first nodes_visited 3
+      >>> refresh()
+      >>> count(NODES_VISITED, 3)
+      count first nodes_visited 3
+      count second nodes_visited 3
+      >>> call("unlock", "file", lambda: 1)
+      begin first unlock file {}
+      begin second unlock file {}
+      end second unlock None 1
+      end first unlock None 1
+      1
+
+    They are told about the errors raised by the operation.
+
+      >>> def fail():
+      ...     raise ValueError("failed")
+      >>> try:
+      ...     call("refreshlock", "file", fail)
+      ... except ValueError:
+      ...     print "Failed"
+      begin first refreshlock file {}
+      begin second refreshlock file {}
+      end second refreshlock ValueError('failed',) None
+      end first refreshlock ValueError('failed',) None
+      Failed
+
+    Cleanup.
+
+      >>> unregister(first)
+      >>> unregister(second)
+
+    The default observers are refreshed when they are turned on or off.
+
+      >>> collector = metrics.enable()
+      >>> call("maybeRecursivelyLockIndirectly", "file", lambda: 0)
+      0
+      >>> collector.snapshot()[metrics.INDIRECT_LOCK_SECONDS]['count']
+      1
+      >>> metrics.disable()
+      >>> call("maybeRecursivelyLockIndirectly", "file", lambda: 0)
+      0
+      >>> collector.snapshot()[metrics.INDIRECT_LOCK_SECONDS]['count']
+      1
+
+    """
+    active = _active
+    if active is None:
+        active = _lookup()
+    if not active:
+        return func(*args)
+    states = [(observer, observer.begin(operation, context, details))
+              for observer in active]
+    result = error = None
+    try:
+        result = func(*args)
+        return result
+    except Exception, error:
+        raise
+    finally:
+        for observer, state in reversed(states):
+            observer.end(state, error, result)
+
+
+def count(name, value = 1):
+    counting = _counting
+    if counting is None:
+        _lookup()
+        counting = _counting
+    for observer in counting:
+        observer.count(name, value)
+
+
+class CostsObserver(object):
+    """
+    Records the costs of the operations, see the costs module.
+    """
+    zope.interface.implements(interfaces.IOperationObserver)
+
+    counts = True
+
+    def active(self):
+        return costs.isEnabled()
+
+    def begin(self, operation, context, details):
+        if operation in TIMED_OPERATIONS:
+            return None
+        return costs.begin(operation, context, details.get("depth"))
+
+    def end(self, state, error, result):
+        costs.end(state)
+
+    def count(self, name, value):
+        if name in (NODES_VISITED, TOKENS_REMOVED):
+            costs.visit(value)
+
+
+class TracingObserver(object):
+    """
+    Starts a span for each operation, see the tracing module.
+    """
+    zope.interface.implements(interfaces.IOperationObserver)
+
+    counts = True
+
+    def active(self):
+        return tracing.getTracer() is not None
+
+    def begin(self, operation, context, details):
+        if operation in TIMED_OPERATIONS:
+            return None
+        return operation, tracing.start(operation, **details)
+
+    def end(self, state, error, result):
+        if state is None:
+            return
+        operation, span = state
+        if operation in CLEANUP_OPERATIONS and error is None:
+            tracing.setAttribute(span, "indirect_tokens", result)
+        tracing.end(span, error)
+
+    def count(self, name, value):
+        if name == TOKENS_REGISTERED:
+            tracing.increment("indirect_tokens", value)
+
+
+class MetricsObserver(object):
+    """
+    Times the operations and reports the counts, see the metrics module.
+    """
+    zope.interface.implements(interfaces.IOperationObserver)
+
+    counts = True
+
+    timers = {
+        "lock": metrics.LOCK_SECONDS,
+        "refreshlock": metrics.REFRESHLOCK_SECONDS,
+        "unlock": metrics.UNLOCK_SECONDS,
+        "maybeRecursivelyLockIndirectly": metrics.INDIRECT_LOCK_SECONDS,
+        "moved": metrics.MOVED_SECONDS,
+        "removeEndedTokens": metrics.REMOVEENDEDTOKENS_SECONDS,
+        "removeExpiredTokens": metrics.REMOVEENDEDTOKENS_SECONDS,
+        "lockdiscovery": metrics.LOCKDISCOVERY_SECONDS,
+        }
+
+    counters = {
+        NODES_VISITED: metrics.NODES_VISITED,
+        TOKENS_REGISTERED: metrics.TOKENS_REGISTERED,
+        TOKENS_REMOVED: metrics.TOKENS_REMOVED,
+        MOVED_SHORTCUTS: metrics.MOVED_SHORTCUTS,
+        MOVED_CHECKS: metrics.MOVED_CHECKS,
+        }
+
+    def active(self):
+        return metrics.getCollector() is not None
+
+    def begin(self, operation, context, details):
+        name = self.timers.get(operation, None)
+        if name is None:
+            return None
+        return name, metrics.start()
+
+    def end(self, state, error, result):
+        if state is not None:
+            metrics.stop(*state)
+
+    def count(self, name, value):
+        name = self.counters.get(name, None)
+        if name is not None:
+            metrics.count(name, value)
+
+
+class EventLogObserver(object):
+    """
+    Records the operations in the event log, which is always on.
+    """
+    zope.interface.implements(interfaces.IOperationObserver)
+
+    counts = False
+
+    kinds = {
+        "lock": eventlog.LOCK,
+        "refreshlock": eventlog.REFRESH,
+        "unlock": eventlog.UNLOCK,
+        "removeEndedTokens": eventlog.END,
+        "removeExpiredTokens": eventlog.EXPIRY,
+        }
+
+    def active(self):
+        return True
+
+    def begin(self, operation, context, details):
+        kind = self.kinds.get(operation, None)
+        if kind is None:
+            return None
+        return kind, eventlog.start(), context
+
+    def end(self, state, error, result):
+        if state is None:
+            return
+        kind, began, context = state
+        detail = 0
+        if kind in (eventlog.END, eventlog.EXPIRY) and error is None:
+            # The number of indirect tokens removed.
+            detail = result
+        eventlog.record(kind, began, error, context, detail)
+
+    def count(self, name, value):
+        pass
+
+
+register(CostsObserver())
+register(TracingObserver())
+register(MetricsObserver())
+register(EventLogObserver())
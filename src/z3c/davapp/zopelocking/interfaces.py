@@ -13,6 +13,7 @@
 ##############################################################################
 
 import zope.interface
+import zope.schema
 import zope.locking.interfaces
 
 
@@ -34,3 +35,195 @@ class IIndirectToken(zope.locking.interfaces.IToken,
     roottoken = zope.interface.Attribute("""
     Return the root lock token against which this token is locked.
     """)
+
+
+class ILockLimits(zope.interface.Interface):
+    """
+    Admission limits applied by the lock manager before it takes out a new
+    lock. Register one of these as a utility to enable the limits.
+    """
+
+    maxIndirectTokens = zope.interface.Attribute("""
+    The largest number of indirect tokens a single depth infinity lock may
+    register, or None for no limit.
+    """)
+
+    maxLocksPerPrincipal = zope.interface.Attribute("""
+    The largest number of WebDAV locks a principal may hold at any one time,
+    or None for no limit.
+    """)
+
+    maxReportedConflicts = zope.interface.Attribute("""
+    The largest number of already locked sub-objects reported in response to
+    a depth infinity LOCK request, or None for the default.
+    """)
+
+
+class IDAVLockepoch(zope.interface.Interface):
+    """
+    The `{http://namespaces.zope.org/z3c.davapp}lockepoch` live property.
+    """
+
+    lockepoch = zope.schema.Int(
+        title = u"Lock epoch",
+        description = u"""A number that increases every time a lock at or
+                          below the resource is taken out, refreshed or
+                          removed. Clients polling for lock changes only
+                          need to ask for the `{DAV:}lockdiscovery` property
+                          of a collection when this has changed.""",
+        readonly = True)
+
+
+class IMetricsCollector(zope.interface.Interface):
+    """
+    Collects the counters and timers reported by the lock manager, see the
+    metrics module.
+    """
+
+    def count(name, value):
+        """
+        Add `value` to the counter `name`.
+        """
+
+    def observe(name, seconds):
+        """
+        Record that one run of the operation `name` took `seconds`.
+        """
+
+
+class ISpan(zope.interface.Interface):
+    """
+    A span started by an ITracer.
+    """
+
+    def setAttribute(key, value):
+        """
+        Set the attribute `key` of the span.
+        """
+
+    def end():
+        """
+        The operation described by the span is finished.
+        """
+
+
+class ITracer(zope.interface.Interface):
+    """
+    Starts the tracing spans of the lock operations, see the tracing module.
+    """
+
+    def startSpan(name, parent, attributes):
+        """
+        Start and return an ISpan called `name` with the `attributes`
+        dictionary. `parent` is the span returned by this tracer for the
+        operation this one is part of, or None.
+        """
+
+
+class IOperationObserver(zope.interface.Interface):
+    """
+    Told about the lock operations and their counts, see the
+    instrumentation module.
+    """
+
+    counts = zope.interface.Attribute("""
+    False if the observer ignores the counts, so that it isn't told about
+    them.
+    """)
+
+    def active():
+        """
+        True if the observer records anything, otherwise it isn't told about
+        the operations. This is only asked again after
+        `instrumentation.refresh` is called.
+        """
+
+    def begin(operation, context, details):
+        """
+        The lock `operation` on `context` is starting, with the `details`
+        dictionary. Returns the value passed to `end`.
+        """
+
+    def end(state, error, result):
+        """
+        The operation is finished. `state` is the value returned by `begin`,
+        `error` the exception raised by the operation if any, and `result`
+        what it returned.
+        """
+
+    def count(name, value):
+        """
+        `value` more of the things counted as `name` have been done.
+        """
+
+
+class ILockStore(zope.interface.Interface):
+    """
+    Keeps the WebDAV locks outside of the ZODB. Locks are identified by the
+    path of the locked resource. Register one of these as a utility and
+    include `lockstore.zcml` instead of this package's `configure.zcml` in
+    order to use it.
+
+    All the locks are returned as `lockstore.StoredLock` objects, and
+    expired locks are never returned.
+    """
+
+    def begin():
+        """
+        Called before the lock manager looks for conflicting locks and
+        changes the store. All the changes made after this are committed or
+        aborted with the current transaction, and no other transaction can
+        change the store until then.
+        """
+
+    def getLocks(path):
+        """
+        Return the locks on the resource at `path`, both the locks whose
+        root is `path` and the depth infinity locks taken out on one of its
+        parents.
+        """
+
+    def getLockedPaths(path):
+        """
+        Iterate over (path, lock) pairs for all the locked resources below
+        `path`, ordered by path.
+        """
+
+    def countLocks(principal_id):
+        """
+        Return the number of locks held by `principal_id`.
+        """
+
+    def addLock(lock, paths):
+        """
+        Add the new `lock` together with the indirect entries that lock the
+        resources at `paths` against it.
+        """
+
+    def addIndirect(locktoken, paths):
+        """
+        Lock the resources at `paths` against the existing lock `locktoken`.
+        """
+
+    def refreshLock(locktoken, expires):
+        """
+        Change the time at which the lock `locktoken` expires.
+        """
+
+    def removeLock(locktoken):
+        """
+        Remove the lock `locktoken` and all of its indirect entries.
+        """
+
+    def movePath(oldpath, newpath, keep = ()):
+        """
+        The resource at `oldpath` has moved to `newpath`. The locks at or
+        below `oldpath` move with it. Indirect entries for locks taken out
+        above `oldpath` are removed, unless their locktoken is in `keep`.
+        """
+
+    def removePath(path):
+        """
+        The resource at `path` has been removed. Remove all the locks and
+        indirect entries at or below `path`.
+        """
@@ -0,0 +1,298 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Admission limits for new WebDAV locks.
+
+A client can send a depth infinity LOCK request for a collection containing
+millions of resources. When an ILockLimits utility is registered the lock
+manager refuses these requests, with a 403 Forbidden response, before it
+registers a single token. It uses the subtree sizes cached on the containers
+to do so.
+"""
+
+import persistent
+import zope.component
+import zope.interface
+import zope.annotation.interfaces
+import zope.container.interfaces
+import zope.locking.interfaces
+
+import interfaces
+import counters
+
+# The event handler stops counting a moved subtree after this many objects.
+MAX_MOVED_COUNT = 1000
+
+class LockLimits(persistent.Persistent):
+    """
+    Persistent implementation of ILockLimits so that the limits can be
+    managed as a local utility.
+
+      >>> import datetime
+      >>> from zope.interface.verify import verifyObject
+      >>> from zope.locking import utility
+      >>> from zope.locking.adapters import TokenBroker
+      >>> from zope.annotation.interfaces import IAttributeAnnotatable
+      >>> from zope.annotation.attribute import AttributeAnnotations
+      >>> from zope.container.contained import ObjectAddedEvent
+      >>> from manager import DAVLockmanager
+
+      >>> limits = LockLimits(maxIndirectTokens = 3)
+      >>> verifyObject(interfaces.ILockLimits, limits)
+      True
+
+      >>> util = utility.TokenUtility()
+      >>> conn.add(util) # add to persistent database
+      >>> gsm = zope.component.getGlobalSiteManager()
+      >>> gsm.registerUtility(util, zope.locking.interfaces.ITokenUtility)
+      >>> gsm.registerUtility(limits, interfaces.ILockLimits)
+      >>> gsm.registerAdapter(TokenBroker, (zope.interface.Interface,),
+      ...    zope.locking.interfaces.ITokenBroker)
+      >>> gsm.registerAdapter(AttributeAnnotations)
+
+      >>> class Folder(DemoFolder):
+      ...     zope.interface.implements(IAttributeAnnotatable)
+
+      >>> folder = Folder()
+      >>> folder['sub'] = Folder()
+      >>> folder['sub']['file'] = Demo()
+      >>> folder['file'] = Demo()
+
+    Subtree sizes
+    -------------
+
+    The size of a subtree is only cached once it has been counted for the
+    token utility, and only if it is big enough to be worth caching.
+
+      >>> oldMinCachedSize = counters.MIN_CACHED_SIZE
+      >>> counters.MIN_CACHED_SIZE = 2
+      >>> counters.subtreeSize(folder) is None
+      True
+      >>> counters.countDescendants(folder)
+      3
+      >>> counters.subtreeSize(folder) is None
+      True
+      >>> counters.subtreeSizesCached(util)
+      False
+      >>> counters.countDescendants(folder, utility = util)
+      3
+      >>> counters.subtreeSize(folder)
+      3
+      >>> counters.subtreeSize(folder['sub']) is None
+      True
+
+    The utility remembers that sizes have been cached. Until then the event
+    handler doesn't look at the parents of the objects moved about.
+
+      >>> counters.subtreeSizesCached(util)
+      True
+
+    After that the event handler keeps it up to date, whether or not limits
+    are in use.
+
+      >>> gsm.unregisterUtility(limits, interfaces.ILockLimits)
+      True
+      >>> folder['sub']['file2'] = Demo()
+      >>> updateSubtreeSizeOnMovedEvent(
+      ...    ObjectAddedEvent(folder['sub']['file2'], folder['sub'], 'file2'))
+      >>> counters.subtreeSize(folder)
+      4
+      >>> gsm.registerUtility(limits, interfaces.ILockLimits)
+
+    The event handler doesn't count big subtrees, it throws away the sizes
+    above them instead.
+
+      >>> from z3c.davapp.zopelocking import limits as limitsmodule
+      >>> limitsmodule.MAX_MOVED_COUNT = 2
+      >>> added = Folder()
+      >>> for i in range(3):
+      ...     added['file%d' % i] = Demo()
+      >>> folder['sub']['added'] = added
+      >>> updateSubtreeSizeOnMovedEvent(
+      ...    ObjectAddedEvent(added, folder['sub'], 'added'))
+      >>> counters.subtreeSize(folder) is None
+      True
+      >>> limitsmodule.MAX_MOVED_COUNT = MAX_MOVED_COUNT
+      >>> del folder['sub']['added']
+
+    Depth infinity locks
+    --------------------
+
+    Locking the folder would register 4 indirect tokens, one more than we
+    allow, so the lock manager refuses before locking anything.
+
+      >>> DAVLockmanager(folder).lock(u'exclusive', u'write', u'Michael',
+      ...    datetime.timedelta(seconds = 3600), 'infinity')
+      Traceback (most recent call last):
+      ...
+      ForbiddenError: Too many resources would be locked
+      >>> util.get(folder) is None
+      True
+      >>> util.get(folder['file']) is None
+      True
+
+    The sub folder is small enough.
+
+      >>> locktoken = DAVLockmanager(folder['sub']).lock(u'exclusive',
+      ...    u'write', u'Michael', datetime.timedelta(seconds = 3600),
+      ...    'infinity')
+      >>> util.get(folder['sub']['file']) is not None
+      True
+
+    When counting a subtree that hasn't been cached we stop as soon as we
+    know that it is too big.
+
+      >>> big = Folder()
+      >>> for i in range(10):
+      ...     big['file%d' % i] = Demo()
+      >>> counters.countDescendants(big, 3, util)
+      4
+      >>> counters.subtreeSize(big) is None
+      True
+
+    The number counted is cached as a lower bound of the size, so that we
+    don't count again to refuse the next lock. It is thrown away as soon as
+    objects are taken away.
+
+      >>> from zope.annotation.interfaces import IAnnotations
+      >>> IAnnotations(big)[counters.SUBTREE_MIN_SIZE_KEY]
+      4
+      >>> counters.countDescendants(big, 3, util)
+      4
+      >>> from zope.container.contained import ObjectRemovedEvent
+      >>> removed = big['file0']
+      >>> del big['file0']
+      >>> updateSubtreeSizeOnMovedEvent(
+      ...    ObjectRemovedEvent(removed, big, 'file0'))
+      >>> counters.SUBTREE_MIN_SIZE_KEY in IAnnotations(big)
+      False
+
+    Counting it completely replaces the lower bound with the size.
+
+      >>> counters.countDescendants(big, 3, util)
+      4
+      >>> counters.countDescendants(big, utility = util)
+      9
+      >>> counters.subtreeSize(big)
+      9
+      >>> counters.SUBTREE_MIN_SIZE_KEY in IAnnotations(big)
+      False
+
+    Per principal quotas
+    --------------------
+
+    The lock manager keeps a count of the WebDAV locks held by each
+    principal.
+
+      >>> counters.principalLockCount(util, 'michael')
+      1
+
+      >>> limits.maxLocksPerPrincipal = 1
+      >>> DAVLockmanager(folder['file']).lock(u'shared', u'write',
+      ...    u'Michael', datetime.timedelta(seconds = 3600), '0')
+      Traceback (most recent call last):
+      ...
+      ForbiddenError: Too many locks are held by this principal
+
+      >>> DAVLockmanager(folder['sub']).unlock(locktoken)
+      >>> counters.principalLockCount(util, 'michael')
+      0
+      >>> locktoken = DAVLockmanager(folder['file']).lock(u'shared',
+      ...    u'write', u'Michael', datetime.timedelta(seconds = 3600), '0')
+      >>> counters.principalLockCount(util, 'michael')
+      1
+      >>> DAVLockmanager(folder['file']).unlock(locktoken)
+      >>> counters.principalLockCount(util, 'michael')
+      0
+
+    Cleanup.
+
+      >>> gsm.unregisterUtility(util, zope.locking.interfaces.ITokenUtility)
+      True
+      >>> gsm.unregisterUtility(limits, interfaces.ILockLimits)
+      True
+      >>> gsm.unregisterAdapter(TokenBroker, (zope.interface.Interface,),
+      ...    zope.locking.interfaces.ITokenBroker)
+      True
+      >>> gsm.unregisterAdapter(AttributeAnnotations)
+      True
+      >>> counters.MIN_CACHED_SIZE = oldMinCachedSize
+
+    """
+    zope.interface.implements(interfaces.ILockLimits)
+
+    maxReportedConflicts = None
+
+    def __init__(self, maxIndirectTokens = None, maxLocksPerPrincipal = None,
+                 maxReportedConflicts = None):
+        self.maxIndirectTokens = maxIndirectTokens
+        self.maxLocksPerPrincipal = maxLocksPerPrincipal
+        self.maxReportedConflicts = maxReportedConflicts
+
+
+@zope.component.adapter(zope.container.interfaces.IObjectMovedEvent)
+def updateSubtreeSizeOnMovedEvent(event):
+    """
+    Keep the subtree sizes cached on the old and new parents of the object
+    up to date. This is done whether or not limits are in use, so that the
+    sizes are still right when limits are turned on again. When the object
+    is too big to count here the sizes above it are thrown away instead.
+    """
+    if event.oldParent is event.newParent:
+        return
+
+    parent = event.newParent
+    if parent is None:
+        parent = event.oldParent
+    utility = zope.component.queryUtility(
+        zope.locking.interfaces.ITokenUtility, context = parent,
+        default = None)
+    if utility is None or not counters.subtreeSizesCached(utility):
+        # No size has ever been cached so there is nothing to keep up to
+        # date, and we don't need to look at the parents.
+        return
+
+    oldsizes = _cachedSizes(event.oldParent)
+    newsizes = _cachedSizes(event.newParent)
+    if not oldsizes and not newsizes:
+        return
+
+    size = counters.countDescendants(event.object, MAX_MOVED_COUNT, utility)
+    if size > MAX_MOVED_COUNT:
+        counters.forgetSubtreeSize(event.oldParent)
+        counters.forgetSubtreeSize(event.newParent)
+        return
+    size += 1
+    for annotations in oldsizes:
+        if counters.SUBTREE_SIZE_KEY in annotations:
+            annotations[counters.SUBTREE_SIZE_KEY].change(-size)
+        else:
+            # A lower bound is no longer one once objects are taken away.
+            del annotations[counters.SUBTREE_MIN_SIZE_KEY]
+    for annotations in newsizes:
+        if counters.SUBTREE_SIZE_KEY in annotations:
+            annotations[counters.SUBTREE_SIZE_KEY].change(size)
+
+
+def _cachedSizes(ob):
+    # The annotations of `ob` and its parents holding a cached size.
+    found = []
+    while ob is not None:
+        annotations = zope.annotation.interfaces.IAnnotations(ob, None)
+        if annotations is not None and \
+               (counters.SUBTREE_SIZE_KEY in annotations or
+                counters.SUBTREE_MIN_SIZE_KEY in annotations):
+            found.append(annotations)
+        ob = getattr(ob, "__parent__", None)
+    return found
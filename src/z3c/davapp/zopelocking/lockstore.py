@@ -0,0 +1,701 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+WebDAV locking using an ILockStore utility instead of zope.locking tokens.
+
+WebDAV locks are short lived and change often. Storing them in the ZODB
+next to the content makes the database grow and lets the lock requests
+conflict with the content changes. The lock manager, `{DAV:}lockdiscovery`
+property and event handler in this module keep the locks in an ILockStore
+instead, see `sqlitestore.SQLiteLockStore`. Include `lockstore.zcml`
+instead of `configure.zcml` to use them.
+
+Locks are identified by the path of the locked resource, so the event
+handler keeps the store up to date as content moves about.
+"""
+
+import time
+
+import zope.component
+import zope.interface
+import zope.security.management
+import zope.publisher.interfaces.http
+import zope.annotation.interfaces
+import zope.container.interfaces
+import zope.traversing.api
+from zope.traversing.browser.absoluteurl import absoluteURL
+import z3c.dav.interfaces
+import z3c.dav.coreproperties
+import z3c.dav.locking
+import z3c.dav.ifvalidator
+
+import interfaces
+import counters
+import properties
+import manager
+
+class StoredLock(object):
+    """
+    A WebDAV lock kept in an ILockStore. `expires` is the time in seconds
+    since the epoch at which the lock expires, or None.
+    """
+
+    def __init__(self, locktoken, path, scope, depth, owner, principal_id,
+                 expires):
+        self.locktoken = locktoken
+        self.path = path
+        self.scope = scope
+        self.depth = depth
+        self.owner = owner
+        self.principal_id = principal_id
+        self.expires = expires
+
+    @property
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(0, int(self.expires - time.time()))
+
+
+def expiresAt(duration):
+    if duration is None:
+        return None
+    return time.time() + duration.days * 86400 + duration.seconds
+
+
+def getPath(ob):
+    return unicode(zope.traversing.api.getPath(ob))
+
+
+def joinPath(path, name):
+    if path.endswith(u"/"):
+        return path + name
+    return path + u"/" + name
+
+
+def parentPath(path):
+    return path.rsplit(u"/", 1)[0] or u"/"
+
+
+def iterPaths(ob, path):
+    """
+    The paths of all the objects below `ob`, found at `path`.
+    """
+    if zope.container.interfaces.IReadContainer.providedBy(ob):
+        for name, subob in ob.items():
+            subpath = joinPath(path, name)
+            yield subpath
+            for found in iterPaths(subob, subpath):
+                yield found
+
+
+def traversePath(ob, path, subpath):
+    for name in subpath[len(path):].split(u"/"):
+        if name:
+            ob = ob[name]
+    return ob
+
+
+def matchesIfHeader(request, path, locks):
+    """
+    Does the `IF` header of `request` hold the token of one of the `locks`
+    on `path`? The same as `z3c.dav.ifvalidator.matchesIfHeader` except
+    that we are told the locks and the path, which may be the old location
+    of an object that has already been moved.
+    """
+    if not locks:
+        return True
+    reqannot = zope.annotation.interfaces.IAnnotations(request)
+    stateresults = reqannot.get(z3c.dav.ifvalidator.STATE_ANNOTS, {})
+    parsedstates = stateresults.get(path, {})
+    while not parsedstates and path != u"/":
+        # The locks may have been taken out on a parent.
+        path = parentPath(path)
+        parsedstates = stateresults.get(path, {})
+    for lock in locks:
+        if lock.locktoken in parsedstates:
+            return True
+    return False
+
+
+class LockStoreLockmanager(object):
+    """
+    Implementation of IDAVLockmanager using an ILockStore.
+
+      >>> import datetime
+      >>> import transaction
+      >>> from zope.interface.verify import verifyObject
+      >>> from zope.site.folder import rootFolder, Folder
+      >>> from zope.location.traversing import LocationPhysicallyLocatable
+      >>> from zope.location.interfaces import ILocation
+      >>> from zope.traversing.interfaces import IPhysicallyLocatable
+      >>> from zope.traversing.browser.interfaces import IAbsoluteURL
+      >>> from z3c.dav.publisher import WebDAVRequest
+      >>> from cStringIO import StringIO
+      >>> from sqlitestore import SQLiteLockStore
+
+      >>> class PathURL(object):
+      ...     zope.interface.implements(IAbsoluteURL)
+      ...     def __init__(self, context, request):
+      ...         self.context = context
+      ...     def __str__(self):
+      ...         return 'http://localhost' + str(getPath(self.context))
+      ...     __call__ = __str__
+
+      >>> gsm = zope.component.getGlobalSiteManager()
+      >>> gsm.registerAdapter(LocationPhysicallyLocatable,
+      ...    (ILocation,), IPhysicallyLocatable)
+      >>> gsm.registerAdapter(PathURL,
+      ...    (ILocation, zope.interface.Interface), IAbsoluteURL)
+
+      >>> root = rootFolder()
+      >>> root['folder'] = Folder()
+      >>> root['folder']['sub'] = Folder()
+      >>> root['folder']['sub']['file'] = Folder()
+      >>> root['file'] = Folder()
+      >>> folder = root['folder']
+
+    Nothing can be locked until an ILockStore is registered.
+
+      >>> LockStoreLockmanager(folder).islockable()
+      False
+      >>> store = SQLiteLockStore(':memory:')
+      >>> gsm.registerUtility(store, interfaces.ILockStore)
+
+      >>> adapter = LockStoreLockmanager(folder)
+      >>> verifyObject(z3c.dav.interfaces.IDAVLockmanager, adapter)
+      True
+      >>> adapter.islockable()
+      True
+      >>> adapter.islocked()
+      False
+
+    Exclusive locks
+    ---------------
+
+      >>> locktoken = adapter.lock(u'exclusive', u'write', u'Michael',
+      ...    datetime.timedelta(seconds = 3600), 'infinity')
+      >>> adapter.islocked()
+      True
+
+    The lock is kept in the store and not in the ZODB.
+
+      >>> [lock.locktoken == locktoken for lock in store.getLocks(u'/folder')]
+      [True]
+      >>> [path for path, lock in store.getLockedPaths(u'/folder')]
+      [u'/folder/sub', u'/folder/sub/file']
+
+      >>> activelock = LockStoreLockmanager(folder['sub']).getActivelock(
+      ...    locktoken)
+      >>> activelock.lockscope
+      [u'exclusive']
+      >>> activelock.locktype
+      [u'write']
+      >>> activelock.depth
+      u'infinity'
+      >>> activelock.owner
+      u'Michael'
+      >>> activelock.timeout in (u'Second-3599', u'Second-3600')
+      True
+      >>> activelock.locktoken == [locktoken]
+      True
+      >>> activelock.lockroot
+      'http://localhost/folder'
+
+    The `{DAV:}lockdiscovery` property, and so the `IF` header validation,
+    find the lock in the store.
+
+      >>> request = WebDAVRequest(StringIO(''), {})
+      >>> lockdiscovery = LockStoreLockdiscovery(
+      ...    folder['sub']['file'], request).lockdiscovery
+      >>> [activelock.locktoken == [locktoken]
+      ...  for activelock in lockdiscovery]
+      [True]
+      >>> LockStoreLockdiscovery(root['file'], request).lockdiscovery is None
+      True
+
+    The same resource can't be locked twice, nor can the parent of a locked
+    resource be locked with a depth infinity lock.
+
+      >>> LockStoreLockmanager(folder['sub']).lock(u'shared', u'write',
+      ...    u'Michael', datetime.timedelta(seconds = 3600),
+      ...    '0') #doctest:+ELLIPSIS
+      Traceback (most recent call last):
+      ...
+      AlreadyLocked...
+      >>> try:
+      ...     LockStoreLockmanager(root).lock(u'shared', u'write', u'Michael',
+      ...        datetime.timedelta(seconds = 3600), 'infinity')
+      ... except z3c.dav.interfaces.WebDAVErrors, errors:
+      ...     pass
+      >>> [getPath(error.resource) for error in errors]
+      [u'/folder', u'/folder/sub', u'/folder/sub/file']
+
+    Refreshing the lock changes its timeout.
+
+      >>> adapter.refreshlock(datetime.timedelta(seconds = 60))
+      >>> adapter.getActivelock(locktoken).timeout in (
+      ...    u'Second-59', u'Second-60')
+      True
+
+      >>> adapter.unlock(locktoken)
+      >>> adapter.islocked()
+      False
+      >>> LockStoreLockmanager(folder['sub']).islocked()
+      False
+      >>> adapter.unlock(locktoken)
+      Traceback (most recent call last):
+      ...
+      ConflictError: The context is not locked, so we can't unlock it.
+
+    Shared locks
+    ------------
+
+    Each shared lock has its own locktoken.
+
+      >>> locktoken = adapter.lock(u'shared', u'write', u'Michael',
+      ...    datetime.timedelta(seconds = 3600), '0')
+      >>> locktoken2 = adapter.lock(u'shared', u'write', u'Michael 2',
+      ...    datetime.timedelta(seconds = 3600), '0')
+      >>> sorted([activelock.owner for activelock in
+      ...         LockStoreLockdiscovery(folder, request).lockdiscovery])
+      [u'Michael', u'Michael 2']
+      >>> adapter.lock(u'exclusive', u'write', u'Michael',
+      ...    datetime.timedelta(seconds = 3600), '0') #doctest:+ELLIPSIS
+      Traceback (most recent call last):
+      ...
+      AlreadyLocked...
+
+      >>> adapter.unlock(locktoken)
+      >>> [activelock.owner for activelock in
+      ...  LockStoreLockdiscovery(folder, request).lockdiscovery]
+      [u'Michael 2']
+      >>> adapter.unlock(locktoken2)
+
+      >>> adapter.lock(u'notexclusive', u'write', u'Michael',
+      ...    datetime.timedelta(seconds = 100), 'infinity') #doctest:+ELLIPSIS
+      Traceback (most recent call last):
+      ...
+      UnprocessableError: ...
+
+    Transactions
+    ------------
+
+    The changes to the store are committed and aborted with the ZODB
+    transaction.
+
+      >>> locktoken = adapter.lock(u'exclusive', u'write', u'Michael',
+      ...    datetime.timedelta(seconds = 3600), '0')
+      >>> transaction.abort()
+      >>> adapter.islocked()
+      False
+
+      >>> locktoken = adapter.lock(u'exclusive', u'write', u'Michael',
+      ...    datetime.timedelta(seconds = 3600), 'infinity')
+      >>> transaction.commit()
+      >>> adapter.islocked()
+      True
+
+    Moving content
+    --------------
+
+    The event handler keeps the store up to date as the content moves,
+    and checks that the client knows about the locks on the content it
+    changes.
+
+      >>> import UserDict
+      >>> from zope.container.contained import ObjectAddedEvent, \\
+      ...    ObjectMovedEvent, ObjectRemovedEvent
+
+      >>> class ReqAnnotation(UserDict.IterableUserDict):
+      ...    zope.interface.implements(zope.annotation.interfaces.IAnnotations)
+      ...    def __init__(self, request):
+      ...        self.data = request._environ.setdefault('annotation', {})
+      >>> gsm.registerAdapter(
+      ...    ReqAnnotation, (zope.publisher.interfaces.http.IHTTPRequest,))
+      >>> participation = \\
+      ...    zope.security.management.getInteraction().participations[0]
+
+    Adding content to the locked folder needs the locktoken.
+
+      >>> folder['new'] = Folder()
+      >>> updateLockStoreOnMovedEvent(
+      ...    ObjectAddedEvent(folder['new'], folder, 'new')) #doctest:+ELLIPSIS
+      Traceback (most recent call last):
+      ...
+      AlreadyLocked...
+
+      >>> ReqAnnotation(participation)[z3c.dav.ifvalidator.STATE_ANNOTS] = {
+      ...    u'/folder': {locktoken: False}}
+      >>> updateLockStoreOnMovedEvent(
+      ...    ObjectAddedEvent(folder['new'], folder, 'new'))
+      >>> LockStoreLockmanager(folder['new']).islocked()
+      True
+
+    An object moved out of the locked folder loses its lock.
+
+      >>> root['moved'] = folder['sub']
+      >>> del folder['sub']
+      >>> updateLockStoreOnMovedEvent(ObjectMovedEvent(
+      ...    root['moved'], folder, 'sub', root, 'moved'))
+      >>> LockStoreLockmanager(root['moved']).islocked()
+      False
+      >>> LockStoreLockmanager(root['moved']['file']).islocked()
+      False
+
+    And gets a lock when it is moved into it.
+
+      >>> folder['back'] = root['moved']
+      >>> del root['moved']
+      >>> updateLockStoreOnMovedEvent(ObjectMovedEvent(
+      ...    folder['back'], root, 'moved', folder, 'back'))
+      >>> LockStoreLockmanager(folder['back']['file']).islocked()
+      True
+
+    Locks taken out below a moved object move with it.
+
+      >>> filelock = LockStoreLockmanager(root['file']).lock(
+      ...    u'exclusive', u'write', u'Michael',
+      ...    datetime.timedelta(seconds = 3600), '0')
+      >>> ReqAnnotation(participation)[
+      ...    z3c.dav.ifvalidator.STATE_ANNOTS][u'/file'] = {filelock: False}
+      >>> root['renamed'] = root['file']
+      >>> del root['file']
+      >>> updateLockStoreOnMovedEvent(ObjectMovedEvent(
+      ...    root['renamed'], root, 'file', root, 'renamed'))
+      >>> [lock.locktoken == filelock
+      ...  for lock in store.getLocks(u'/renamed')]
+      [True]
+
+    Removing an object removes its locks.
+
+      >>> ReqAnnotation(participation)[
+      ...    z3c.dav.ifvalidator.STATE_ANNOTS][u'/renamed'] = {filelock: False}
+      >>> removed = root['renamed']
+      >>> del root['renamed']
+      >>> updateLockStoreOnMovedEvent(
+      ...    ObjectRemovedEvent(removed, root, 'renamed'))
+      >>> store.getLocks(u'/renamed')
+      []
+
+    Cleanup
+    -------
+
+      >>> transaction.abort()
+      >>> store.close()
+      >>> gsm.unregisterUtility(store, interfaces.ILockStore)
+      True
+      >>> gsm.unregisterAdapter(LocationPhysicallyLocatable,
+      ...    (ILocation,), IPhysicallyLocatable)
+      True
+      >>> gsm.unregisterAdapter(PathURL,
+      ...    (ILocation, zope.interface.Interface), IAbsoluteURL)
+      True
+      >>> gsm.unregisterAdapter(
+      ...    ReqAnnotation, (zope.publisher.interfaces.http.IHTTPRequest,))
+      True
+
+    """
+    zope.interface.implements(z3c.dav.interfaces.IDAVLockmanager)
+    zope.component.adapts(zope.interface.Interface)
+
+    def __init__(self, context):
+        self.context = self.__parent__ = context
+
+    def _store(self):
+        return zope.component.queryUtility(
+            interfaces.ILockStore, context = self.context, default = None)
+
+    def islockable(self):
+        return self._store() is not None
+
+    def checkLimits(self, store, principal_id, depth):
+        limits = zope.component.queryUtility(
+            interfaces.ILockLimits, context = self.context, default = None)
+        if limits is None:
+            return
+
+        maxLocks = limits.maxLocksPerPrincipal
+        if maxLocks is not None and store.countLocks(principal_id) >= maxLocks:
+            raise z3c.dav.interfaces.ForbiddenError(
+                self.context,
+                message = u"Too many locks are held by this principal")
+
+        maxTokens = limits.maxIndirectTokens
+        if maxTokens is not None and depth == "infinity" and \
+               zope.container.interfaces.IReadContainer.providedBy(
+                   self.context) and \
+               counters.countDescendants(self.context, maxTokens) > maxTokens:
+            raise z3c.dav.interfaces.ForbiddenError(
+                self.context, message = u"Too many resources would be locked")
+
+    def maxReportedConflicts(self):
+        limits = zope.component.queryUtility(
+            interfaces.ILockLimits, context = self.context, default = None)
+        maxConflicts = getattr(limits, "maxReportedConflicts", None)
+        if maxConflicts is None:
+            return manager.MAX_REPORTED_CONFLICTS
+        return maxConflicts
+
+    def lock(self, scope, type, owner, duration, depth):
+        if scope not in (u"exclusive", u"shared"):
+            raise z3c.dav.interfaces.UnprocessableError(
+                self.context,
+                message = u"Invalid lockscope supplied to the lock manager")
+
+        principal_id = manager.getPrincipalId()
+        store = zope.component.getUtility(
+            interfaces.ILockStore, context = self.context)
+        path = getPath(self.context)
+
+        store.begin()
+        self.checkLimits(store, principal_id, depth)
+
+        for lock in store.getLocks(path):
+            if scope == u"exclusive" or lock.scope == u"exclusive":
+                raise z3c.dav.interfaces.AlreadyLocked(
+                    self.context,
+                    message = u"A conflicting lock already exists for this resource")
+
+        paths = []
+        if depth == "infinity" and \
+               zope.container.interfaces.IReadContainer.providedBy(
+                   self.context):
+            conflicts = []
+            maxConflicts = self.maxReportedConflicts()
+            for subpath, lock in store.getLockedPaths(path):
+                if scope == u"shared" and lock.scope == u"shared":
+                    continue
+                try:
+                    subob = traversePath(self.context, path, subpath)
+                except KeyError:
+                    # Left behind by content that has gone.
+                    continue
+                if conflicts and conflicts[-1].resource is subob:
+                    continue
+                conflicts.append(z3c.dav.interfaces.AlreadyLocked(
+                    subob, message = u"Sub-object is already locked"))
+                if len(conflicts) >= maxConflicts:
+                    break
+            if conflicts:
+                raise z3c.dav.interfaces.WebDAVErrors(self.context, conflicts)
+            paths = iterPaths(self.context, path)
+
+        locktoken = z3c.dav.locking.generateLocktoken()
+        store.addLock(StoredLock(locktoken, path, scope, depth, owner,
+                                 principal_id, expiresAt(duration)), paths)
+
+        return locktoken
+
+    def getActivelock(self, locktoken, request = None):
+        # Note that this is only used for testing purposes.
+        for lock in self._store().getLocks(getPath(self.context)):
+            if lock.locktoken == locktoken:
+                return StoredActiveLock(lock, self.context, request)
+        return None
+
+    def refreshlock(self, timeout):
+        store = zope.component.getUtility(
+            interfaces.ILockStore, context = self.context)
+        store.begin()
+        for lock in store.getLocks(getPath(self.context)):
+            store.refreshLock(lock.locktoken, expiresAt(timeout))
+
+    def unlock(self, locktoken):
+        store = zope.component.getUtility(
+            interfaces.ILockStore, context = self.context)
+        store.begin()
+        locks = store.getLocks(getPath(self.context))
+        if not locks:
+            raise z3c.dav.interfaces.ConflictError(
+                self.context,
+                message = "The context is not locked, so we can't unlock it.")
+        for lock in locks:
+            if lock.locktoken == locktoken:
+                store.removeLock(locktoken)
+                return
+        raise z3c.dav.interfaces.ConflictError(
+            self.context,
+            message = "The lock token doesn't apply to this resource.")
+
+    def islocked(self):
+        store = self._store()
+        if store is None:
+            return False
+        return bool(store.getLocks(getPath(self.context)))
+
+
+class StoredActiveLock(object):
+    """
+    The `{DAV:}activelock` XML element for a lock kept in an ILockStore.
+    """
+    zope.interface.implements(z3c.dav.coreproperties.IActiveLock)
+
+    def __init__(self, lock, context, request):
+        self.context = self.__parent__ = context
+        self.lock = lock
+        self.request = request
+
+    @property
+    def lockscope(self):
+        return [self.lock.scope]
+
+    @property
+    def locktype(self):
+        return [u"write"]
+
+    @property
+    def depth(self):
+        return self.lock.depth
+
+    @property
+    def owner(self):
+        return self.lock.owner
+
+    @property
+    def timeout(self):
+        remaining = self.lock.remaining
+        if remaining is None:
+            return None
+        return u"Second-%d" % remaining
+
+    @property
+    def locktoken(self):
+        return [self.lock.locktoken]
+
+    @property
+    def lockroot(self):
+        # The root of an indirect lock is one of the parents of the context.
+        root = self.context
+        path = getPath(root)
+        while path != self.lock.path and \
+                  getattr(root, "__parent__", None) is not None:
+            root = root.__parent__
+            path = parentPath(path)
+        return absoluteURL(root, self.request)
+
+
+@zope.component.adapter(
+    zope.interface.Interface, z3c.dav.interfaces.IWebDAVRequest)
+@zope.interface.implementer(z3c.dav.coreproperties.IDAVSupportedlock)
+def LockStoreSupportedlock(context, request):
+    store = zope.component.queryUtility(
+        interfaces.ILockStore, context = context, default = None)
+    if store is None:
+        return None
+    return properties.DAVSupportedlockAdapter()
+
+
+@zope.component.adapter(
+    zope.interface.Interface, zope.publisher.interfaces.http.IHTTPRequest)
+@zope.interface.implementer(z3c.dav.coreproperties.IDAVLockdiscovery)
+def LockStoreLockdiscovery(context, request):
+    store = zope.component.queryUtility(
+        interfaces.ILockStore, context = context, default = None)
+    if store is None:
+        return None
+    return LockStoreLockdiscoveryAdapter(context, request, store)
+
+
+class LockStoreLockdiscoveryAdapter(object):
+    zope.interface.implements(z3c.dav.coreproperties.IDAVLockdiscovery)
+
+    def __init__(self, context, request, store):
+        self.context = context
+        self.request = request
+        self.store = store
+
+    @property
+    def lockdiscovery(self):
+        locks = self.store.getLocks(getPath(self.context))
+        if not locks:
+            return None
+        return [StoredActiveLock(lock, self.context, self.request)
+                for lock in locks]
+
+
+@zope.component.adapter(zope.container.interfaces.IObjectMovedEvent)
+def updateLockStoreOnMovedEvent(event):
+    """
+    Move the locks in the store along with the content and validate the
+    change against the WebDAV locks, see
+    `manager.indirectlyLockObjectOnMovedEvent`.
+    """
+    store = zope.component.queryUtility(
+        interfaces.ILockStore, context = event.object)
+    if store is None:
+        return
+
+    oldpath = newpath = None
+    if event.oldParent is not None:
+        oldpath = joinPath(getPath(event.oldParent), event.oldName)
+    if event.newParent is not None:
+        parentpath = getPath(event.newParent)
+        newpath = joinPath(parentpath, event.newName)
+    if oldpath == newpath:
+        return
+
+    objectlocks = oldpath is not None and store.getLocks(oldpath) or []
+    parentlocks = newpath is not None and store.getLocks(parentpath) or []
+    lockedbelow = False
+
+    # This is an hack to get at the current request object
+    interaction = zope.security.management.queryInteraction()
+    if interaction:
+        request = interaction.participations[0]
+        if zope.publisher.interfaces.http.IHTTPRequest.providedBy(request) \
+               and request.method not in manager.BROWSER_METHODS:
+            if oldpath is not None:
+                if not matchesIfHeader(request, oldpath, objectlocks):
+                    raise z3c.dav.interfaces.AlreadyLocked(
+                        event.object, "Locked object cannot be moved ")
+                validated = set([lock.locktoken for lock in objectlocks])
+                for subpath, lock in store.getLockedPaths(oldpath):
+                    lockedbelow = True
+                    if lock.locktoken not in validated and \
+                           not matchesIfHeader(request, subpath, [lock]):
+                        raise z3c.dav.interfaces.AlreadyLocked(
+                            event.object, "Locked object cannot be moved")
+            if newpath is not None and \
+                   not matchesIfHeader(request, parentpath, parentlocks):
+                raise z3c.dav.interfaces.AlreadyLocked(
+                    event.object, "Destination folder is locked")
+
+    held = set([lock.locktoken for lock in objectlocks])
+    inherited = [lock for lock in parentlocks if lock.depth == "infinity"]
+    new = [lock for lock in inherited if lock.locktoken not in held]
+    if newpath is not None and new and objectlocks:
+        # XXX - the same as the zope.locking lock manager we don't merge
+        # the locks.
+        raise z3c.dav.interfaces.AlreadyLocked(
+            event.object, "Locked object cannot be moved.")
+
+    if oldpath is not None and not objectlocks and not lockedbelow:
+        for found in store.getLockedPaths(oldpath):
+            lockedbelow = True
+            break
+    if not objectlocks and not lockedbelow and not new:
+        # Nothing to change, so don't hold up the other lock requests.
+        return
+
+    store.begin()
+    if newpath is None:
+        store.removePath(oldpath)
+    elif oldpath is not None:
+        store.movePath(oldpath, newpath,
+                       [lock.locktoken for lock in inherited])
+    if newpath is not None and new:
+        paths = [newpath] + list(iterPaths(event.object, newpath))
+        for lock in new:
+            store.addIndirect(lock.locktoken, paths)
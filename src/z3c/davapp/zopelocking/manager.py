@@ -17,6 +17,7 @@ the zope.locking utiltity to integrate it into z3c.dav.
 """
 
 from BTrees.OOBTree import OOBTree
+import transaction
 import zope.component
 import zope.interface
 import zope.security.management
@@ -30,9 +31,22 @@ import z3c.dav.ifvalidator
 import interfaces
 import indirecttokens
 import properties
+import counters
+import costs
+import cache
+import bloom
+import sweeper
+import scanner
+import principals
+import stats
+import instrumentation
 
 WEBDAV_LOCK_KEY = "z3c.dav.lockingutils.info"
 
+# The default for the largest number of conflicting sub-objects reported in
+# response to a single depth infinity LOCK request.
+MAX_REPORTED_CONFLICTS = 100
+
 class DAVLockmanager(object):
     """
 
@@ -160,11 +174,14 @@ class DAVLockmanager(object):
       >>> sharedlocktoken.annotations[WEBDAV_LOCK_KEY]['principal_ids']
       ['michael']
       >>> len(sharedlocktoken.annotations[WEBDAV_LOCK_KEY][locktoken])
-      2
+      3
       >>> sharedlocktoken.annotations[WEBDAV_LOCK_KEY][locktoken]['owner']
       u'Michael'
       >>> sharedlocktoken.annotations[WEBDAV_LOCK_KEY][locktoken]['depth']
       '0'
+      >>> sharedlocktoken.annotations[WEBDAV_LOCK_KEY][locktoken][
+      ...    'principal_id']
+      'michael'
       >>> sharedlocktoken.duration
       datetime.timedelta(0, 3600)
       >>> sharedlocktoken.principal_ids
@@ -293,10 +310,73 @@ class DAVLockmanager(object):
       >>> locktoken = DAVLockmanager(file).lock(u'shared', u'write',
       ...    u'Michael', datetime.timedelta(seconds = 3600), '0')
       >>> adapter.lock(u'shared', u'write', u'Michael 2',
-      ...    datetime.timedelta(seconds = 3600), 'infinity') #doctest:+ELLIPSIS
+      ...    datetime.timedelta(seconds = 3600), 'infinity')
       Traceback (most recent call last):
       ...
-      AlreadyLocked:...
+      WebDAVErrors
+
+    The lock token on the folder was registered before the conflict was
+    found. Normally it is thrown away when the transaction is aborted.
+
+      >>> util.get(demofolder).end()
+
+    All the sub-objects that are already locked are reported together, so
+    that the client can deal with all of them before trying again.
+
+      >>> file2 = Demo()
+      >>> demofolder['demo2'] = file2
+      >>> locktoken2 = DAVLockmanager(file2).lock(u'exclusive', u'write',
+      ...    u'Michael', datetime.timedelta(seconds = 3600), '0')
+      >>> try:
+      ...     adapter.lock(u'exclusive', u'write', u'Michael 2',
+      ...        datetime.timedelta(seconds = 3600), 'infinity')
+      ... except z3c.dav.interfaces.WebDAVErrors, errors:
+      ...     pass
+      >>> sorted([error.resource.__name__ for error in errors])
+      ['demo', 'demo2']
+      >>> [error.__class__.__name__ for error in errors]
+      ['AlreadyLocked', 'AlreadyLocked']
+      >>> util.get(demofolder).end()
+
+    The number of conflicts reported is limited, by default to
+    MAX_REPORTED_CONFLICTS. We stop looking once we have found that many.
+
+      >>> from limits import LockLimits
+      >>> limits = LockLimits()
+      >>> limits.maxReportedConflicts = 1
+      >>> zope.component.getGlobalSiteManager().registerUtility(
+      ...    limits, interfaces.ILockLimits)
+      >>> try:
+      ...     adapter.lock(u'exclusive', u'write', u'Michael 2',
+      ...        datetime.timedelta(seconds = 3600), 'infinity')
+      ... except z3c.dav.interfaces.WebDAVErrors, errors:
+      ...     pass
+      >>> len(errors)
+      1
+      >>> util.get(demofolder).end()
+      >>> zope.component.getGlobalSiteManager().unregisterUtility(
+      ...    limits, interfaces.ILockLimits)
+      True
+
+    A lock covering a whole sub-tree is reported once, for its root, and
+    not for each of the objects below it.
+
+      >>> subfolder = demofolder['subfolder'] = DemoFolder()
+      >>> subfolder['a'] = Demo()
+      >>> subfolder['b'] = Demo()
+      >>> sublocktoken = DAVLockmanager(subfolder).lock(u'exclusive',
+      ...    u'write', u'Michael', datetime.timedelta(seconds = 3600),
+      ...    'infinity')
+      >>> try:
+      ...     adapter.lock(u'exclusive', u'write', u'Michael 2',
+      ...        datetime.timedelta(seconds = 3600), 'infinity')
+      ... except z3c.dav.interfaces.WebDAVErrors, errors:
+      ...     pass
+      >>> sorted([error.resource.__name__ for error in errors])
+      ['demo', 'demo2', 'subfolder']
+      >>> util.get(demofolder).end()
+      >>> DAVLockmanager(subfolder).unlock(sublocktoken)
+      >>> del demofolder['subfolder']
 
     Some error conditions
     ---------------------
@@ -333,31 +413,156 @@ class DAVLockmanager(object):
         return utility is not None
 
     def maybeRecursivelyLockIndirectly(self, utility,
-                                       context, roottoken, depth):
+                                       context, roottoken, depth,
+                                       check = True, conflicts = None,
+                                       reported = None):
+        # If `conflicts` is a list then the sub-objects that are already
+        # locked are collected in it, otherwise the first one found raises
+        # an AlreadyLocked exception. Each conflicting lock is reported once
+        # and we don't look below the objects it covers. Returns the number
+        # of indirect tokens registered.
+        registered = 0
+        if reported is None:
+            reported = {}
         if depth == "infinity" and \
                zope.container.interfaces.IReadContainer.providedBy(context):
             for subob in context.values():
-                token = utility.get(subob)
-                if token:
-                    raise z3c.dav.interfaces.AlreadyLocked(
-                        subob, message = u"Sub-object is already locked")
+                instrumentation.count(instrumentation.NODES_VISITED)
+                # Once the subtree lock count tells us that nothing at or
+                # below subob is locked, we can stop looking for conflicts.
+                subcheck = check and \
+                           counters.subtreeLockCount(utility, subob) != 0
+                if subcheck:
+                    started = costs.start()
+                    token = bloom.getToken(utility, subob)
+                    costs.stop("conflicts", started)
+                    if token:
+                        self.addLockedConflict(
+                            conflicts, reported, subob, token)
+                        continue
+                if conflicts:
+                    # This lock is going to fail so don't register any more
+                    # tokens, just look for the rest of the conflicts.
+                    if subcheck:
+                        self.maybeRecursivelyLockIndirectly(
+                            utility, subob, roottoken, depth, subcheck,
+                            conflicts, reported)
+                    continue
                 indirecttoken = indirecttokens.IndirectToken(subob, roottoken)
-                utility.register(indirecttoken)
-                self.maybeRecursivelyLockIndirectly(
-                    utility, subob, roottoken, depth)
+                try:
+                    self.register(utility, indirecttoken)
+                    instrumentation.count(instrumentation.TOKENS_REGISTERED)
+                    registered += 1
+                except z3c.dav.interfaces.AlreadyLocked, error:
+                    token = utility.get(subob)
+                    if token is None:
+                        self.addConflict(conflicts, error)
+                    else:
+                        self.addLockedConflict(
+                            conflicts, reported, subob, token)
+                    continue
+                registered += self.maybeRecursivelyLockIndirectly(
+                    utility, subob, roottoken, depth, subcheck, conflicts,
+                    reported)
+        return registered
+
+    def addLockedConflict(self, conflicts, reported, subob, token):
+        # `reported` maps the ids of the lock roots already reported to them.
+        if interfaces.IIndirectToken.providedBy(token):
+            token = token.roottoken
+        if id(token) in reported:
+            return
+        reported[id(token)] = token
+        self.addConflict(
+            conflicts, z3c.dav.interfaces.AlreadyLocked(
+                subob, message = u"Sub-object is already locked"))
+
+    def addConflict(self, conflicts, error):
+        if conflicts is None:
+            raise error
+        conflicts.append(error)
+        if len(conflicts) >= self.maxReportedConflicts():
+            raise z3c.dav.interfaces.WebDAVErrors(self.context, conflicts)
+
+    def maxReportedConflicts(self):
+        limits = zope.component.queryUtility(
+            interfaces.ILockLimits, context = self.context, default = None)
+        maxConflicts = getattr(limits, "maxReportedConflicts", None)
+        if maxConflicts is None:
+            return MAX_REPORTED_CONFLICTS
+        return maxConflicts
 
     def register(self, utility, token):
+        started = costs.start()
         try:
             return utility.register(token)
         except zope.locking.interfaces.RegistrationError:
             raise z3c.dav.interfaces.AlreadyLocked(
                 token.context, message = u"Context is locked")
+        finally:
+            costs.stop("register", started)
+
+    def checkLimits(self, utility, principal_id, depth):
+        limits = zope.component.queryUtility(
+            interfaces.ILockLimits, context = self.context, default = None)
+        if limits is None:
+            return
+
+        maxLocks = limits.maxLocksPerPrincipal
+        if maxLocks is not None and \
+               counters.principalLockCount(utility, principal_id) >= maxLocks:
+            # The counter can be too high since expired tokens end without
+            # telling anyone, so count exactly before refusing the lock.
+            count = countPrincipalLocks(utility, principal_id)
+            counters.changePrincipalLockCount(
+                utility, principal_id,
+                count - counters.principalLockCount(utility, principal_id))
+            if count >= maxLocks:
+                raise z3c.dav.interfaces.ForbiddenError(
+                    self.context,
+                    message = u"Too many locks are held by this principal")
+
+        maxTokens = limits.maxIndirectTokens
+        if maxTokens is not None and depth == "infinity" and \
+               zope.container.interfaces.IReadContainer.providedBy(
+                   self.context) and \
+               counters.countDescendants(
+                   self.context, maxTokens, utility) > maxTokens:
+            raise z3c.dav.interfaces.ForbiddenError(
+                self.context, message = u"Too many resources would be locked")
 
     def lock(self, scope, type, owner, duration, depth):
+        return instrumentation.call(
+            "lock", self.context, self._lock,
+            (scope, type, owner, duration, depth),
+            scope = scope, depth = depth)
+
+    def _lock(self, scope, type, owner, duration, depth):
         principal_id = getPrincipalId()
         utility = zope.component.getUtility(
             zope.locking.interfaces.ITokenUtility, context = self.context)
 
+        started = costs.start()
+        indirecttokens.flushDeferredCleanups(utility)
+        self.checkLimits(utility, principal_id, depth)
+
+        check = True
+        if depth == "infinity" and \
+               scanner.canScanInParallel(utility, self.context):
+            # Look for conflicting locks in other threads before writing
+            # anything. The scan sees the latest committed state, so it can
+            # miss locks only in the snapshot of this request, but
+            # registering the indirect tokens still refuses those.
+            conflicts = scanner.findLockedDescendants(
+                utility, self.context, limit = self.maxReportedConflicts())
+            if conflicts:
+                raise z3c.dav.interfaces.WebDAVErrors(self.context, [
+                    z3c.dav.interfaces.AlreadyLocked(
+                        subob, message = u"Sub-object is already locked")
+                    for subob in conflicts])
+            check = False
+        costs.stop("checks", started)
+
         locktoken = z3c.dav.locking.generateLocktoken()
 
         if scope == u"exclusive":
@@ -403,10 +608,29 @@ class DAVLockmanager(object):
                 message = u"Invalid lockscope supplied to the lock manager")
 
         annots[locktoken] = OOBTree()
-        annots[locktoken].update({"owner": owner, "depth": depth})
-
-        self.maybeRecursivelyLockIndirectly(
-            utility, self.context, roottoken, depth)
+        annots[locktoken].update(
+            {"owner": owner, "depth": depth, "principal_id": principal_id})
+
+        conflicts = []
+        started = costs.start()
+        registered = instrumentation.call(
+            "maybeRecursivelyLockIndirectly", self.context,
+            self.maybeRecursivelyLockIndirectly,
+            (utility, self.context, roottoken, depth, check, conflicts),
+            depth = depth)
+        costs.stop("traversal", started, exclude = ("conflicts", "register"))
+        if conflicts:
+            # Report all the conflicts found in one multi-status response.
+            raise z3c.dav.interfaces.WebDAVErrors(self.context, conflicts)
+
+        started = costs.start()
+        counters.changePrincipalLockCount(utility, principal_id, 1)
+        principals.indexLocktoken(utility, principal_id, locktoken, roottoken)
+        counters.changeLockEpoch(self.context)
+        stats.changeIndirectTokens(roottoken, registered)
+        if scope == u"shared":
+            stats.changeHolders(roottoken, len(annots["principal_ids"]))
+        costs.stop("counters", started)
 
         return locktoken
 
@@ -419,13 +643,33 @@ class DAVLockmanager(object):
         return None
 
     def refreshlock(self, timeout):
+        instrumentation.call(
+            "refreshlock", self.context, self._refreshlock, (timeout,))
+
+    def _refreshlock(self, timeout):
+        started = costs.start()
         token = zope.locking.interfaces.ITokenBroker(self.context).get()
+        costs.stop("keyref", started)
         token.duration = timeout
+        if interfaces.IIndirectToken.providedBy(token):
+            token = token.roottoken
+        started = costs.start()
+        counters.changeLockEpoch(token.context)
+        costs.stop("counters", started)
 
     def unlock(self, locktoken):
+        instrumentation.call(
+            "unlock", self.context, self._unlock, (locktoken,))
+
+    def _unlock(self, locktoken):
         utility = zope.component.getUtility(
             zope.locking.interfaces.ITokenUtility, context = self.context)
+        started = costs.start()
+        indirecttokens.flushDeferredCleanups(utility)
+        costs.stop("checks", started)
+        started = costs.start()
         token = utility.get(self.context)
+        costs.stop("keyref", started)
         if token is None:
             raise z3c.dav.interfaces.ConflictError(
                 self.context,
@@ -434,22 +678,17 @@ class DAVLockmanager(object):
         if interfaces.IIndirectToken.providedBy(token):
             token = token.roottoken
 
-        if zope.locking.interfaces.IExclusiveLock.providedBy(token):
-            token.end()
-        elif zope.locking.interfaces.ISharedLock.providedBy(token):
-            principal_id = getPrincipalId()
-            annots = token.annotations[WEBDAV_LOCK_KEY]
-            del annots[locktoken]
-            annots["principal_ids"].remove(principal_id)
-            if principal_id not in annots["principal_ids"]:
-                # will end token if no principals left
-                token.remove((principal_id,))
-        else:
-            raise ValueError("Unknown lock token")
+        started = costs.start()
+        endLock(utility, token, locktoken)
+        costs.stop("teardown", started)
 
     def islocked(self):
-        tokenBroker = zope.locking.interfaces.ITokenBroker(self.context)
-        return tokenBroker.get() is not None
+        utility = zope.component.queryUtility(
+            zope.locking.interfaces.ITokenUtility,
+            context = self.context, default = None)
+        if utility is None:
+            return False
+        return cache.getToken(utility, self.context) is not None
 
 
 def getPrincipalId():
@@ -464,6 +703,237 @@ def getPrincipalId():
 
     return principal_id
 
+
+def endLock(utility, token, locktoken, principal_id = None):
+    """
+    End the WebDAV lock `locktoken` on the lock root `token`. For shared
+    locks this only removes the lock held by `principal_id`, which defaults
+    to the current principal.
+    """
+    if zope.locking.interfaces.IExclusiveLock.providedBy(token):
+        token.end()
+        for principal_id in token.principal_ids:
+            counters.changePrincipalLockCount(utility, principal_id, -1)
+            principals.unindexLocktoken(utility, principal_id, locktoken)
+    elif zope.locking.interfaces.ISharedLock.providedBy(token):
+        if principal_id is None:
+            principal_id = getPrincipalId()
+        annots = token.annotations[WEBDAV_LOCK_KEY]
+        del annots[locktoken]
+        annots["principal_ids"].remove(principal_id)
+        stats.changeHolders(token, len(annots["principal_ids"]))
+        counters.changePrincipalLockCount(utility, principal_id, -1)
+        principals.unindexLocktoken(utility, principal_id, locktoken)
+        if principal_id not in annots["principal_ids"]:
+            # will end token if no principals left
+            token.remove((principal_id,))
+    else:
+        raise ValueError("Unknown lock token")
+
+    counters.changeLockEpoch(token.context)
+
+
+def countPrincipalLocks(utility, principal_id):
+    """
+    Count the WebDAV locks held by `principal_id` by looking at all of its
+    tokens.
+    """
+    count = 0
+    for token in utility.iterForPrincipalId(principal_id):
+        if interfaces.IIndirectToken.providedBy(token) or \
+               WEBDAV_LOCK_KEY not in token.annotations:
+            continue
+        annots = token.annotations[WEBDAV_LOCK_KEY]
+        if "principal_ids" in annots:
+            count += list(annots["principal_ids"]).count(principal_id)
+        else:
+            count += len(annots)
+    return count
+
+
+def heldLocktokens(token, principal_id):
+    """
+    The WebDAV locktokens on the lock root `token` held by `principal_id`.
+    """
+    annots = token.annotations.get(WEBDAV_LOCK_KEY, {})
+    if "principal_ids" not in annots:
+        # An exclusive lock
+        if principal_id not in token.principal_ids:
+            return []
+        return list(annots.keys())
+    locktokens = []
+    for locktoken, data in annots.items():
+        if locktoken == "principal_ids":
+            continue
+        # Shared locks taken out before we recorded the principal can only
+        # be told apart if there is one principal.
+        owner = data.get("principal_id", None)
+        if owner == principal_id or (owner is None and
+                                     list(annots["principal_ids"]) ==
+                                     [principal_id]):
+            locktokens.append(locktoken)
+    return locktokens
+
+
+def startIndexingPrincipalLocks(utility):
+    """
+    Start maintaining the index of the locktokens held by each principal
+    for `utility`, indexing the locks that are already registered. This
+    walks every token.
+    """
+    principals.clearIndex(utility)
+    for token in utility:
+        if interfaces.IIndirectToken.providedBy(token):
+            continue
+        for principal_id in token.principal_ids:
+            for locktoken in heldLocktokens(token, principal_id):
+                principals.indexLocktoken(
+                    utility, principal_id, locktoken, token)
+
+
+def _principalLocks(utility, principal_id):
+    # Returns the active (locktoken, lock root) pairs, and the locktokens
+    # of locks that have ended but are still in the index.
+    indexed = principals.indexedLocktokens(utility, principal_id)
+    if indexed is None:
+        active = []
+        for token in utility.iterForPrincipalId(principal_id):
+            if not interfaces.IIndirectToken.providedBy(token):
+                active.extend([(locktoken, token) for locktoken in
+                               heldLocktokens(token, principal_id)])
+        return active, []
+    active = []
+    ended = []
+    for locktoken, token in indexed:
+        if not token.ended and \
+               locktoken in token.annotations.get(WEBDAV_LOCK_KEY, {}):
+            active.append((locktoken, token))
+        else:
+            ended.append(locktoken)
+    return active, ended
+
+
+def getPrincipalLocks(utility, principal_id):
+    """
+    The WebDAV locks held by `principal_id`, as (locktoken, lock root)
+    pairs. Without the index every token of the principal is looked at.
+    """
+    return _principalLocks(utility, principal_id)[0]
+
+
+def releasePrincipalLocks(utility, principal_id, chunk = 100,
+                          transaction_manager = None):
+    """
+    End all the WebDAV locks held by `principal_id`, committing after every
+    `chunk` locks so that releasing many locks doesn't become one large
+    transaction. Returns the number of locks released.
+
+      >>> import datetime
+      >>> import persistent.interfaces
+      >>> import ZODB.interfaces
+      >>> import zope.app.keyreference.interfaces
+      >>> from zope.app.keyreference.persistent import \\
+      ...    KeyReferenceToPersistent, connectionOfPersistent
+      >>> from zope.container.btree import BTreeContainer
+      >>> from zope.locking import utility as lockingutility
+
+      >>> gsm = zope.component.getGlobalSiteManager()
+      >>> gsm.registerAdapter(KeyReferenceToPersistent,
+      ...    (persistent.interfaces.IPersistent,),
+      ...    zope.app.keyreference.interfaces.IKeyReference)
+      >>> gsm.registerAdapter(connectionOfPersistent,
+      ...    (persistent.interfaces.IPersistent,), ZODB.interfaces.IConnection)
+
+      >>> root = conn.root()
+      >>> folder = root['folder'] = BTreeContainer()
+      >>> for i in range(5):
+      ...     folder['file%d' % i] = BTreeContainer()
+      >>> util = root['util'] = lockingutility.TokenUtility()
+      >>> transaction.commit()
+      >>> gsm.registerUtility(util, zope.locking.interfaces.ITokenUtility)
+      >>> hour = datetime.timedelta(hours = 1)
+
+    Without the index the principal's tokens are searched.
+
+      >>> locktoken0 = DAVLockmanager(folder['file0']).lock(
+      ...    u'exclusive', u'write', None, hour, '0')
+      >>> getPrincipalLocks(util, 'michael') == [
+      ...    (locktoken0, util.get(folder['file0']))]
+      True
+
+    Once the index is started it holds the locks already taken out, and
+    the locks taken out afterwards.
+
+      >>> startIndexingPrincipalLocks(util)
+      >>> locktokens = [locktoken0] + [
+      ...    DAVLockmanager(folder['file%d' % i]).lock(
+      ...        u'shared', u'write', None, hour, '0')
+      ...    for i in range(1, 5)]
+      >>> sorted([locktoken for locktoken, token in
+      ...         getPrincipalLocks(util, 'michael')]) == sorted(locktokens)
+      True
+      >>> getPrincipalLocks(util, 'zope.anybody')
+      []
+      >>> transaction.commit()
+
+    Unlocking removes the lock from the index, and locks ended by other
+    applications aren't returned.
+
+      >>> DAVLockmanager(folder['file1']).unlock(locktokens[1])
+      >>> util.get(folder['file4']).end()
+      >>> len(getPrincipalLocks(util, 'michael'))
+      3
+      >>> len(principals.indexedLocktokens(util, 'michael'))
+      4
+      >>> transaction.commit()
+
+    The remaining locks are released two at a time, each in its own
+    transaction, and the index is cleaned up.
+
+      >>> class CountingTransactionManager(object):
+      ...     commits = 0
+      ...     def commit(self):
+      ...         self.commits += 1
+      ...         transaction.commit()
+      >>> tm = CountingTransactionManager()
+      >>> releasePrincipalLocks(util, 'michael', 2, tm)
+      3
+      >>> tm.commits
+      2
+      >>> [util.get(folder['file%d' % i]) for i in range(5)]
+      [None, None, None, None, None]
+      >>> principals.indexedLocktokens(util, 'michael')
+      []
+
+    Cleanup.
+
+      >>> gsm.unregisterAdapter(KeyReferenceToPersistent,
+      ...    (persistent.interfaces.IPersistent,),
+      ...    zope.app.keyreference.interfaces.IKeyReference)
+      True
+      >>> gsm.unregisterAdapter(connectionOfPersistent,
+      ...    (persistent.interfaces.IPersistent,), ZODB.interfaces.IConnection)
+      True
+      >>> gsm.unregisterUtility(util, zope.locking.interfaces.ITokenUtility)
+      True
+
+    """
+    if transaction_manager is None:
+        transaction_manager = transaction.manager
+    released = 0
+    while True:
+        active, ended = _principalLocks(utility, principal_id)
+        for locktoken in ended:
+            principals.unindexLocktoken(utility, principal_id, locktoken)
+        if not active:
+            if ended:
+                transaction_manager.commit()
+            return released
+        for locktoken, token in active[:chunk]:
+            endLock(utility, token, locktoken, principal_id)
+            released += 1
+        transaction_manager.commit()
+
 ###############################################################################
 #
 # These event handlers enforce the WebDAV lock model. Namely on modification
@@ -487,6 +957,14 @@ def getPrincipalId():
 
 BROWSER_METHODS = ("GET", "HEAD", "POST")
 
+def matchesIfHeader(ob, request):
+    started = costs.start()
+    try:
+        return z3c.dav.ifvalidator.matchesIfHeader(ob, request)
+    finally:
+        costs.stop("ifheader", started)
+
+
 @zope.component.adapter(zope.container.interfaces.IObjectMovedEvent)
 def indirectlyLockObjectOnMovedEvent(event):
     """
@@ -661,6 +1139,48 @@ def indirectlyLockObjectOnMovedEvent(event):
       >>> subsubtoken.roottoken == roottoken
       True
 
+    Moving locked collections
+    -------------------------
+
+    An object moving within the collection locked by the same depth infinity
+    lock keeps the indirect token it already has.
+
+      >>> demofolder['subsubfolder'] = subsubfolder
+      >>> indirectlyLockObjectOnMovedEvent(
+      ...    ObjectMovedEvent(subsubfolder, subfolder, 'subfolder',
+      ...                     demofolder, 'subsubfolder'))
+      >>> util.get(subsubfolder) is subsubtoken
+      True
+
+    Moving the root of a depth infinity lock keeps the root token and all the
+    indirect tokens locked against it, since tokens refer to the content
+    objects and not to their location. Nothing needs to be registered again,
+    so the cost of the move doesn't depend on the size of the collection.
+
+      >>> properties.DAVActiveLock(
+      ...    locktoken, subtoken, subfolder, None).lockroot
+      '/dummy/'
+
+      >>> oldparent = DemoFolder()
+      >>> newparent = DemoFolder()
+      >>> newparent['moved'] = demofolder
+      >>> indirectlyLockObjectOnMovedEvent(
+      ...    ObjectMovedEvent(demofolder, oldparent, 'demofolder',
+      ...                     newparent, 'moved'))
+      >>> util.get(demofolder) is roottoken
+      True
+      >>> util.get(subfolder) is subtoken
+      True
+      >>> util.get(file1).roottoken is roottoken
+      True
+
+    The lockroot is worked out from the location of the root token's context,
+    so it follows the collection.
+
+      >>> properties.DAVActiveLock(
+      ...    locktoken, subtoken, subfolder, None).lockroot
+      '/dummy/dummy/'
+
     But this eventhandler never raises exceptions for any of the browser
     methods, GET, HEAD, POST.
 
@@ -669,6 +1189,25 @@ def indirectlyLockObjectOnMovedEvent(event):
       >>> indirectlyLockObjectOnMovedEvent(
       ...    ObjectRemovedEvent(file2, demofolder, 'file2'))
 
+    Nothing locked
+    --------------
+
+    When the utility is counting its active locks, the event handler returns
+    straight away if nothing in the site is locked.
+
+      >>> roottoken.end()
+      >>> util.get(demofolder2).end()
+      >>> counters.resetActiveLockCount(util)
+      0
+
+      >>> request.method = 'PUT'
+      >>> file5 = Demo()
+      >>> demofolder['file5'] = file5
+      >>> indirectlyLockObjectOnMovedEvent(
+      ...    ObjectAddedEvent(file5, demofolder, 'file5'))
+      >>> util.get(file5) is None
+      True
+
     Cleanup
     -------
 
@@ -687,44 +1226,104 @@ def indirectlyLockObjectOnMovedEvent(event):
         zope.locking.interfaces.ITokenUtility, context = event.object)
     if not utility:
         # If there is no utility then is nothing that we can check against.
+        instrumentation.count(instrumentation.MOVED_SHORTCUTS)
+        return
+
+    if not sweeper.isReadRequest():
+        indirecttokens.flushDeferredCleanups(utility)
+
+    if counters.activeLockCount(utility) == 0:
+        # Nothing is locked anywhere in the site so there is nothing to
+        # validate and no lock for the object to inherit.
+        instrumentation.count(instrumentation.MOVED_SHORTCUTS)
         return
 
+    instrumentation.count(instrumentation.MOVED_CHECKS)
+    instrumentation.call(
+        "moved", event.object, validateMovedObject, (utility, event))
+
+
+def validateMovedObject(utility, event):
+    """
+    Check that the container event is allowed by the locks and lock the
+    object added to a locked collection.
+    """
+    started = costs.start()
+    counters.moveSubtreeLockCount(utility, event)
+    if event.oldParent is not None and stats.isCollecting(utility):
+        # The indirect tokens of an object leaving its lock no longer count
+        # towards the lock root.
+        token = bloom.getToken(utility, event.object)
+        if interfaces.IIndirectToken.providedBy(token):
+            parentToken = None
+            if event.newParent is not None:
+                parentToken = bloom.getToken(utility, event.newParent)
+                if interfaces.IIndirectToken.providedBy(parentToken):
+                    parentToken = parentToken.roottoken
+            if parentToken is not token.roottoken:
+                stats.removeIndirectTokens(token.roottoken, event.object)
+    costs.stop("counters", started)
+
     # This is an hack to get at the current request object
     interaction = zope.security.management.queryInteraction()
     if interaction:
         request = interaction.participations[0]
         if zope.publisher.interfaces.http.IHTTPRequest.providedBy(request) \
                and request.method not in BROWSER_METHODS:
-            objectToken = utility.get(event.object)
+            started = costs.start()
+            objectToken = bloom.getToken(utility, event.object)
+            costs.stop("keyref", started)
             if objectToken:
                 # The object is been moved out of its parent - hance we need
                 # to validate that we are allowed to perform this
                 # modification.
                 if event.oldParent is not None and \
-                       not z3c.dav.ifvalidator.matchesIfHeader(
-                           event.object, request):
+                       not matchesIfHeader(event.object, request):
                     raise z3c.dav.interfaces.AlreadyLocked(
                         event.object, "Locked object cannot be moved ")
                 # Otherwise since the oldParent hasn't changed we don't
                 # need to check if we are allowed to perform this action,
                 # this is probable a copy.
+            if event.oldParent is not None:
+                # Any independent locks held below the object must also be
+                # known to the client. The subtree lock counts let us skip
+                # the parts of the tree that contain no locks.
+                for subob, subtoken in counters.iterLockedDescendants(
+                    utility, event.object):
+                    if not matchesIfHeader(subob, request):
+                        raise z3c.dav.interfaces.AlreadyLocked(
+                            subob, "Locked object cannot be moved")
             if event.newParent is not None:
                 # Probable an object added event, the object lock must be
                 # consistent we the lock on its parent.
-                parentToken = utility.get(event.newParent)
+                started = costs.start()
+                parentToken = bloom.getToken(utility, event.newParent)
+                costs.stop("keyref", started)
                 if parentToken is not None:
-                    if not z3c.dav.ifvalidator.matchesIfHeader(
-                        event.newParent, request):
+                    if not matchesIfHeader(event.newParent, request):
                         raise z3c.dav.interfaces.AlreadyLocked(
                             event.object, "Destination folder is locked") 
+                    if interfaces.IIndirectToken.providedBy(parentToken):
+                        parentToken = parentToken.roottoken
                     if objectToken is not None:
+                        if event.oldParent is not None and \
+                               interfaces.IIndirectToken.providedBy(
+                                   objectToken) and \
+                               objectToken.roottoken is parentToken:
+                            # The object is moving within the collection
+                            # locked by the same lock, so it and its
+                            # descendants keep the tokens they have.
+                            return
                         # XXX - this needs to be smarter. We the lock on
-                        # the parent as depth '0' or the objectToken is
-                        # indirectly locked against the parentToken then
-                        # we shouldn't raise this exception.
+                        # the parent as depth '0' then we shouldn't raise
+                        # this exception.
                         raise z3c.dav.interfaces.AlreadyLocked(
                             event.object, "Locked object cannot be moved.")
-                    if interfaces.IIndirectToken.providedBy(parentToken):
-                        parentToken = parentToken.roottoken
+                    started = costs.start()
                     utility.register(
                         indirecttokens.IndirectToken(event.object, parentToken))
+                    costs.stop("register", started)
+                    instrumentation.count(instrumentation.TOKENS_REGISTERED)
+                    stats.changeIndirectTokens(parentToken, 1)
+                    # The object and its descendants are now locked.
+                    counters.changeLockEpoch(event.object)
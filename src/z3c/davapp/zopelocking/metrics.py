@@ -0,0 +1,234 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Counters and timers for the hot paths of the lock manager.
+
+The lock manager and the event handlers report what they do to the
+IMetricsCollector plugged in with `setCollector`. Nothing is collected
+until one is plugged in, and until then each call below only checks that
+there is no collector, so the instrumentation costs next to nothing in
+production. `enable` plugs in a `Metrics` object, which keeps the numbers
+for this process and exports them as a snapshot or as Prometheus text.
+"""
+
+import threading
+import time
+
+import zope.interface
+
+import interfaces
+
+# The names and descriptions of what is measured.
+LOCK_SECONDS = "lock_seconds"
+UNLOCK_SECONDS = "unlock_seconds"
+REFRESHLOCK_SECONDS = "refreshlock_seconds"
+NODES_VISITED = "indirect_lock_nodes_visited"
+TOKENS_REGISTERED = "indirect_tokens_registered"
+REMOVEENDEDTOKENS_SECONDS = "remove_ended_tokens_seconds"
+TOKENS_REMOVED = "indirect_tokens_removed"
+MOVED_SHORTCUTS = "moved_event_shortcuts"
+MOVED_CHECKS = "moved_event_checks"
+MOVED_SECONDS = "moved_event_seconds"
+INDIRECT_LOCK_SECONDS = "indirect_lock_seconds"
+LOCKDISCOVERY_SECONDS = "lockdiscovery_seconds"
+
+METRICS = {
+    LOCK_SECONDS: "Time spent taking out WebDAV locks.",
+    UNLOCK_SECONDS: "Time spent removing WebDAV locks.",
+    REFRESHLOCK_SECONDS: "Time spent refreshing WebDAV locks.",
+    NODES_VISITED: "Objects visited while taking out depth infinity locks.",
+    TOKENS_REGISTERED: "Indirect tokens registered for depth infinity locks.",
+    REMOVEENDEDTOKENS_SECONDS:
+        "Time spent removing the indirect tokens of ended locks.",
+    TOKENS_REMOVED: "Indirect tokens removed after their lock ended.",
+    MOVED_SHORTCUTS:
+        "Container events ignored because nothing in the site is locked.",
+    MOVED_CHECKS: "Container events validated against the locks.",
+    MOVED_SECONDS: "Time spent validating container events.",
+    INDIRECT_LOCK_SECONDS:
+        "Time spent registering the indirect tokens of depth infinity locks.",
+    LOCKDISCOVERY_SECONDS:
+        "Time spent finding the active locks for {DAV:}lockdiscovery.",
+    }
+
+PREFIX = "z3c_davapp_"
+
+_collector = None
+
+def setCollector(collector):
+    """
+    Report to `collector` from now on, or stop collecting if it is None.
+    """
+    global _collector
+    _collector = collector
+    # The instrumentation module imports this one.
+    import instrumentation
+    instrumentation.refresh()
+
+
+def getCollector():
+    return _collector
+
+
+def enable():
+    """
+    Start collecting in a new `Metrics` object, which is returned.
+    """
+    metrics = Metrics()
+    setCollector(metrics)
+    return metrics
+
+
+def disable():
+    setCollector(None)
+
+
+def count(name, value = 1):
+    if _collector is not None:
+        _collector.count(name, value)
+
+
+def start():
+    """
+    Start timing an operation, returns the value to pass to `stop`.
+    """
+    if _collector is None:
+        return None
+    return time.time()
+
+
+def stop(name, started):
+    if started is not None and _collector is not None:
+        _collector.observe(name, time.time() - started)
+
+
+class Metrics(object):
+    """
+    Keeps the counters and timers of this process.
+
+      >>> from zope.interface.verify import verifyObject
+      >>> metrics = enable()
+      >>> verifyObject(interfaces.IMetricsCollector, metrics)
+      True
+
+      >>> count(NODES_VISITED, 3)
+      >>> count(NODES_VISITED)
+      >>> metrics.observe(LOCK_SECONDS, 0.25)
+      >>> metrics.observe(LOCK_SECONDS, 0.5)
+
+      >>> snapshot = metrics.snapshot()
+      >>> snapshot[NODES_VISITED]
+      4
+      >>> sorted(snapshot[LOCK_SECONDS].items())
+      [('count', 2), ('max', 0.5), ('sum', 0.75)]
+
+      >>> print metrics.prometheus()
+      # HELP z3c_davapp_indirect_lock_nodes_visited Objects visited while taking out depth infinity locks.
+      # TYPE z3c_davapp_indirect_lock_nodes_visited counter
+      z3c_davapp_indirect_lock_nodes_visited 4
+      # HELP z3c_davapp_lock_seconds Time spent taking out WebDAV locks.
+      # TYPE z3c_davapp_lock_seconds summary
+      z3c_davapp_lock_seconds_count 2
+      z3c_davapp_lock_seconds_sum 0.75
+
+    The operations are timed with `start` and `stop`.
+
+      >>> started = start()
+      >>> stop(UNLOCK_SECONDS, started)
+      >>> metrics.snapshot()[UNLOCK_SECONDS]['count']
+      1
+
+    Nothing is collected once disabled.
+
+      >>> disable()
+      >>> start() is None
+      True
+      >>> count(NODES_VISITED)
+      >>> metrics.snapshot()[NODES_VISITED]
+      4
+
+      >>> metrics.reset()
+      >>> metrics.snapshot()
+      {}
+
+    """
+    zope.interface.implements(interfaces.IMetricsCollector)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.counters = {}
+            # name -> [count, sum, max]
+            self.timers = {}
+        finally:
+            self._lock.release()
+
+    def count(self, name, value):
+        self._lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + value
+        finally:
+            self._lock.release()
+
+    def observe(self, name, seconds):
+        self._lock.acquire()
+        try:
+            timer = self.timers.get(name, None)
+            if timer is None:
+                self.timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """
+        Returns a dictionary of the counters, and of the timers as
+        dictionaries with their count, sum and max.
+        """
+        self._lock.acquire()
+        try:
+            result = dict(self.counters)
+            for name, (number, total, longest) in self.timers.items():
+                result[name] = {"count": number, "sum": total,
+                                "max": longest}
+        finally:
+            self._lock.release()
+        return result
+
+    def prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format, the
+        timers as summaries without quantiles.
+        """
+        lines = []
+        for name, value in sorted(self.snapshot().items()):
+            metric = PREFIX + name
+            description = METRICS.get(name, None)
+            if description is not None:
+                lines.append("# HELP %s %s" % (metric, description))
+            if isinstance(value, dict):
+                lines.append("# TYPE %s summary" % metric)
+                lines.append("%s_count %d" % (metric, value["count"]))
+                lines.append("%s_sum %r" % (metric, value["sum"]))
+            else:
+                lines.append("# TYPE %s counter" % metric)
+                lines.append("%s %d" % (metric, value))
+        return "\n".join(lines)
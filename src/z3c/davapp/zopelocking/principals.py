@@ -0,0 +1,111 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+An index of the WebDAV locktokens held by each principal.
+
+The index is stored on the token utility and maps each principal id to the
+locktokens held by that principal and the lock root of each locktoken. The
+lock manager maintains it once `manager.startIndexingPrincipalLocks` has
+been called for the utility. Locks that time out, or that are ended by
+other applications, stay in the index until they are released, so the
+entries must be checked against their tokens when read.
+
+The locktokens of a principal are kept in their own BTree, which is never
+removed from the index once created. This way concurrent transactions
+locking and unlocking for the same principal only ever change different
+keys of the same BTree, which ZODB resolves without a conflict.
+"""
+
+from BTrees.OOBTree import OOBTree
+
+PRINCIPAL_INDEX_KEY = "_z3c_davapp_principalindex"
+
+def isIndexing(utility):
+    return getattr(utility, PRINCIPAL_INDEX_KEY, None) is not None
+
+
+def clearIndex(utility):
+    setattr(utility, PRINCIPAL_INDEX_KEY, OOBTree())
+
+
+def indexLocktoken(utility, principal_id, locktoken, roottoken):
+    index = getattr(utility, PRINCIPAL_INDEX_KEY, None)
+    if index is None:
+        return
+    locktokens = index.get(principal_id, None)
+    if locktokens is None:
+        locktokens = index[principal_id] = OOBTree()
+    locktokens[locktoken] = roottoken
+
+
+def unindexLocktoken(utility, principal_id, locktoken):
+    index = getattr(utility, PRINCIPAL_INDEX_KEY, None)
+    if index is None:
+        return
+    locktokens = index.get(principal_id, None)
+    if locktokens is not None and locktoken in locktokens:
+        del locktokens[locktoken]
+
+
+def indexedLocktokens(utility, principal_id):
+    """
+    The (locktoken, lock root) pairs indexed for `principal_id`, or None if
+    the index isn't maintained for `utility`. This never writes to the
+    database.
+
+      >>> from zope.locking.utility import TokenUtility
+      >>> util = TokenUtility()
+
+    Nothing is indexed until the index is started.
+
+      >>> isIndexing(util)
+      False
+      >>> indexLocktoken(util, 'michael', 'opaquelocktoken:1', 'root1')
+      >>> print indexedLocktokens(util, 'michael')
+      None
+
+      >>> clearIndex(util)
+      >>> isIndexing(util)
+      True
+      >>> indexLocktoken(util, 'michael', 'opaquelocktoken:1', 'root1')
+      >>> indexLocktoken(util, 'michael', 'opaquelocktoken:2', 'root2')
+      >>> indexLocktoken(util, 'anna', 'opaquelocktoken:3', 'root1')
+      >>> indexedLocktokens(util, 'michael')
+      [('opaquelocktoken:1', 'root1'), ('opaquelocktoken:2', 'root2')]
+      >>> indexedLocktokens(util, 'anna')
+      [('opaquelocktoken:3', 'root1')]
+      >>> indexedLocktokens(util, 'zope.anybody')
+      []
+
+    Unindexing a locktoken that isn't indexed does nothing.
+
+      >>> unindexLocktoken(util, 'michael', 'opaquelocktoken:1')
+      >>> unindexLocktoken(util, 'michael', 'opaquelocktoken:1')
+      >>> unindexLocktoken(util, 'zope.anybody', 'opaquelocktoken:1')
+      >>> indexedLocktokens(util, 'michael')
+      [('opaquelocktoken:2', 'root2')]
+
+    The BTree of a principal is kept once it is empty.
+
+      >>> unindexLocktoken(util, 'michael', 'opaquelocktoken:2')
+      >>> indexedLocktokens(util, 'michael')
+      []
+      >>> 'michael' in getattr(util, PRINCIPAL_INDEX_KEY)
+      True
+
+    """
+    index = getattr(utility, PRINCIPAL_INDEX_KEY, None)
+    if index is None:
+        return None
+    return list(index.get(principal_id, {}).items())
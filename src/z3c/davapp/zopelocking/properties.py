@@ -32,8 +32,12 @@ from zope.traversing.browser.absoluteurl import absoluteURL
 from z3c.dav.coreproperties import ILockEntry, IDAVSupportedlock, \
      IActiveLock
 import z3c.dav.interfaces
+import z3c.dav.properties
 
 import interfaces
+import cache
+import counters
+import instrumentation
 from manager import WEBDAV_LOCK_KEY
 
 ################################################################################
@@ -555,7 +559,11 @@ class DAVLockdiscoveryAdapter(object):
 
     @property
     def lockdiscovery(self):
-        token = self.utility.get(self.context)
+        return instrumentation.call(
+            "lockdiscovery", self.context, self._lockdiscovery)
+
+    def _lockdiscovery(self):
+        token = cache.getToken(self.utility, self.context)
         if token is None:
             return None
 
@@ -571,3 +579,74 @@ class DAVLockdiscoveryAdapter(object):
         # We probable need an other active lock implementation to handle
         # this case.
         return [DAVActiveLock(None, token, self.context, self.request)]
+
+
+lockepoch = z3c.dav.properties.DAVProperty(
+    "{http://namespaces.zope.org/z3c.davapp}lockepoch",
+    interfaces.IDAVLockepoch)
+
+
+class DAVLockepochAdapter(object):
+    interface.implements(interfaces.IDAVLockepoch)
+
+    def __init__(self, context, epoch):
+        self.context = context
+        self.lockepoch = epoch
+
+
+@component.adapter(
+    interface.Interface, zope.publisher.interfaces.http.IHTTPRequest)
+@interface.implementer(interfaces.IDAVLockepoch)
+def DAVLockepoch(context, request):
+    """
+    This adapter is responsible for getting the data for the lock epoch
+    property, which is only defined on the resources keeping a lock epoch.
+
+      >>> from zope.annotation.attribute import AttributeAnnotations
+      >>> from z3c.dav.publisher import WebDAVRequest
+      >>> from cStringIO import StringIO
+      >>> component.getGlobalSiteManager().registerAdapter(
+      ...    AttributeAnnotations)
+      >>> request = WebDAVRequest(StringIO(''), {})
+
+      >>> DAVLockepoch(DemoFolder(), request) is None
+      True
+
+      >>> resource = Demo()
+      >>> DAVLockepoch(resource, request) is None
+      True
+      >>> counters.enableLockEpochs(resource)
+      1
+      >>> DAVLockepoch(resource, request).lockepoch
+      0
+      >>> counters.changeLockEpoch(resource)
+      >>> DAVLockepoch(resource, request).lockepoch
+      1
+
+    It is rendered as an integer.
+
+      >>> import z3c.dav.widgets
+      >>> import zope.schema.interfaces
+      >>> component.getGlobalSiteManager().registerAdapter(
+      ...    z3c.dav.widgets.IntDAVWidget,
+      ...    (zope.schema.interfaces.IInt, z3c.dav.interfaces.IWebDAVRequest))
+      >>> widget = z3c.dav.properties.getWidget(
+      ...    lockepoch, DAVLockepoch(resource, request), request)
+      >>> print etree.tostring(widget.render()) #doctest:+XMLDATA
+      <lockepoch xmlns="http://namespaces.zope.org/z3c.davapp">1</lockepoch>
+
+    Cleanup
+
+      >>> component.getGlobalSiteManager().unregisterAdapter(
+      ...    AttributeAnnotations)
+      True
+      >>> component.getGlobalSiteManager().unregisterAdapter(
+      ...    z3c.dav.widgets.IntDAVWidget,
+      ...    (zope.schema.interfaces.IInt, z3c.dav.interfaces.IWebDAVRequest))
+      True
+
+    """
+    epoch = counters.lockEpoch(context)
+    if epoch is None:
+        return None
+    return DAVLockepochAdapter(context, epoch)
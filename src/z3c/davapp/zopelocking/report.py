@@ -0,0 +1,318 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+A report of all the active locks at or below a collection.
+
+`iterLocks` generates the locks one at a time. They are taken from the
+index of the token utility, or from the ILockStore, so the content of the
+collection is never walked. The REPORT view renders each lock as a
+`{DAV:}response` element holding its `{DAV:}lockdiscovery` property. These
+are written to a temporary file as they are generated, which is then
+streamed to the client once the transaction is over, so a report on a large
+subtree doesn't need more memory than a small one.
+"""
+
+import tempfile
+
+import zope.component
+import zope.interface
+import zope.locking.interfaces
+import zope.locking.utils
+import zope.publisher.interfaces.http
+import z3c.etree
+import z3c.dav.coreproperties
+import z3c.dav.interfaces
+import z3c.dav.properties
+import z3c.dav.utils
+
+import interfaces
+import lockstore
+import properties
+from manager import WEBDAV_LOCK_KEY
+
+LOCKREPORT = "{http://namespaces.zope.org/z3c.davapp}lock-report"
+
+# The size of the chunks of the report sent to the client.
+CHUNK_SIZE = 1 << 16
+
+# Let the database connection trim its cache every time this many tokens
+# have been looked at.
+GC_INTERVAL = 1000
+
+def _isInside(collection, ob):
+    while ob is not None:
+        if ob is collection:
+            return True
+        ob = getattr(ob, "__parent__", None)
+    return False
+
+
+def _activelocks(token, request):
+    annots = token.annotations.get(WEBDAV_LOCK_KEY, {})
+    locktokens = [locktoken for locktoken in annots.keys()
+                  if locktoken != "principal_ids"]
+    if not locktokens:
+        # Locked by a non-webdav application, see DAVLockdiscoveryAdapter
+        return [properties.DAVActiveLock(None, token, token.context, request)]
+    return [properties.DAVActiveLock(locktoken, token, token.context, request)
+            for locktoken in locktokens]
+
+
+def iterLocks(collection, request, depth = "infinity"):
+    """
+    Generate a (lock root, activelock) pair for each of the active locks at
+    or below `collection`, or only the locks on `collection` if `depth` is
+    "0".
+
+      >>> import datetime
+      >>> from BTrees.OOBTree import OOBTree
+      >>> from cStringIO import StringIO
+      >>> from zope.locking import tokens
+      >>> from zope.locking.utility import TokenUtility
+      >>> from z3c.dav.publisher import WebDAVRequest
+
+      >>> folder = DemoFolder()
+      >>> folder['sub'] = DemoFolder()
+      >>> folder['sub']['file'] = Demo()
+      >>> folder['other'] = Demo()
+      >>> request = WebDAVRequest(StringIO(''), {})
+
+    Nothing is locked without a token utility.
+
+      >>> list(iterLocks(folder, request))
+      []
+
+      >>> util = TokenUtility()
+      >>> conn.add(util) # add to persistent database
+      >>> zope.component.getGlobalSiteManager().registerUtility(
+      ...    util, zope.locking.interfaces.ITokenUtility)
+
+      >>> import indirecttokens
+      >>> subtoken = util.register(tokens.ExclusiveLock(
+      ...    folder['sub'], 'michael'))
+      >>> locktokendata = subtoken.annotations[WEBDAV_LOCK_KEY] = OOBTree()
+      >>> locktokendata['subtoken'] = OOBTree()
+      >>> locktokendata['subtoken']['depth'] = 'infinity'
+      >>> indirect = util.register(indirecttokens.IndirectToken(
+      ...    folder['sub']['file'], subtoken))
+      >>> othertoken = util.register(tokens.SharedLock(
+      ...    folder['other'], ['michael'], datetime.timedelta(hours = 1)))
+
+    The lock roots are returned, not the indirect tokens.
+
+      >>> sorted([(ob.__name__, activelock.lockscope)
+      ...         for ob, activelock in iterLocks(folder, request)])
+      [('other', [u'shared']), ('sub', [u'exclusive'])]
+      >>> [ob.__name__ for ob, activelock in iterLocks(folder['sub'], request)]
+      ['sub']
+      >>> list(iterLocks(folder['sub']['file'], request))
+      []
+      >>> list(iterLocks(folder, request, '0'))
+      []
+
+    Ended locks aren't returned.
+
+      >>> othertoken.end()
+      >>> [ob.__name__ for ob, activelock in iterLocks(folder, request)]
+      ['sub']
+
+    The REPORT view renders the locks.
+
+      >>> body = '<lock-report xmlns="http://namespaces.zope.org/z3c.davapp"/>'
+      >>> request = WebDAVRequest(StringIO(body), {
+      ...    'CONTENT_TYPE': 'text/xml', 'CONTENT_LENGTH': str(len(body))})
+      >>> request.processInputs()
+      >>> result = REPORT(folder, request).REPORT()
+      >>> request.response.getStatus()
+      207
+      >>> request.response.getHeader('content-type')
+      'application/xml'
+      >>> print ''.join(result) #doctest:+XMLDATA
+      <multistatus xmlns="DAV:">
+        <response>
+          <href>/dummy/dummy/</href>
+          <propstat>
+            <prop>
+              <lockdiscovery>
+                <activelock>
+                  <lockscope><exclusive /></lockscope>
+                  <locktype><write /></locktype>
+                  <depth>infinity</depth>
+                  <locktoken><href>subtoken</href></locktoken>
+                  <lockroot>/dummy/dummy/</lockroot>
+                </activelock>
+              </lockdiscovery>
+            </prop>
+            <status>HTTP/1.1 200 Ok</status>
+          </propstat>
+        </response>
+      </multistatus>
+
+    Only one report is supported.
+
+      >>> body = '<version-tree xmlns="DAV:"/>'
+      >>> request = WebDAVRequest(StringIO(body), {
+      ...    'CONTENT_TYPE': 'text/xml', 'CONTENT_LENGTH': str(len(body))})
+      >>> request.processInputs()
+      >>> REPORT(folder, request).REPORT()
+      Traceback (most recent call last):
+      ...
+      UnprocessableError: Unknown report.
+
+    Cleanup.
+
+      >>> zope.component.getGlobalSiteManager().unregisterUtility(
+      ...    util, zope.locking.interfaces.ITokenUtility)
+      True
+
+    """
+    store = zope.component.queryUtility(
+        interfaces.ILockStore, context = collection, default = None)
+    if store is not None:
+        return _iterStoredLocks(store, collection, request, depth)
+    utility = zope.component.queryUtility(
+        zope.locking.interfaces.ITokenUtility,
+        context = collection, default = None)
+    if utility is None:
+        return iter(())
+    return _iterTokenLocks(utility, collection, request, depth)
+
+
+def _iterTokenLocks(utility, collection, request, depth):
+    if depth == "0":
+        token = utility.get(collection)
+        if token is not None and \
+               not interfaces.IIndirectToken.providedBy(token):
+            for activelock in _activelocks(token, request):
+                yield collection, activelock
+        return
+
+    now = zope.locking.utils.now()
+    jar = getattr(utility, "_p_jar", None)
+    count = 0
+    for token, principal_ids, expiration in utility._locks.values():
+        count += 1
+        if jar is not None and count % GC_INTERVAL == 0:
+            jar.cacheGC()
+        # The class of the token and its expiration time are known without
+        # loading the token.
+        if interfaces.IIndirectToken.implementedBy(type(token)) or \
+               (expiration is not None and expiration <= now):
+            continue
+        if zope.locking.interfaces.IEndable.providedBy(token) and \
+               token.ended:
+            continue
+        if _isInside(collection, token.context):
+            for activelock in _activelocks(token, request):
+                yield token.context, activelock
+
+
+def _iterStoredLocks(store, collection, request, depth):
+    path = lockstore.getPath(collection)
+    for lock in store.getLocks(path):
+        if lock.path == path:
+            yield collection, lockstore.StoredActiveLock(
+                lock, collection, request)
+    if depth == "0":
+        return
+    for subpath, lock in store.getLockedPaths(path):
+        if lock.path != subpath:
+            # Only report the lock roots
+            continue
+        try:
+            ob = lockstore.traversePath(collection, path, subpath)
+        except KeyError:
+            # The content has been removed in this transaction.
+            continue
+        yield ob, lockstore.StoredActiveLock(lock, ob, request)
+
+
+class ReportLockdiscovery(object):
+    zope.interface.implements(z3c.dav.coreproperties.IDAVLockdiscovery)
+
+    def __init__(self, activelocks):
+        self.lockdiscovery = activelocks
+
+
+def renderLock(ob, activelock, request):
+    """
+    Render the `{DAV:}response` element for one lock.
+    """
+    response = z3c.dav.utils.Response(
+        z3c.dav.utils.getObjectURL(ob, request))
+    widget = z3c.dav.properties.getWidget(
+        z3c.dav.coreproperties.lockdiscovery,
+        ReportLockdiscovery([activelock]), request)
+    response.addProperty(200, widget.render())
+    return response()
+
+
+class ReportResult(object):
+    """
+    Streams the report from its temporary file.
+    """
+    zope.interface.implements(zope.publisher.interfaces.http.IResult)
+
+    def __init__(self, body):
+        self.body = body
+
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self.body.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.body.close()
+
+
+class REPORT(object):
+    """
+    REPORT handler returning all the locks at or below the context.
+    """
+    zope.interface.implements(z3c.dav.interfaces.IWebDAVMethod)
+    zope.component.adapts(zope.interface.Interface,
+                          z3c.dav.interfaces.IWebDAVRequest)
+
+    def __init__(self, context, request):
+        self.context = context
+        self.request = request
+
+    def REPORT(self):
+        report = self.request.xmlDataSource
+        if report is not None and report.tag != LOCKREPORT:
+            raise z3c.dav.interfaces.UnprocessableError(
+                self.context, message = u"Unknown report.")
+
+        depth = self.request.getHeader("depth", "infinity")
+        if depth not in ("0", "infinity"):
+            raise z3c.dav.interfaces.BadRequest(
+                self.request, message = u"Invalid Depth header supplied")
+
+        etree = z3c.etree.getEngine()
+        body = tempfile.TemporaryFile()
+        body.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                   '<multistatus xmlns="DAV:">')
+        for ob, activelock in iterLocks(self.context, self.request, depth):
+            body.write(etree.tostring(
+                renderLock(ob, activelock, self.request), encoding = "utf-8"))
+        body.write('</multistatus>')
+        length = body.tell()
+        body.seek(0)
+
+        self.request.response.setStatus(207)
+        self.request.response.setHeader("content-type", "application/xml")
+        self.request.response.setHeader("content-length", str(length))
+        return ReportResult(body)
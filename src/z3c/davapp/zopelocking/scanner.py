@@ -0,0 +1,252 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Look for the existing locks below a collection using a number of threads.
+
+Before a depth infinity lock is taken out every object below the collection
+must be checked for an existing lock. Each thread opens its own connection
+to the database and checks part of the collection, so that the objects that
+need loading from the storage are loaded concurrently. Only the connection
+of the request then writes the new tokens.
+
+The other connections see the latest committed state, not the snapshot seen
+by the request, nor any changes the request has made. So each object found
+is looked up again in the connection of the request, and dropped if it has
+gone or isn't locked there. Locks the other threads miss because they are
+only in the snapshot of the request are still found when the lock manager
+registers the indirect tokens.
+"""
+
+import itertools
+import sys
+import threading
+
+import transaction
+import zope.container.interfaces
+
+import counters
+
+# The number of threads used to scan a collection.
+WORKERS = 4
+
+# Collections containing fewer objects than this are scanned in the request
+# thread as starting the threads costs more than it saves.
+MIN_PARALLEL_SIZE = 1000
+
+def canScanInParallel(utility, container, minimum = None):
+    """
+    Can we look for the locks below `container` in other threads?
+
+      >>> import zope.component
+      >>> import persistent.interfaces
+      >>> import ZODB.interfaces
+      >>> import zope.app.keyreference.interfaces
+      >>> from zope.app.keyreference.persistent import \\
+      ...    KeyReferenceToPersistent, connectionOfPersistent
+      >>> from zope.container.btree import BTreeContainer
+      >>> from zope.locking import utility, tokens
+
+      >>> gsm = zope.component.getGlobalSiteManager()
+      >>> gsm.registerAdapter(KeyReferenceToPersistent,
+      ...    (persistent.interfaces.IPersistent,),
+      ...    zope.app.keyreference.interfaces.IKeyReference)
+      >>> gsm.registerAdapter(connectionOfPersistent,
+      ...    (persistent.interfaces.IPersistent,), ZODB.interfaces.IConnection)
+
+      >>> root = conn.root()
+      >>> folder = root['folder'] = BTreeContainer()
+      >>> for i in range(4):
+      ...     folder['sub%d' % i] = BTreeContainer()
+      >>> folder['sub2']['leaf'] = BTreeContainer()
+      >>> folder['sub2']['free'] = BTreeContainer()
+      >>> util = root['util'] = utility.TokenUtility()
+      >>> transaction.commit()
+
+    The folder is too small to be worth scanning in parallel.
+
+      >>> canScanInParallel(util, folder)
+      False
+      >>> canScanInParallel(util, folder, 2)
+      True
+
+    Nor can we scan content that isn't stored in the database.
+
+      >>> canScanInParallel(util, DemoFolder(), 0)
+      False
+
+    Now lock some of the content.
+
+      >>> token = util.register(
+      ...    tokens.ExclusiveLock(folder['sub1'], 'michael'))
+      >>> token = util.register(
+      ...    tokens.ExclusiveLock(folder['sub2']['leaf'], 'michael'))
+      >>> transaction.commit()
+
+    All the locked objects are found, and they are the objects from the
+    connection of the request.
+
+      >>> found = findLockedDescendants(util, folder, workers = 2)
+      >>> sorted([ob.__name__ for ob in found])
+      [u'leaf', u'sub1']
+      >>> [ob._p_jar is conn for ob in found]
+      [True, True]
+
+    With a single worker everything happens in this thread.
+
+      >>> found = findLockedDescendants(util, folder, workers = 1)
+      >>> sorted([ob.__name__ for ob in found])
+      [u'leaf', u'sub1']
+
+      >>> findLockedDescendants(util, folder['sub3'], workers = 2)
+      []
+
+    The other connections can't see the changes made by the request. The
+    objects they find that the request has unlocked or moved away are not
+    returned.
+
+      >>> util.get(folder['sub1']).end()
+      >>> leaf = folder['sub2']['leaf']
+      >>> del folder['sub2']['leaf']
+      >>> findLockedDescendants(util, folder, workers = 2)
+      []
+      >>> transaction.abort()
+
+    We can stop after finding a number of locked objects.
+
+      >>> len(findLockedDescendants(util, folder, workers = 2, limit = 1))
+      1
+      >>> len(findLockedDescendants(util, folder, workers = 1, limit = 1))
+      1
+
+    We don't look below a locked object, the objects there are covered by
+    the same lock or by locks that conflict with it anyway.
+
+      >>> token = util.register(
+      ...    tokens.ExclusiveLock(folder['sub2'], 'michael'))
+      >>> found = findLockedDescendants(util, folder, workers = 1)
+      >>> sorted([ob.__name__ for ob in found])
+      [u'sub1', u'sub2']
+      >>> transaction.abort()
+
+    Cleanup.
+
+      >>> gsm.unregisterAdapter(KeyReferenceToPersistent,
+      ...    (persistent.interfaces.IPersistent,),
+      ...    zope.app.keyreference.interfaces.IKeyReference)
+      True
+      >>> gsm.unregisterAdapter(connectionOfPersistent,
+      ...    (persistent.interfaces.IPersistent,), ZODB.interfaces.IConnection)
+      True
+
+    """
+    if minimum is None:
+        minimum = MIN_PARALLEL_SIZE
+    if not zope.container.interfaces.IReadContainer.providedBy(container):
+        return False
+
+    jar = getattr(container, "_p_jar", None)
+    if jar is None or getattr(utility, "_p_jar", None) is not jar or \
+           container._p_oid is None or utility._p_oid is None:
+        return False
+
+    size = counters.subtreeSize(container)
+    if size is None:
+        size = len(container)
+    return size >= minimum
+
+
+def findLockedDescendants(utility, container, workers = None, limit = None):
+    """
+    Return all the objects below `container` that already hold a token,
+    checking the items of the container in up to `workers` threads. The
+    subtrees which the subtree lock counts tell us contain no locks are
+    skipped. At most `limit` objects are returned.
+    """
+    if workers is None:
+        workers = WORKERS
+    names = list(container.keys())
+    workers = min(workers, len(names))
+    if workers < 2 or not canScanInParallel(utility, container, 0):
+        return [_traverse(container, path)
+                for path in itertools.islice(
+                    _scanItems(utility, container, names), limit)]
+
+    db = container._p_jar.db()
+    results = []
+    errors = []
+    threads = []
+    for i in range(workers):
+        thread = threading.Thread(
+            target = _scanWorker,
+            args = (db, utility._p_oid, container._p_oid, names[i::workers],
+                    limit, results, errors))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+    found = []
+    for path in results:
+        ob = _traverse(container, path)
+        if ob is not None and utility.get(ob) is not None:
+            found.append(ob)
+    return found[:limit]
+
+
+def _scanWorker(db, utility_oid, container_oid, names, limit,
+                results, errors):
+    tm = transaction.TransactionManager()
+    conn = db.open(transaction_manager = tm)
+    try:
+        try:
+            utility = conn.get(utility_oid)
+            container = conn.get(container_oid)
+            # list.extend is atomic, so the threads can share results.
+            results.extend(list(itertools.islice(
+                _scanItems(utility, container, names), limit)))
+        except:
+            errors.append(sys.exc_info())
+    finally:
+        tm.abort()
+        conn.close()
+
+
+def _scanItems(utility, container, names, path = ()):
+    for name in names:
+        subob = container[name]
+        if counters.subtreeLockCount(utility, subob) == 0:
+            continue
+        subpath = path + (name,)
+        if utility.get(subob) is not None:
+            # The objects below are covered by the same conflicting lock,
+            # or by locks that conflict with it anyway.
+            yield subpath
+            continue
+        if zope.container.interfaces.IReadContainer.providedBy(subob):
+            for found in _scanItems(
+                utility, subob, list(subob.keys()), subpath):
+                yield found
+
+
+def _traverse(container, path):
+    # Returns None if the object has been moved or removed since.
+    ob = container
+    for name in path:
+        ob = ob.get(name, None)
+        if ob is None:
+            return None
+    return ob
@@ -0,0 +1,713 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+An ILockStore keeping the WebDAV locks in a memory mapped table shared by
+the worker processes on one host.
+
+Nothing about the locks is written to the ZODB. The table should be kept
+on a memory backed file system like /dev/shm, where it is lost when the
+host restarts. Use it where losing the locks is acceptable.
+
+The table is made of fixed size rows stored column by column: the kind of
+row, the lock scope and depth, a key hashed from the path or the
+locktoken, the index of the row of the lock root, the expiration time and
+a small data area holding the path, locktoken, principal and owner. The
+rows form an open addressing hash table, so finding the locks on a path
+only reads a few rows. Scanning a column, to find the rows locked against
+a lock root or all the lock roots, is a search through a string.
+
+Changes are made in place while holding a lock on the file, and undone if
+the transaction is aborted. Readers don't take the lock, but use a
+sequence number kept in the header to retry reads that overlap a change.
+This means that the other workers see the changes of a transaction before
+it commits.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import thread
+import threading
+import time
+
+import transaction
+import transaction.interfaces
+import zope.interface
+from ZODB.POSException import ConflictError
+
+import interfaces
+import lockstore
+
+# The default number of rows in the table.
+CAPACITY = 65536
+
+# The size in bytes of the data area of each row.
+DATA_SIZE = 512
+
+# The table is compacted when this fraction of its rows are in use.
+MAX_LOAD = 0.75
+
+MAGIC = "ZDLK"
+
+# magic, capacity, rows used, rows deleted, sequence number
+HEADER = struct.Struct("<4sIIIQ")
+HEADER_SIZE = 64
+SEQUENCE_OFFSET = HEADER.size - 8
+
+# The kinds of rows
+EMPTY, DELETED, ROOT, INDIRECT, TOKEN = range(5)
+
+SCOPES = (None, u"exclusive", u"shared")
+DEPTHS = ("0", "1", "infinity")
+
+COLUMNS = (("kind", "B"), ("scope", "B"), ("depth", "B"), ("key", "8s"),
+           ("root", "i"), ("expires", "d"), ("datalen", "H"),
+           ("data", "%ds" % DATA_SIZE))
+
+def _tableSize(capacity):
+    return HEADER_SIZE + capacity * sum(
+        [struct.calcsize("<" + fmt) for name, fmt in COLUMNS])
+
+
+def _key(prefix, value):
+    return hashlib.md5((prefix + value).encode("utf-8")).digest()[:8]
+
+
+def _encode(fields):
+    data = u"\0".join(fields).encode("utf-8")
+    if len(data) > DATA_SIZE:
+        raise LockTableError("The lock information is too large")
+    return data
+
+
+def _inside(path, subpath):
+    return subpath == path or subpath.startswith(lockstore.joinPath(path, u""))
+
+
+class LockTableError(Exception):
+    """
+    The lock can't be stored in the table.
+    """
+
+
+class SharedMemoryLockStore(object):
+    """
+    All the workers using the same file share the locks.
+
+      >>> import shutil
+      >>> import tempfile
+      >>> import datetime
+      >>> from zope.interface.verify import verifyObject
+
+      >>> tmpdir = tempfile.mkdtemp()
+      >>> filename = os.path.join(tmpdir, 'locks')
+      >>> store = SharedMemoryLockStore(filename, capacity = 32)
+      >>> verifyObject(interfaces.ILockStore, store)
+      True
+
+    The table is created by the first worker to open it, the others use
+    its capacity.
+
+      >>> other = SharedMemoryLockStore(filename)
+      >>> other.capacity
+      32
+
+      >>> def makeLock(locktoken, path, scope = u'exclusive', seconds = 3600,
+      ...              owner = u'Michael'):
+      ...     return lockstore.StoredLock(
+      ...        locktoken, path, scope, 'infinity', owner, 'michael',
+      ...        lockstore.expiresAt(datetime.timedelta(seconds = seconds)))
+
+    The other workers see new locks straight away.
+
+      >>> store.begin()
+      >>> store.addLock(makeLock('token1', u'/a'), [u'/a/b', u'/a/b/c'])
+      >>> [(lock.locktoken, lock.path, lock.scope, lock.depth, lock.owner)
+      ...  for lock in other.getLocks(u'/a/b/c')]
+      [(u'token1', u'/a', u'exclusive', 'infinity', u'Michael')]
+      >>> transaction.commit()
+
+      >>> [path for path, lock in other.getLockedPaths(u'/a')]
+      [u'/a/b', u'/a/b/c']
+      >>> other.countLocks('michael')
+      1
+
+    Aborted changes are undone.
+
+      >>> store.begin()
+      >>> store.addLock(makeLock('token2', u'/d'), [u'/d/e'])
+      >>> store.removeLock('token1')
+      >>> len(other.getLocks(u'/d/e')), len(other.getLocks(u'/a/b'))
+      (1, 0)
+      >>> transaction.abort()
+      >>> len(other.getLocks(u'/d/e')), len(other.getLocks(u'/a/b'))
+      (0, 1)
+
+    Only one transaction can change the locks at a time. The other
+    transaction gets a ConflictError so that the request is retried.
+
+      >>> other.timeout = 0
+      >>> store.begin()
+      >>> other.begin() #doctest:+ELLIPSIS
+      Traceback (most recent call last):
+      ...
+      ConflictError: ...The lock store is busy...
+      >>> transaction.abort()
+
+    Locks move with their resources, and the indirect entries for locks
+    taken out above the old location are removed.
+
+      >>> store.begin()
+      >>> store.addLock(makeLock('token3', u'/a/b/c', u'shared'), [])
+      >>> store.movePath(u'/a/b', u'/e')
+      >>> store.getLocks(u'/a/b')
+      []
+      >>> [lock.path for lock in store.getLocks(u'/e/c')]
+      [u'/e/c']
+      >>> store.refreshLock('token3', None)
+      >>> [lock.expires for lock in other.getLocks(u'/e/c')]
+      [None]
+
+    Removing a resource removes all the locks below it.
+
+      >>> store.removePath(u'/e')
+      >>> store.getLocks(u'/e/c')
+      []
+      >>> [path for path, lock in store.getLockedPaths(u'/')]
+      [u'/a']
+      >>> transaction.commit()
+
+    The indirect entries of a lock move with it when one of the parents of
+    its root is moved.
+
+      >>> store.begin()
+      >>> store.addLock(makeLock('token5', u'/g/h'), [u'/g/h/i', u'/g/h/i/j'])
+      >>> store.movePath(u'/g', u'/k')
+      >>> store.getLocks(u'/g/h/i')
+      []
+      >>> [lock.path for lock in other.getLocks(u'/k/h/i')]
+      [u'/k/h']
+      >>> [lock.path for lock in other.getLocks(u'/k/h/i/j')]
+      [u'/k/h']
+      >>> [path for path, lock in store.getLockedPaths(u'/k')]
+      [u'/k/h', u'/k/h/i', u'/k/h/i/j']
+      >>> transaction.abort()
+
+    Expired locks are never returned.
+
+      >>> store.begin()
+      >>> store.addLock(makeLock('token4', u'/f', seconds = -1), [u'/f/g'])
+      >>> store.getLocks(u'/f/g')
+      []
+      >>> transaction.commit()
+
+    Deleted and expired rows are thrown away when the table fills up.
+
+      >>> for i in range(30):
+      ...     store.begin()
+      ...     store.addLock(makeLock('new%d' % i, u'/new'), [u'/new/sub'])
+      ...     store.removeLock('new%d' % i)
+      ...     transaction.commit()
+      >>> [lock.locktoken for lock in store.getLocks(u'/a')]
+      [u'token1']
+
+    But there is only so much room.
+
+      >>> store.begin()
+      >>> store.addLock(makeLock('big', u'/big'),
+      ...    [u'/big/%d' % i for i in range(30)])
+      Traceback (most recent call last):
+      ...
+      LockTableError: The lock table is full
+      >>> store.addLock(makeLock('long', u'/long', owner = u'x' * 1000), [])
+      Traceback (most recent call last):
+      ...
+      LockTableError: The lock information is too large
+      >>> transaction.abort()
+
+    Cleanup.
+
+      >>> store.close()
+      >>> other.close()
+      >>> shutil.rmtree(tmpdir)
+
+    """
+    zope.interface.implements(interfaces.ILockStore)
+
+    def __init__(self, filename, capacity = CAPACITY, timeout = 5.0):
+        self.filename = filename
+        self.capacity = capacity
+        # Seconds to wait for an other worker to finish changing the locks.
+        self.timeout = timeout
+        self._mutex = threading.Lock()
+        self._writer = None
+        self._undo = None
+        self._open()
+
+    def _open(self):
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            header = os.read(fd, HEADER.size)
+            if len(header) == HEADER.size and header[:4] == MAGIC:
+                self.capacity = HEADER.unpack(header)[1]
+            else:
+                os.ftruncate(fd, _tableSize(self.capacity))
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, HEADER.pack(MAGIC, self.capacity, 0, 0, 0))
+            self._fd = fd
+            self._map = mmap.mmap(fd, _tableSize(self.capacity))
+            self._columns = {}
+            offset = HEADER_SIZE
+            for name, fmt in COLUMNS:
+                fmt = struct.Struct("<" + fmt)
+                self._columns[name] = (offset, fmt)
+                offset += fmt.size * self.capacity
+            if header[:4] != MAGIC:
+                self._clear()
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self._pid = os.getpid()
+
+    def _checkProcess(self):
+        # A forked worker needs its own file descriptor for the file lock.
+        if self._pid != os.getpid():
+            self._map.close()
+            os.close(self._fd)
+            self._mutex = threading.Lock()
+            self._writer = None
+            self._undo = None
+            self._open()
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    # Access to the table
+
+    def _get(self, column, idx):
+        offset, fmt = self._columns[column]
+        return fmt.unpack_from(self._map, offset + idx * fmt.size)[0]
+
+    def _set(self, column, idx, value):
+        offset, fmt = self._columns[column]
+        fmt.pack_into(self._map, offset + idx * fmt.size, value)
+
+    def _row(self, idx):
+        return tuple([self._get(name, idx) for name, fmt in COLUMNS])
+
+    def _setRow(self, idx, row, log = True):
+        if log and self._undo is not None:
+            self._undo.append((idx, self._row(idx)))
+        for (name, fmt), value in zip(COLUMNS, row):
+            self._set(name, idx, value)
+
+    def _data(self, idx):
+        data = self._get("data", idx)[:self._get("datalen", idx)]
+        return data.decode("utf-8").split(u"\0")
+
+    def _counts(self):
+        return HEADER.unpack_from(self._map, 0)[2:4]
+
+    def _setCounts(self, used, deleted):
+        struct.pack_into("<II", self._map, 8, used, deleted)
+
+    def _sequence(self):
+        return struct.unpack_from("<Q", self._map, SEQUENCE_OFFSET)[0]
+
+    def _bumpSequence(self):
+        # The sequence number is odd while the table is being changed.
+        struct.pack_into(
+            "<Q", self._map, SEQUENCE_OFFSET, self._sequence() + 1)
+
+    def _clear(self):
+        offset, fmt = self._columns["kind"]
+        self._map[offset:offset + self.capacity] = chr(EMPTY) * self.capacity
+        offset, fmt = self._columns["root"]
+        self._map[offset:offset + fmt.size * self.capacity] = \
+            fmt.pack(-1) * self.capacity
+        self._setCounts(0, 0)
+
+    def _read(self, func, *args):
+        while True:
+            before = self._sequence()
+            if before % 2:
+                time.sleep(0)
+                continue
+            try:
+                result = func(*args)
+            except Exception:
+                if self._sequence() == before:
+                    raise
+                continue
+            if self._sequence() == before:
+                return result
+
+    def _probe(self, key):
+        idx = struct.unpack("<Q", key)[0] % self.capacity
+        for i in xrange(self.capacity):
+            kind = self._get("kind", idx)
+            if kind == EMPTY:
+                return
+            if kind >= ROOT and self._get("key", idx) == key:
+                yield idx
+            idx = (idx + 1) % self.capacity
+
+    def _iterKind(self, kind):
+        offset, fmt = self._columns["kind"]
+        end = offset + self.capacity
+        pos = self._map.find(chr(kind), offset, end)
+        while pos != -1:
+            yield pos - offset
+            pos = self._map.find(chr(kind), pos + 1, end)
+
+    def _iterIndirect(self, root):
+        # The rows locked against the lock root at `root`.
+        offset, fmt = self._columns["root"]
+        end = offset + fmt.size * self.capacity
+        pattern = fmt.pack(root)
+        pos = self._map.find(pattern, offset, end)
+        while pos != -1:
+            if (pos - offset) % fmt.size == 0:
+                idx = (pos - offset) // fmt.size
+                if self._get("kind", idx) == INDIRECT:
+                    yield idx
+            pos = self._map.find(pattern, pos + 1, end)
+
+    def _findToken(self, locktoken):
+        for idx in self._probe(_key(u"token:", locktoken)):
+            if self._get("kind", idx) == TOKEN and \
+                   self._data(idx)[0] == locktoken:
+                return idx
+        return None
+
+    def _rootOf(self, idx, now):
+        # Returns the index of the active lock root of the row at `idx`.
+        kind = self._get("kind", idx)
+        if kind == INDIRECT:
+            locktoken = self._data(idx)[1]
+            idx = self._get("root", idx)
+            if self._get("kind", idx) != ROOT or \
+                   self._data(idx)[1] != locktoken:
+                return None
+        elif kind != ROOT:
+            return None
+        expires = self._get("expires", idx)
+        if expires and expires <= now:
+            return None
+        return idx
+
+    def _lock(self, idx):
+        fields = self._data(idx)
+        owner = None
+        if len(fields) > 3:
+            owner = fields[3]
+        return lockstore.StoredLock(
+            fields[1], fields[0], SCOPES[self._get("scope", idx)],
+            DEPTHS[self._get("depth", idx)], owner, fields[2],
+            self._get("expires", idx) or None)
+
+    # Reading
+
+    def getLocks(self, path):
+        return self._read(self._getLocks, path)
+
+    def _getLocks(self, path):
+        now = time.time()
+        locks = []
+        for idx in self._probe(_key(u"path:", path)):
+            if self._data(idx)[0] != path:
+                continue
+            root = self._rootOf(idx, now)
+            if root is not None:
+                locks.append(self._lock(root))
+        return locks
+
+    def getLockedPaths(self, path):
+        return iter(self._read(self._getLockedPaths, path))
+
+    def _getLockedPaths(self, path):
+        now = time.time()
+        found = []
+        for kind in (ROOT, INDIRECT):
+            for idx in self._iterKind(kind):
+                subpath = self._data(idx)[0]
+                if subpath == path or not _inside(path, subpath):
+                    continue
+                root = self._rootOf(idx, now)
+                if root is not None:
+                    found.append((subpath, self._lock(root)))
+        found.sort(key = lambda item: item[0])
+        return found
+
+    def countLocks(self, principal_id):
+        return self._read(self._countLocks, principal_id)
+
+    def _countLocks(self, principal_id):
+        now = time.time()
+        count = 0
+        for idx in self._iterKind(ROOT):
+            if self._data(idx)[2] == principal_id and \
+                   self._rootOf(idx, now) is not None:
+                count += 1
+        return count
+
+    # Writing
+
+    def begin(self):
+        if self._writer == thread.get_ident():
+            return
+        self._checkProcess()
+        deadline = time.time() + self.timeout
+        while not self._mutex.acquire(False):
+            if time.time() >= deadline:
+                raise ConflictError("The lock store is busy")
+            time.sleep(0.01)
+        try:
+            while True:
+                try:
+                    fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except IOError:
+                    if time.time() >= deadline:
+                        raise ConflictError("The lock store is busy")
+                    time.sleep(0.01)
+        except:
+            self._mutex.release()
+            raise
+        self._writer = thread.get_ident()
+        self._undo = []
+        self._savedCounts = self._counts()
+        transaction.get().join(SharedMemoryDataManager(self))
+
+    def _finish(self, abort):
+        try:
+            if abort and self._undo:
+                self._bumpSequence()
+                try:
+                    for idx, row in reversed(self._undo):
+                        if idx is None:
+                            start = self._columns["kind"][0]
+                            self._map[start:] = row
+                        else:
+                            self._setRow(idx, row, log = False)
+                    self._setCounts(*self._savedCounts)
+                finally:
+                    self._bumpSequence()
+        finally:
+            self._undo = None
+            self._writer = None
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._mutex.release()
+
+    def _change(self, func, *args):
+        self.begin()
+        self._bumpSequence()
+        try:
+            return func(*args)
+        finally:
+            self._bumpSequence()
+
+    def _makeRoom(self, rows):
+        # Returns True if the table was compacted, which moves the rows.
+        used, deleted = self._counts()
+        limit = self.capacity * MAX_LOAD
+        if used + deleted + rows <= limit:
+            return False
+        self._compact()
+        used, deleted = self._counts()
+        if used + rows > limit:
+            raise LockTableError("The lock table is full")
+        return True
+
+    def _compact(self):
+        now = time.time()
+        roots = [(idx, self._row(idx)) for idx in self._iterKind(ROOT)
+                 if self._rootOf(idx, now) is not None]
+        live = set([idx for idx, row in roots])
+        others = [(idx, self._row(idx))
+                  for kind in (TOKEN, INDIRECT) for idx in self._iterKind(kind)
+                  if self._get("root", idx) in live]
+        if self._undo is not None:
+            start = self._columns["kind"][0]
+            self._undo.append((None, self._map[start:]))
+        self._clear()
+        moved = {}
+        for idx, row in roots:
+            moved[idx] = self._place(row, log = False)
+        for idx, row in others:
+            self._place(row[:4] + (moved[row[4]],) + row[5:], log = False)
+
+    def _place(self, row, log = True):
+        idx = struct.unpack("<Q", row[3])[0] % self.capacity
+        while self._get("kind", idx) >= ROOT:
+            idx = (idx + 1) % self.capacity
+        used, deleted = self._counts()
+        if self._get("kind", idx) == DELETED:
+            deleted -= 1
+        self._setRow(idx, row, log)
+        self._setCounts(used + 1, deleted)
+        return idx
+
+    def _insert(self, kind, key, root, fields, scope = 0, depth = 0,
+                expires = 0.0):
+        data = _encode(fields)
+        return self._place(
+            (kind, scope, depth, key, root, expires, len(data), data))
+
+    def _delete(self, idx):
+        self._setRow(idx, (DELETED, 0, 0, "\0" * 8, -1, 0.0, 0, ""))
+        used, deleted = self._counts()
+        self._setCounts(used - 1, deleted + 1)
+
+    def addLock(self, lock, paths):
+        self._change(self._addLock, lock, list(paths))
+
+    def _addLock(self, lock, paths):
+        fields = [lock.path, lock.locktoken, lock.principal_id]
+        if lock.owner is not None:
+            fields.append(lock.owner)
+        self._makeRoom(2 + len(paths))
+        root = self._insert(
+            ROOT, _key(u"path:", lock.path), -1, fields,
+            SCOPES.index(lock.scope), DEPTHS.index(lock.depth),
+            lock.expires or 0.0)
+        self._insert(TOKEN, _key(u"token:", lock.locktoken), root,
+                     [lock.locktoken])
+        for path in paths:
+            self._insert(INDIRECT, _key(u"path:", path), root,
+                         [path, lock.locktoken])
+
+    def addIndirect(self, locktoken, paths):
+        self._change(self._addIndirect, locktoken, list(paths))
+
+    def _addIndirect(self, locktoken, paths):
+        self._makeRoom(len(paths))
+        token = self._findToken(locktoken)
+        if token is None:
+            return
+        root = self._get("root", token)
+        for path in paths:
+            for idx in self._probe(_key(u"path:", path)):
+                if self._get("kind", idx) == INDIRECT and \
+                       self._data(idx) == [path, locktoken]:
+                    break
+            else:
+                self._insert(INDIRECT, _key(u"path:", path), root,
+                             [path, locktoken])
+
+    def refreshLock(self, locktoken, expires):
+        self._change(self._refreshLock, locktoken, expires)
+
+    def _refreshLock(self, locktoken, expires):
+        token = self._findToken(locktoken)
+        if token is not None:
+            root = self._get("root", token)
+            row = self._row(root)
+            self._setRow(root, row[:5] + (expires or 0.0,) + row[6:])
+
+    def removeLock(self, locktoken):
+        self._change(self._removeLock, locktoken)
+
+    def _removeLock(self, locktoken):
+        token = self._findToken(locktoken)
+        if token is None:
+            return
+        root = self._get("root", token)
+        for idx in list(self._iterIndirect(root)):
+            self._delete(idx)
+        self._delete(token)
+        self._delete(root)
+
+    def movePath(self, oldpath, newpath, keep = ()):
+        self._change(self._movePath, oldpath, newpath, keep)
+
+    def _rowsInside(self, path):
+        return [idx for kind in (ROOT, INDIRECT)
+                for idx in self._iterKind(kind)
+                if _inside(path, self._data(idx)[0])]
+
+    def _movePath(self, oldpath, newpath, keep):
+        self._makeRoom(len(self._rowsInside(oldpath)))
+        rows = self._rowsInside(oldpath)
+        # Find the indirect rows inherited from the old parents before the
+        # lock roots below `oldpath` are moved to `newpath`.
+        inherited = set([
+            idx for idx in rows
+            if self._get("kind", idx) == INDIRECT and
+               self._data(idx)[1] not in keep and
+               not _inside(oldpath, self._data(self._get("root", idx))[0])])
+        for idx in rows:
+            if idx in inherited:
+                self._delete(idx)
+                continue
+            row = self._row(idx)
+            fields = self._data(idx)
+            fields[0] = newpath + fields[0][len(oldpath):]
+            data = _encode(fields)
+            self._delete(idx)
+            newidx = self._place(row[:3] + (_key(u"path:", fields[0]),) +
+                                 row[4:6] + (len(data), data))
+            if row[0] == ROOT:
+                # Point the locktoken and indirect rows at the new row.
+                for subidx in list(self._iterIndirect(idx)) + \
+                        [self._findToken(fields[1])]:
+                    subrow = self._row(subidx)
+                    self._setRow(subidx, subrow[:4] + (newidx,) + subrow[5:])
+
+    def removePath(self, path):
+        self._change(self._removePath, path)
+
+    def _removePath(self, path):
+        for idx in self._rowsInside(path):
+            kind = self._get("kind", idx)
+            if kind == ROOT:
+                self._removeLock(self._data(idx)[1])
+            elif kind == INDIRECT:
+                self._delete(idx)
+
+
+class SharedMemoryDataManager(object):
+    """
+    Undoes the changes made to the table if the transaction is aborted, and
+    lets the other workers change it once the transaction is over.
+    """
+    zope.interface.implements(transaction.interfaces.IDataManager)
+
+    def __init__(self, store):
+        self.store = store
+        self.transaction_manager = transaction.manager
+
+    def abort(self, txn):
+        self.store._finish(True)
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        pass
+
+    def tpc_finish(self, txn):
+        self.store._finish(False)
+
+    def tpc_abort(self, txn):
+        self.store._finish(True)
+
+    def sortKey(self):
+        return "~z3c.davapp.zopelocking.sharedstore:%s" % self.store.filename
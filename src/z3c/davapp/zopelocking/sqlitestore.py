@@ -0,0 +1,365 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+An ILockStore keeping the WebDAV locks in a local SQLite database.
+
+Lock roots live in the `locks` table and the resources locked by a depth
+infinity lock get a row each in the `indirect` table. Both are indexed by
+path, and the lock roots also by principal and expiration time.
+
+The first change made by a transaction starts an immediate SQLite
+transaction, which stops other processes changing the locks, and joins a
+data manager to the ZODB transaction. All the changes are committed to
+SQLite in one go when the ZODB transaction votes.
+"""
+
+import sqlite3
+import threading
+import time
+
+import transaction
+import transaction.interfaces
+import zope.interface
+from ZODB.POSException import ConflictError
+
+import interfaces
+import lockstore
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS locks (
+    locktoken TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    depth TEXT NOT NULL,
+    owner TEXT,
+    principal_id TEXT NOT NULL,
+    expires REAL
+);
+CREATE INDEX IF NOT EXISTS locks_path ON locks (path);
+CREATE INDEX IF NOT EXISTS locks_principal_id ON locks (principal_id);
+CREATE INDEX IF NOT EXISTS locks_expires ON locks (expires);
+CREATE TABLE IF NOT EXISTS indirect (
+    path TEXT NOT NULL,
+    locktoken TEXT NOT NULL,
+    PRIMARY KEY (path, locktoken)
+);
+CREATE INDEX IF NOT EXISTS indirect_locktoken ON indirect (locktoken);
+"""
+
+COLUMNS = "l.locktoken, l.path, l.scope, l.depth, l.owner, " \
+          "l.principal_id, l.expires"
+
+ACTIVE = "(l.expires IS NULL OR l.expires > ?)"
+
+class SQLiteLockStore(object):
+    """
+    Each thread uses its own connection to the database.
+
+      >>> import os.path
+      >>> import shutil
+      >>> import tempfile
+      >>> import datetime
+      >>> from zope.interface.verify import verifyObject
+
+      >>> tmpdir = tempfile.mkdtemp()
+      >>> filename = os.path.join(tmpdir, 'locks.db')
+      >>> store = SQLiteLockStore(filename)
+      >>> verifyObject(interfaces.ILockStore, store)
+      True
+
+    A second store using the same database file stands in for an other
+    process.
+
+      >>> other = SQLiteLockStore(filename)
+
+      >>> def makeLock(locktoken, path, scope = u'exclusive', seconds = 3600):
+      ...     return lockstore.StoredLock(
+      ...        locktoken, path, scope, 'infinity', u'Michael', 'michael',
+      ...        lockstore.expiresAt(datetime.timedelta(seconds = seconds)))
+
+    Changes are visible to other processes once the transaction is
+    committed.
+
+      >>> store.begin()
+      >>> store.addLock(makeLock('token1', u'/a'), [u'/a/b', u'/a/b/c'])
+      >>> [lock.locktoken for lock in store.getLocks(u'/a/b/c')]
+      [u'token1']
+      >>> other.getLocks(u'/a/b/c')
+      []
+
+      >>> transaction.commit()
+      >>> [lock.locktoken for lock in other.getLocks(u'/a/b/c')]
+      [u'token1']
+      >>> [path for path, lock in other.getLockedPaths(u'/a')]
+      [u'/a/b', u'/a/b/c']
+      >>> other.countLocks('michael')
+      1
+
+    Aborted changes are thrown away.
+
+      >>> store.begin()
+      >>> store.addLock(makeLock('token2', u'/d'), [])
+      >>> len(store.getLocks(u'/d'))
+      1
+      >>> transaction.abort()
+      >>> store.getLocks(u'/d')
+      []
+
+    Only one transaction can change the locks at a time. The other
+    transaction gets a ConflictError so that the request is retried.
+
+      >>> other.timeout = 0
+      >>> store.begin()
+      >>> other.begin() #doctest:+ELLIPSIS
+      Traceback (most recent call last):
+      ...
+      ConflictError: ...The lock store is busy...
+      >>> transaction.abort()
+
+    Locks move with their resources, and the indirect entries for locks
+    taken out above the old location are removed.
+
+      >>> store.begin()
+      >>> store.addLock(makeLock('token3', u'/a/b/c', u'shared'), [])
+      >>> store.movePath(u'/a/b', u'/e')
+      >>> store.getLocks(u'/a/b')
+      []
+      >>> [lock.path for lock in store.getLocks(u'/e/c')]
+      [u'/e/c']
+      >>> transaction.commit()
+
+    Removing a resource removes all the locks below it.
+
+      >>> store.begin()
+      >>> store.removePath(u'/e')
+      >>> store.getLocks(u'/e/c')
+      []
+      >>> [path for path, lock in store.getLockedPaths(u'/')]
+      [u'/a']
+      >>> transaction.commit()
+
+    Expired locks are never returned, and they are deleted by the next
+    transaction to change the store.
+
+      >>> store.begin()
+      >>> store.addLock(makeLock('token4', u'/f', seconds = -1), [u'/f/g'])
+      >>> store.getLocks(u'/f/g')
+      []
+      >>> transaction.commit()
+      >>> store.begin()
+      >>> store._connection().execute(
+      ...    'SELECT COUNT(*) FROM indirect').fetchone()[0]
+      0
+      >>> transaction.commit()
+
+    Cleanup.
+
+      >>> store.close()
+      >>> other.close()
+      >>> shutil.rmtree(tmpdir)
+
+    """
+    zope.interface.implements(interfaces.ILockStore)
+
+    def __init__(self, filename, timeout = 5.0):
+        self.filename = filename
+        # Seconds to wait for an other process to finish changing the locks.
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # We manage the SQLite transactions ourselves.
+            connection = sqlite3.connect(
+                self.filename, timeout = self.timeout,
+                isolation_level = None, check_same_thread = False)
+            # Readers don't block the writer.
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+        return connection
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def begin(self):
+        if getattr(self._local, "datamanager", None) is not None:
+            return
+        connection = self._connection()
+        connection.execute("PRAGMA busy_timeout = %d" %(self.timeout * 1000))
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError:
+            raise ConflictError("The lock store is busy")
+        datamanager = SQLiteDataManager(self, connection)
+        transaction.get().join(datamanager)
+        self._local.datamanager = datamanager
+
+        # We hold the write lock so this is a good time to throw away the
+        # locks that have expired.
+        now = time.time()
+        connection.execute(
+            "DELETE FROM indirect WHERE locktoken IN "
+            "(SELECT locktoken FROM locks WHERE expires <= ?)", (now,))
+        connection.execute("DELETE FROM locks WHERE expires <= ?", (now,))
+
+    def _finished(self, datamanager):
+        if getattr(self._local, "datamanager", None) is datamanager:
+            self._local.datamanager = None
+
+    def getLocks(self, path):
+        now = time.time()
+        cursor = self._connection().execute(
+            "SELECT %s FROM locks l WHERE l.path = ? AND %s "
+            "UNION ALL "
+            "SELECT %s FROM indirect i JOIN locks l "
+            "ON l.locktoken = i.locktoken WHERE i.path = ? AND %s" %(
+                COLUMNS, ACTIVE, COLUMNS, ACTIVE),
+            (path, now, path, now))
+        return [lockstore.StoredLock(*row) for row in cursor]
+
+    def getLockedPaths(self, path):
+        low, high = _subtree(path)
+        now = time.time()
+        cursor = self._connection().execute(
+            "SELECT l.path, %s FROM locks l "
+            "WHERE l.path >= ? AND l.path < ? AND l.path != ? AND %s "
+            "UNION ALL "
+            "SELECT i.path, %s FROM indirect i JOIN locks l "
+            "ON l.locktoken = i.locktoken "
+            "WHERE i.path >= ? AND i.path < ? AND i.path != ? AND %s "
+            "ORDER BY 1" %(COLUMNS, ACTIVE, COLUMNS, ACTIVE),
+            (low, high, path, now, low, high, path, now))
+        for row in cursor:
+            yield row[0], lockstore.StoredLock(*row[1:])
+
+    def countLocks(self, principal_id):
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM locks l WHERE l.principal_id = ? AND %s" %(
+                ACTIVE,), (principal_id, time.time())).fetchone()[0]
+
+    def addLock(self, lock, paths):
+        connection = self._connection()
+        connection.execute(
+            "INSERT INTO locks VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (lock.locktoken, lock.path, lock.scope, lock.depth, lock.owner,
+             lock.principal_id, lock.expires))
+        self.addIndirect(lock.locktoken, paths)
+
+    def addIndirect(self, locktoken, paths):
+        self._connection().executemany(
+            "INSERT OR IGNORE INTO indirect VALUES (?, ?)",
+            ((path, locktoken) for path in paths))
+
+    def refreshLock(self, locktoken, expires):
+        self._connection().execute(
+            "UPDATE locks SET expires = ? WHERE locktoken = ?",
+            (expires, locktoken))
+
+    def removeLock(self, locktoken):
+        connection = self._connection()
+        connection.execute(
+            "DELETE FROM indirect WHERE locktoken = ?", (locktoken,))
+        connection.execute(
+            "DELETE FROM locks WHERE locktoken = ?", (locktoken,))
+
+    def movePath(self, oldpath, newpath, keep = ()):
+        connection = self._connection()
+        low, high = _subtree(oldpath)
+        inside = "(path = ? OR (path >= ? AND path < ?))"
+        # Forget the locks inherited from the old parents.
+        query = "DELETE FROM indirect WHERE %s AND locktoken NOT IN " \
+                "(SELECT locktoken FROM locks WHERE %s)" %(inside, inside)
+        if keep:
+            query += " AND locktoken NOT IN (%s)" %(", ".join("?" * len(keep)))
+        connection.execute(
+            query, (oldpath, low, high, oldpath, low, high) + tuple(keep))
+        for table in ("locks", "indirect"):
+            connection.execute(
+                "UPDATE OR REPLACE %s SET path = ? || substr(path, ?) "
+                "WHERE %s" %(table, inside),
+                (newpath, len(oldpath) + 1, oldpath, low, high))
+
+    def removePath(self, path):
+        connection = self._connection()
+        low, high = _subtree(path)
+        inside = "(path = ? OR (path >= ? AND path < ?))"
+        connection.execute(
+            "DELETE FROM indirect WHERE locktoken IN "
+            "(SELECT locktoken FROM locks WHERE %s)" % inside,
+            (path, low, high))
+        connection.execute(
+            "DELETE FROM locks WHERE %s" % inside, (path, low, high))
+        connection.execute(
+            "DELETE FROM indirect WHERE %s" % inside, (path, low, high))
+
+
+def _subtree(path):
+    # All the paths below `path` sort between these two values, as "0" is
+    # the character after "/".
+    if not path.endswith(u"/"):
+        path += u"/"
+    return path, path[:-1] + u"0"
+
+
+class SQLiteDataManager(object):
+    """
+    Commits the SQLite transaction with the ZODB transaction.
+
+    SQLite can't prepare a transaction, so it is committed when the ZODB
+    transaction votes. The sort key makes sure that this happens after all
+    the other data managers have voted, leaving only the ZODB's `tpc_finish`
+    which doesn't fail.
+    """
+    zope.interface.implements(transaction.interfaces.IDataManager)
+
+    def __init__(self, store, connection):
+        self.store = store
+        self.connection = connection
+        self.transaction_manager = transaction.manager
+        self._committed = False
+
+    def _rollback(self):
+        if not self._committed:
+            self.connection.execute("ROLLBACK")
+        self.store._finished(self)
+
+    def abort(self, txn):
+        self._rollback()
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        try:
+            self.connection.execute("COMMIT")
+        except sqlite3.OperationalError:
+            raise ConflictError("Unable to commit the lock store")
+        self._committed = True
+
+    def tpc_finish(self, txn):
+        self.store._finished(self)
+
+    def tpc_abort(self, txn):
+        self._rollback()
+
+    def sortKey(self):
+        return "~z3c.davapp.zopelocking.sqlitestore:%s" % self.store.filename
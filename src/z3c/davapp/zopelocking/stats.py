@@ -0,0 +1,481 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Statistics of the lock table, read from counters maintained as the locks
+change so that they can be polled without walking the tokens.
+
+The counters are kept on the token utility once the first lock root has
+started: the number of lock roots of each scope, the number of lock roots
+started and expiring in each minute, the number of shared lock roots held
+by each number of WebDAV locks, and the lock roots ordered by their number
+of indirect tokens. Each lock root remembers what it was counted as in its
+annotations, and is removed from the counters when the indirect tokens of
+the ended lock are cleaned up. Locks that time out are only removed once
+they have been swept, until then they are counted as expired. Like the
+other counters, these are approximate.
+"""
+
+import calendar
+import itertools
+import time
+
+from BTrees.Length import Length
+from BTrees.IOBTree import IOBTree
+from BTrees.OOBTree import OOBTree
+import zope.component
+import zope.locking.interfaces
+import zope.publisher.browser
+import zope.traversing.api
+from zope.app.keyreference.interfaces import IKeyReference
+
+import interfaces
+import counters
+
+STATS_KEY = "_z3c_davapp_lockstats"
+ROOT_STATS_KEY = "z3c.davapp.zopelocking.lockstats"
+
+# The upper bounds, in seconds, of the age distribution.
+AGES = (60, 600, 3600, 86400)
+
+def _minutes(value, roundup = False):
+    if value is None:
+        return None
+    seconds = calendar.timegm(value.utctimetuple())
+    if roundup:
+        return int(-(-seconds // 60))
+    return int(seconds // 60)
+
+
+def _changeCount(tree, key, delta):
+    # The counters are never deleted here, since a concurrent change to a
+    # deleted counter would be lost. `pruneExpired` forgets the minutes
+    # without locks.
+    if key is None or not delta:
+        return
+    counter = tree.get(key, None)
+    if counter is None:
+        if delta > 0:
+            tree[key] = Length(delta)
+    else:
+        counter.change(delta)
+
+
+def _scope(token):
+    if zope.locking.interfaces.IExclusiveLock.providedBy(token):
+        return u"exclusive"
+    if zope.locking.interfaces.ISharedLock.providedBy(token):
+        return u"shared"
+    return u"other"
+
+
+def _add(table, token, holders, indirect):
+    # record: (scope, started, expires, holders, indirect tokens)
+    record = (_scope(token), _minutes(token.started),
+              _minutes(token.expiration, roundup = True), holders, indirect)
+    scope, started, expires, holders, indirect = record
+    _changeCount(table["scopes"], scope, 1)
+    _changeCount(table["started"], started, 1)
+    _changeCount(table["expires"], expires, 1)
+    if expires is not None:
+        expiring = table["expiring"].get(expires, None)
+        if expiring is None:
+            expiring = table["expiring"][expires] = OOBTree()
+        expiring[IKeyReference(token.context)] = token
+    _changeCount(table["holders"], holders or None, 1)
+    if indirect:
+        table["largest"][(-indirect, IKeyReference(token.context))] = token
+    token.annotations[ROOT_STATS_KEY] = record
+
+
+def _remove(table, token):
+    record = token.annotations.get(ROOT_STATS_KEY, None)
+    if record is None:
+        return None
+    scope, started, expires, holders, indirect = record
+    _changeCount(table["scopes"], scope, -1)
+    _changeCount(table["started"], started, -1)
+    _changeCount(table["expires"], expires, -1)
+    if expires is not None:
+        expiring = table["expiring"].get(expires, None)
+        key_ref = IKeyReference(token.context)
+        if expiring is not None and key_ref in expiring:
+            del expiring[key_ref]
+    _changeCount(table["holders"], holders or None, -1)
+    if indirect:
+        key = (-indirect, IKeyReference(token.context))
+        if key in table["largest"]:
+            del table["largest"][key]
+    del token.annotations[ROOT_STATS_KEY]
+    return record
+
+
+def _table(token):
+    return getattr(token.utility, STATS_KEY, None)
+
+
+def isCollecting(utility):
+    return getattr(utility, STATS_KEY, None) is not None
+
+
+def startCollecting(utility):
+    """
+    Start maintaining the statistics of `utility`, counting the lock roots
+    already registered. This walks every token.
+    """
+    table = OOBTree()
+    for name in ("scopes", "largest"):
+        table[name] = OOBTree()
+    for name in ("started", "expires", "expiring", "holders"):
+        table[name] = IOBTree()
+    for token in utility:
+        if not interfaces.IIndirectToken.providedBy(token):
+            if ROOT_STATS_KEY in token.annotations:
+                del token.annotations[ROOT_STATS_KEY]
+            holders = 0
+            if zope.locking.interfaces.ISharedLock.providedBy(token):
+                holders = len(token.principal_ids)
+            _add(table, token, holders, 0)
+    setattr(utility, STATS_KEY, table)
+
+
+def changeHolders(roottoken, holders):
+    """
+    The shared lock `roottoken` is now held by `holders` WebDAV locks.
+    """
+    table = _table(roottoken)
+    record = roottoken.annotations.get(ROOT_STATS_KEY, None)
+    if table is None or record is None or record[3] == holders:
+        return
+    _changeCount(table["holders"], record[3] or None, -1)
+    _changeCount(table["holders"], holders or None, 1)
+    roottoken.annotations[ROOT_STATS_KEY] = record[:3] + (holders, record[4])
+
+
+def changeIndirectTokens(roottoken, delta):
+    """
+    `delta` indirect tokens have been registered for `roottoken`.
+    """
+    table = _table(roottoken)
+    record = roottoken.annotations.get(ROOT_STATS_KEY, None)
+    if table is None or record is None or not delta:
+        return
+    key_ref = IKeyReference(roottoken.context)
+    indirect = record[4]
+    if indirect and (-indirect, key_ref) in table["largest"]:
+        del table["largest"][(-indirect, key_ref)]
+    indirect = max(indirect + delta, 0)
+    if indirect:
+        table["largest"][(-indirect, key_ref)] = roottoken
+    roottoken.annotations[ROOT_STATS_KEY] = record[:4] + (indirect,)
+
+
+def removeIndirectTokens(roottoken, ob):
+    """
+    `ob` and its descendants, which held indirect tokens of `roottoken`,
+    have been moved out of the lock or removed.
+    """
+    table = _table(roottoken)
+    record = roottoken.annotations.get(ROOT_STATS_KEY, None)
+    if table is None or record is None or not record[4]:
+        return
+    # There can't be more than the tokens counted, so stop counting there.
+    count = 1 + counters.countDescendants(ob, record[4])
+    changeIndirectTokens(roottoken, -count)
+
+
+def removeToken(roottoken):
+    """
+    Stop counting the ended lock `roottoken`.
+    """
+    table = _table(roottoken)
+    if table is not None:
+        _remove(table, roottoken)
+
+
+def pruneExpired(utility, when = None):
+    """
+    Stop counting the lock roots of `utility` that have timed out, which
+    nobody is told about, and forget the past minutes without locks.
+    Returns how many lock roots were removed.
+    """
+    table = getattr(utility, STATS_KEY, None)
+    if table is None:
+        return 0
+    if when is None:
+        when = time.time()
+    now = int(when // 60)
+    removed = 0
+    for minute in list(table["expiring"].keys(max = now)):
+        for token in list(table["expiring"][minute].values()):
+            if token.ended:
+                _remove(table, token)
+                removed += 1
+    # Nothing starts or expires in a past minute any more, so its counter
+    # can't change concurrently. The minute before is left alone in case
+    # the clocks of the clients differ a little.
+    for name in ("started", "expires"):
+        tree = table[name]
+        for minute, counter in list(tree.items(max = now - 2)):
+            if counter() <= 0:
+                del tree[minute]
+    for minute, expiring in list(table["expiring"].items(max = now - 2)):
+        if not expiring:
+            del table["expiring"][minute]
+    return removed
+
+
+@zope.component.adapter(zope.locking.interfaces.ITokenStartedEvent)
+def addStartedToken(event):
+    """subscriber handler for ITokenStartedEvent"""
+    token = event.object
+    if interfaces.IIndirectToken.providedBy(token):
+        return
+    table = _table(token)
+    if table is None:
+        # The token has already been registered so it is counted.
+        startCollecting(token.utility)
+        return
+    holders = 0
+    if zope.locking.interfaces.ISharedLock.providedBy(token):
+        holders = len(token.principal_ids)
+    _add(table, token, holders, 0)
+
+
+@zope.component.adapter(zope.locking.interfaces.IEndableToken,
+                        zope.locking.interfaces.IExpirationChangedEvent)
+def changeExpiration(object, event):
+    """subscriber handler for IExpirationChangedEvent"""
+    token = event.object
+    if interfaces.IIndirectToken.providedBy(token) or token.utility is None:
+        return
+    table = _table(token)
+    if table is None:
+        return
+    record = _remove(table, token)
+    if record is not None:
+        _add(table, token, record[3], record[4])
+
+
+def lockStatistics(utility, top = 10, when = None):
+    """
+    The statistics of the locks registered with `utility`, or None if they
+    are not being collected yet. This reads a handful of objects and never
+    writes to the database.
+
+      >>> import datetime
+      >>> import zope.interface
+      >>> from zope.locking import utility
+      >>> from zope.locking.adapters import TokenBroker
+      >>> from zope.annotation.interfaces import IAttributeAnnotatable
+      >>> from zope.annotation.attribute import AttributeAnnotations
+      >>> from zope.publisher.browser import TestRequest
+      >>> from manager import DAVLockmanager
+      >>> from indirecttokens import removeEndedTokens, sweepExpiredTokens
+
+      >>> util = utility.TokenUtility()
+      >>> conn.add(util) # add to persistent database
+      >>> gsm = zope.component.getGlobalSiteManager()
+      >>> gsm.registerUtility(util, zope.locking.interfaces.ITokenUtility)
+      >>> gsm.registerAdapter(TokenBroker, (zope.interface.Interface,),
+      ...    zope.locking.interfaces.ITokenBroker)
+      >>> gsm.registerAdapter(AttributeAnnotations)
+      >>> gsm.registerHandler(addStartedToken)
+      >>> gsm.registerHandler(changeExpiration)
+      >>> gsm.registerHandler(removeEndedTokens)
+
+      >>> class Folder(DemoFolder):
+      ...     zope.interface.implements(IAttributeAnnotatable)
+      >>> folder = Folder(None, u'folder')
+      >>> folder['sub'] = Folder()
+      >>> folder['sub']['file'] = Demo()
+      >>> folder['file'] = Demo()
+      >>> other = Demo()
+      >>> other.__name__ = u'other'
+
+      >>> lockStatistics(util) is None
+      True
+
+    We take out a depth infinity lock on the folder, and two shared locks
+    on another resource.
+
+      >>> hour = datetime.timedelta(seconds = 3600)
+      >>> locktoken = DAVLockmanager(folder).lock(u'exclusive', u'write',
+      ...    u'Michael', hour, 'infinity')
+      >>> shared1 = DAVLockmanager(other).lock(u'shared', u'write',
+      ...    u'Michael', hour, '0')
+      >>> shared2 = DAVLockmanager(other).lock(u'shared', u'write',
+      ...    u'Michael', hour, '0')
+
+      >>> stats = lockStatistics(util)
+      >>> sorted(stats['roots'].items())
+      [(u'exclusive', 1), (u'shared', 1)]
+      >>> stats['expired']
+      0
+      >>> stats['fanout']
+      {2: 1}
+      >>> stats['ages']
+      [(60, 2), (600, 0), (3600, 0), (86400, 0), (None, 0)]
+      >>> [(token.context.__name__, count)
+      ...  for token, count in stats['largest']]
+      [(u'folder', 3)]
+
+    The indirect tokens of the objects moved out of the lock or removed are
+    no longer counted.
+
+      >>> removeIndirectTokens(util.get(folder), folder['sub'])
+      >>> [(token.context.__name__, count)
+      ...  for token, count in lockStatistics(util)['largest']]
+      [(u'folder', 1)]
+
+    Two hours from now both locks have expired, which is counted until they
+    are swept.
+
+      >>> later = time.time() + 7200
+      >>> lockStatistics(util, when = later)['expired']
+      2
+      >>> stats = lockStatistics(util, when = later)
+      >>> stats['ages']
+      [(60, 0), (600, 0), (3600, 0), (86400, 2), (None, 0)]
+
+    Unlocking removes the lock from the statistics.
+
+      >>> DAVLockmanager(other).unlock(shared2)
+      >>> lockStatistics(util)['fanout']
+      {1: 1}
+      >>> DAVLockmanager(other).unlock(shared1)
+      >>> DAVLockmanager(folder).unlock(locktoken)
+      >>> stats = lockStatistics(util)
+      >>> sorted(stats['roots'].items())
+      [(u'exclusive', 0), (u'shared', 0)]
+      >>> stats['fanout'], stats['largest']
+      ({}, [])
+
+    The counters of the minutes without locks are kept when the locks are
+    removed, so that they don't conflict with the locks started or removed
+    concurrently.
+
+      >>> table = getattr(util, STATS_KEY)
+      >>> [counter() for counter in table['started'].values()]
+      [0]
+
+    Locks that time out are forgotten when swept.
+
+      >>> locktoken = DAVLockmanager(folder).lock(u'exclusive', u'write',
+      ...    u'Michael', datetime.timedelta(seconds = 0), '0')
+      >>> lockStatistics(util, when = later)['expired']
+      1
+      >>> pruneExpired(util, when = later)
+      1
+      >>> lockStatistics(util, when = later)['expired']
+      0
+
+    It also forgets the minutes without locks.
+
+      >>> len(table['started']), len(table['expires']), len(table['expiring'])
+      (0, 0, 0)
+
+    The statistics can also be viewed as text.
+
+      >>> print LockStatisticsView(util, TestRequest())()
+      roots exclusive 0
+      roots shared 0
+      expired 0
+      age<=60s 0
+      age<=600s 0
+      age<=3600s 0
+      age<=86400s 0
+      age>86400s 0
+
+    Cleanup.
+
+      >>> gsm.unregisterUtility(util, zope.locking.interfaces.ITokenUtility)
+      True
+      >>> gsm.unregisterAdapter(TokenBroker, (zope.interface.Interface,),
+      ...    zope.locking.interfaces.ITokenBroker)
+      True
+      >>> gsm.unregisterAdapter(AttributeAnnotations)
+      True
+      >>> gsm.unregisterHandler(addStartedToken)
+      True
+      >>> gsm.unregisterHandler(changeExpiration)
+      True
+      >>> gsm.unregisterHandler(removeEndedTokens)
+      True
+
+    """
+    table = getattr(utility, STATS_KEY, None)
+    if table is None:
+        return None
+    if when is None:
+        when = time.time()
+
+    now = int(when // 60)
+    ages = [0] * (len(AGES) + 1)
+    for minute, counter in table["started"].items():
+        # in whole minutes
+        age = (now - minute) * 60
+        for i, bound in enumerate(AGES):
+            if age <= bound:
+                break
+        else:
+            i = len(AGES)
+        ages[i] += counter()
+
+    return {
+        "roots": dict([(scope, counter())
+                       for scope, counter in table["scopes"].items()]),
+        "expired": sum([counter() for counter in
+                        table["expires"].values(max = now)]),
+        "fanout": dict([(holders, counter())
+                        for holders, counter in table["holders"].items()
+                        if counter()]),
+        "ages": zip(AGES + (None,), ages),
+        "largest": [(token, -count) for (count, key_ref), token in
+                    itertools.islice(table["largest"].items(), top)],
+        }
+
+
+def _path(ob):
+    try:
+        return zope.traversing.api.getPath(ob)
+    except TypeError:
+        # Not located
+        return repr(ob)
+
+
+class LockStatisticsView(zope.publisher.browser.BrowserPage):
+    """
+    The lock statistics of the token utility as text, one "name value"
+    pair on each line, for monitoring.
+    """
+
+    def __call__(self):
+        self.request.response.setHeader("content-type", "text/plain")
+        stats = lockStatistics(self.context)
+        if stats is None:
+            return u"Not collected yet, no lock has been taken out.\n"
+        lines = []
+        for scope, count in sorted(stats["roots"].items()):
+            lines.append(u"roots %s %d" % (scope, count))
+        lines.append(u"expired %d" % stats["expired"])
+        for holders, count in sorted(stats["fanout"].items()):
+            lines.append(u"shared holders=%d %d" % (holders, count))
+        for bound, count in stats["ages"]:
+            if bound is None:
+                lines.append(u"age>%ds %d" % (AGES[-1], count))
+            else:
+                lines.append(u"age<=%ds %d" % (bound, count))
+        for token, count in stats["largest"]:
+            lines.append(u"indirect %s %d" % (_path(token.context), count))
+        return u"\n".join(lines)
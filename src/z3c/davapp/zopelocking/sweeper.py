@@ -0,0 +1,219 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Defer the clean up of ended tokens out of read requests.
+
+Removing the indirect tokens of an ended lock writes to the database. If
+this happens during a GET or PROPFIND request then the read turns into a
+write transaction that can conflict with other requests. When
+`STRICT_READS` is set, the clean up is queued instead and done by the next
+request that writes to the token utility, or by calling
+`indirecttokens.flushDeferredCleanups` from a sweeper. The ended tokens are
+already treated as unlocked so nothing else needs to wait for the clean up.
+
+The queue is kept in memory for each process, so a queued clean up can be
+lost when the process is restarted. This only leaves some ended indirect
+tokens in the index of their lock root until the token utility itself
+cleans out its expired tokens.
+"""
+
+import weakref
+
+import zope.security.management
+import zope.publisher.interfaces.http
+
+import interfaces
+
+# Methods that should never write to the database.
+READ_METHODS = ("GET", "HEAD", "OPTIONS", "PROPFIND", "REPORT")
+
+# Queue the clean up of tokens ending in read requests.
+STRICT_READS = False
+
+# The queue doesn't grow beyond this number of tokens.
+MAX_QUEUED = 10000
+
+# (database name, oid of the lock root) -> True
+_queue = {}
+
+# transaction -> (set of the (utility oid, key) looked at, keys to dequeue)
+_flushed = weakref.WeakKeyDictionary()
+
+def isReadRequest():
+    interaction = zope.security.management.queryInteraction()
+    if interaction is None:
+        return False
+    for participation in interaction.participations:
+        if zope.publisher.interfaces.http.IHTTPRequest.providedBy(
+            participation) and participation.method in READ_METHODS:
+            return True
+    return False
+
+
+def _key(token):
+    jar = getattr(token, "_p_jar", None)
+    oid = getattr(token, "_p_oid", None)
+    if jar is None or oid is None:
+        return None
+    return jar.db().database_name, oid
+
+
+def deferCleanup(token):
+    """
+    Queue the clean up of the ended `token` if we are in a read request.
+    Returns True if the clean up has been deferred.
+
+      >>> import zope.component
+      >>> from zope.locking import utility, tokens
+      >>> import indirecttokens
+      >>> from z3c.davapp.zopelocking import sweeper
+      >>> sweeper.STRICT_READS = True
+
+      >>> util = utility.TokenUtility()
+      >>> conn.add(util) # add to persistent database
+      >>> gsm = zope.component.getGlobalSiteManager()
+      >>> gsm.registerHandler(indirecttokens.removeEndedTokens)
+
+      >>> demofolder = DemoFolder()
+      >>> demofolder['demo'] = Demo()
+      >>> lockroot = util.register(
+      ...    tokens.ExclusiveLock(demofolder, 'michael'))
+      >>> indirect = util.register(
+      ...    indirecttokens.IndirectToken(demofolder['demo'], lockroot))
+
+    A lock that ends during a GET request isn't cleaned up straight away,
+    but both objects are unlocked.
+
+      >>> request = zope.security.management.getInteraction().participations[0]
+      >>> request.method = 'GET'
+      >>> lockroot.end()
+      >>> util.get(demofolder) is None
+      True
+      >>> util.get(demofolder['demo']) is None
+      True
+      >>> len(lockroot.annotations[indirecttokens.INDIRECT_INDEX_KEY])
+      1
+      >>> len(_queue)
+      1
+
+    The next request that writes cleans it up. The token stays queued until
+    the transaction commits, in case it is aborted. Tokens queued for other
+    databases are left alone.
+
+      >>> from ZODB.utils import p64
+      >>> _queue[('other', p64(1))] = True
+      >>> request.method = 'PUT'
+      >>> indirecttokens.flushDeferredCleanups(util)
+      >>> len(lockroot.annotations[indirecttokens.INDIRECT_INDEX_KEY])
+      0
+      >>> len(_queue)
+      2
+
+    The queued tokens are only cleaned up once in a transaction.
+
+      >>> popQueuedTokens(util)
+      []
+
+      >>> import transaction
+      >>> transaction.commit()
+      >>> _queue.keys()
+      [('other', '\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x01')]
+      >>> _queue.clear()
+
+    The queue is lost when the process is restarted, but the read requests
+    queue the ended tokens they come across.
+
+      >>> lockroot = util.register(
+      ...    tokens.ExclusiveLock(demofolder, 'michael'))
+      >>> indirect = util.register(
+      ...    indirecttokens.IndirectToken(demofolder['demo'], lockroot))
+      >>> request.method = 'PROPFIND'
+      >>> lockroot.end()
+      >>> _queue.clear()
+      >>> noticeEndedToken(indirect)
+      >>> len(_queue)
+      1
+      >>> request.method = 'PUT'
+      >>> indirecttokens.flushDeferredCleanups(util)
+      >>> len(lockroot.annotations[indirecttokens.INDIRECT_INDEX_KEY])
+      0
+
+    Cleanup.
+
+      >>> sweeper.STRICT_READS = False
+      >>> gsm.unregisterHandler(indirecttokens.removeEndedTokens)
+      True
+
+    """
+    if not STRICT_READS or not isReadRequest():
+        return False
+    key = _key(token)
+    if key is None:
+        return False
+    if len(_queue) < MAX_QUEUED:
+        _queue[key] = True
+    return True
+
+
+def noticeEndedToken(token):
+    """
+    Called by the read paths when they find a token that has ended, which
+    may have timed out without anyone cleaning up after it.
+    """
+    if interfaces.IIndirectToken.providedBy(token):
+        token = token.roottoken
+    key = _key(token)
+    if key is not None and len(_queue) < MAX_QUEUED:
+        _queue[key] = True
+
+
+def popQueuedTokens(utility):
+    """
+    Return the lock roots queued for `utility` loaded from the connection
+    of `utility`, which haven't been returned already in the current
+    transaction. They are only removed from the queue once the transaction
+    commits, so that they are cleaned up by a later transaction if this one
+    is aborted.
+    """
+    jar = getattr(utility, "_p_jar", None)
+    if jar is None or not _queue:
+        return []
+    database_name = jar.db().database_name
+    txn = jar.transaction_manager.get()
+    flushed = _flushed.get(txn, None)
+    if flushed is None:
+        flushed = _flushed[txn] = (set(), [])
+        txn.addAfterCommitHook(_dequeue, (flushed[1],))
+    seen, keys = flushed
+    queued = []
+    for key in list(_queue.keys()):
+        if key[0] != database_name or (utility._p_oid, key) in seen:
+            continue
+        seen.add((utility._p_oid, key))
+        try:
+            token = jar.get(key[1])
+        except KeyError:
+            # POSKeyError, the token has been packed away.
+            _queue.pop(key, None)
+            continue
+        if token.utility is utility:
+            queued.append(token)
+            keys.append(key)
+    return queued
+
+
+def _dequeue(status, keys):
+    if status:
+        for key in keys:
+            _queue.pop(key, None)
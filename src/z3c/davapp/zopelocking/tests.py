@@ -254,4 +254,76 @@ def test_suite():
                              checker = z3c.etree.testing.xmlOutputChecker,
                              setUp = lockingSetUp,
                              tearDown = lockingTearDown),
+        doctest.DocTestSuite("z3c.davapp.zopelocking.counters",
+                             checker = z3c.etree.testing.xmlOutputChecker,
+                             setUp = lockingSetUp,
+                             tearDown = lockingTearDown),
+        doctest.DocTestSuite("z3c.davapp.zopelocking.limits",
+                             checker = z3c.etree.testing.xmlOutputChecker,
+                             setUp = lockingSetUp,
+                             tearDown = lockingTearDown),
+        doctest.DocTestSuite("z3c.davapp.zopelocking.scanner",
+                             checker = z3c.etree.testing.xmlOutputChecker,
+                             setUp = lockingSetUp,
+                             tearDown = lockingTearDown),
+        doctest.DocTestSuite("z3c.davapp.zopelocking.cache",
+                             checker = z3c.etree.testing.xmlOutputChecker,
+                             setUp = lockingSetUp,
+                             tearDown = lockingTearDown),
+        doctest.DocTestSuite("z3c.davapp.zopelocking.bloom",
+                             checker = z3c.etree.testing.xmlOutputChecker,
+                             setUp = lockingSetUp,
+                             tearDown = lockingTearDown),
+        doctest.DocTestSuite("z3c.davapp.zopelocking.sweeper",
+                             checker = z3c.etree.testing.xmlOutputChecker,
+                             setUp = lockingSetUp,
+                             tearDown = lockingTearDown),
+        doctest.DocTestSuite("z3c.davapp.zopelocking.expiry",
+                             checker = z3c.etree.testing.xmlOutputChecker,
+                             setUp = lockingSetUp,
+                             tearDown = lockingTearDown),
+        doctest.DocTestSuite("z3c.davapp.zopelocking.principals",
+                             checker = z3c.etree.testing.xmlOutputChecker,
+                             setUp = lockingSetUp,
+                             tearDown = lockingTearDown),
+        doctest.DocTestSuite("z3c.davapp.zopelocking.report",
+                             checker = z3c.etree.testing.xmlOutputChecker,
+                             setUp = lockingSetUp,
+                             tearDown = lockingTearDown),
+        doctest.DocTestSuite("z3c.davapp.zopelocking.metrics",
+                             checker = z3c.etree.testing.xmlOutputChecker,
+                             setUp = lockingSetUp,
+                             tearDown = lockingTearDown),
+        doctest.DocTestSuite("z3c.davapp.zopelocking.costs",
+                             checker = z3c.etree.testing.xmlOutputChecker,
+                             setUp = lockingSetUp,
+                             tearDown = lockingTearDown),
+        doctest.DocTestSuite("z3c.davapp.zopelocking.tracing",
+                             checker = z3c.etree.testing.xmlOutputChecker,
+                             setUp = lockingSetUp,
+                             tearDown = lockingTearDown),
+        doctest.DocTestSuite("z3c.davapp.zopelocking.stats",
+                             checker = z3c.etree.testing.xmlOutputChecker,
+                             setUp = lockingSetUp,
+                             tearDown = lockingTearDown),
+        doctest.DocTestSuite("z3c.davapp.zopelocking.eventlog",
+                             checker = z3c.etree.testing.xmlOutputChecker,
+                             setUp = lockingSetUp,
+                             tearDown = lockingTearDown),
+        doctest.DocTestSuite("z3c.davapp.zopelocking.instrumentation",
+                             checker = z3c.etree.testing.xmlOutputChecker,
+                             setUp = lockingSetUp,
+                             tearDown = lockingTearDown),
+        doctest.DocTestSuite("z3c.davapp.zopelocking.sqlitestore",
+                             checker = z3c.etree.testing.xmlOutputChecker,
+                             setUp = lockingSetUp,
+                             tearDown = lockingTearDown),
+        doctest.DocTestSuite("z3c.davapp.zopelocking.sharedstore",
+                             checker = z3c.etree.testing.xmlOutputChecker,
+                             setUp = lockingSetUp,
+                             tearDown = lockingTearDown),
+        doctest.DocTestSuite("z3c.davapp.zopelocking.lockstore",
+                             checker = z3c.etree.testing.xmlOutputChecker,
+                             setUp = lockingSetUp,
+                             tearDown = lockingTearDown),
         ))
@@ -0,0 +1,327 @@
+##############################################################################
+#
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Tracing spans for the lock operations.
+
+The lock manager, `removeEndedTokens` and the container event handler start
+a span for each operation through the ITracer plugged in with `setTracer`.
+Spans started during another operation of the same thread, like the clean
+up of the indirect tokens when unlocking, are its children. Each span has
+an `outcome` attribute, which is one of
+
+  ok          the operation succeeded
+  locked      refused because of a conflicting lock, the `conflicts`
+              attribute is the number of conflicting locks reported
+  conflict    a ZODB conflict error, the publisher will retry the request
+  error       any other exception
+
+When no tracer is plugged in, which is the default, starting a span only
+checks that there is no tracer. `enableOpenTelemetry` plugs in a tracer
+creating OpenTelemetry spans, which are children of the span current when
+the lock operation starts, like the span of the request.
+"""
+
+import threading
+
+import zope.interface
+from ZODB.POSException import ConflictError
+import z3c.dav.interfaces
+
+try:
+    from opentelemetry import trace as oteltrace
+except ImportError:
+    oteltrace = None
+
+import interfaces
+
+PREFIX = "z3c.davapp."
+
+_tracer = None
+
+_local = threading.local()
+
+def setTracer(tracer):
+    """
+    Start the spans with `tracer` from now on, or stop tracing if it is None.
+    """
+    global _tracer
+    _tracer = tracer
+    _local.active = []
+    # The instrumentation module imports this one.
+    import instrumentation
+    instrumentation.refresh()
+
+
+def getTracer():
+    return _tracer
+
+
+def enableOpenTelemetry(tracer = None):
+    """
+    Trace the lock operations with OpenTelemetry. Returns False, and traces
+    nothing, if the opentelemetry API isn't installed.
+    """
+    if oteltrace is None:
+        setTracer(None)
+        return False
+    setTracer(OpenTelemetryTracer(tracer))
+    return True
+
+
+def disable():
+    setTracer(None)
+
+
+def _active():
+    active = getattr(_local, "active", None)
+    if active is None:
+        active = _local.active = []
+    return active
+
+
+def start(name, **attributes):
+    """
+    Start the span of the operation `name`, returns the value to pass to
+    `end`.
+    """
+    if _tracer is None:
+        return None
+    active = _active()
+    parent = active and active[-1][0] or None
+    span = _tracer.startSpan(
+        PREFIX + name, parent,
+        dict([(key, value) for key, value in attributes.items()
+              if value is not None]))
+    # [span, counted attributes]
+    active.append([span, {}])
+    return span
+
+
+def setAttribute(span, key, value):
+    if span is not None and value is not None:
+        span.setAttribute(key, value)
+
+
+def increment(key, value = 1):
+    """
+    Add `value` to the attribute `key` of the innermost span.
+    """
+    if _tracer is None:
+        return
+    active = _active()
+    if active:
+        counts = active[-1][1]
+        counts[key] = counts.get(key, 0) + value
+
+
+def outcome(error):
+    if error is None:
+        return "ok"
+    if isinstance(error, z3c.dav.interfaces.WebDAVErrors):
+        return "locked"
+    if isinstance(error, z3c.dav.interfaces.AlreadyLocked):
+        return "locked"
+    if isinstance(error, ConflictError):
+        return "conflict"
+    return "error"
+
+
+def end(span, error = None):
+    """
+    End `span`, `error` being the exception raised by the operation if any.
+    """
+    if span is None:
+        return
+    active = _active()
+    counts = {}
+    while active:
+        # Spans left open by a broken tracer are dropped with their child.
+        entry = active.pop()
+        if entry[0] is span:
+            counts = entry[1]
+            break
+    for key, value in counts.items():
+        span.setAttribute(key, value)
+    span.setAttribute("outcome", outcome(error))
+    if isinstance(error, z3c.dav.interfaces.WebDAVErrors):
+        span.setAttribute("conflicts", len(error.errors))
+    elif isinstance(error, z3c.dav.interfaces.AlreadyLocked):
+        span.setAttribute("conflicts", 1)
+    span.end()
+
+
+class RecordedSpan(object):
+    zope.interface.implements(interfaces.ISpan)
+
+    def __init__(self, tracer, name, parent, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.attributes = dict(attributes)
+        self.ended = False
+
+    def setAttribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self):
+        self.ended = True
+        self.tracer.finished.append(self)
+
+
+class RecordingTracer(object):
+    """
+    Keeps the finished spans in memory, for debugging and testing.
+
+      >>> import datetime
+      >>> import zope.component
+      >>> import zope.locking.interfaces
+      >>> from zope.interface.verify import verifyObject
+      >>> from zope.locking import utility
+      >>> from zope.locking.adapters import TokenBroker
+      >>> from zope.annotation.interfaces import IAttributeAnnotatable
+      >>> from zope.annotation.attribute import AttributeAnnotations
+      >>> from manager import DAVLockmanager
+      >>> from indirecttokens import removeEndedTokens
+
+      >>> util = utility.TokenUtility()
+      >>> conn.add(util) # add to persistent database
+      >>> gsm = zope.component.getGlobalSiteManager()
+      >>> gsm.registerUtility(util, zope.locking.interfaces.ITokenUtility)
+      >>> gsm.registerAdapter(TokenBroker, (zope.interface.Interface,),
+      ...    zope.locking.interfaces.ITokenBroker)
+      >>> gsm.registerAdapter(AttributeAnnotations)
+      >>> gsm.registerHandler(removeEndedTokens)
+
+      >>> class Folder(DemoFolder):
+      ...     zope.interface.implements(IAttributeAnnotatable)
+      >>> folder = Folder()
+      >>> folder['sub'] = Folder()
+      >>> folder['sub']['file'] = Demo()
+      >>> folder['file'] = Demo()
+
+      >>> tracer = RecordingTracer()
+      >>> verifyObject(interfaces.ITracer, tracer)
+      True
+      >>> setTracer(tracer)
+
+    Locking the folder registers 3 indirect tokens.
+
+      >>> locktoken = DAVLockmanager(folder).lock(u'exclusive', u'write',
+      ...    u'Michael', datetime.timedelta(seconds = 3600), 'infinity')
+      >>> span = tracer.finished[-1]
+      >>> span.name, span.parent
+      ('z3c.davapp.lock', None)
+      >>> span.attributes['scope'], span.attributes['depth']
+      (u'exclusive', 'infinity')
+      >>> span.attributes['indirect_tokens'], span.attributes['outcome']
+      (3, 'ok')
+
+    The conflicting locks are counted.
+
+      >>> try:
+      ...     DAVLockmanager(folder['sub']).lock(u'exclusive', u'write',
+      ...        u'Michael', datetime.timedelta(seconds = 3600), '0')
+      ... except z3c.dav.interfaces.AlreadyLocked:
+      ...     print "Already locked"
+      Already locked
+      >>> span = tracer.finished[-1]
+      >>> span.attributes['outcome'], span.attributes['conflicts']
+      ('locked', 1)
+
+    The clean up of the indirect tokens is part of the unlock.
+
+      >>> del tracer.finished[:]
+      >>> DAVLockmanager(folder).unlock(locktoken)
+      >>> [span.name for span in tracer.finished]
+      ['z3c.davapp.removeEndedTokens', 'z3c.davapp.unlock']
+      >>> cleanup, unlock = tracer.finished
+      >>> cleanup.parent is unlock
+      True
+      >>> cleanup.attributes['indirect_tokens']
+      3
+      >>> unlock.attributes['outcome']
+      'ok'
+
+    Nothing is traced once disabled.
+
+      >>> disable()
+      >>> del tracer.finished[:]
+      >>> locktoken = DAVLockmanager(folder).lock(u'exclusive', u'write',
+      ...    u'Michael', datetime.timedelta(seconds = 3600), '0')
+      >>> tracer.finished
+      []
+
+    Without the opentelemetry API the OpenTelemetry tracer does nothing.
+
+      >>> if oteltrace is None:
+      ...     enableOpenTelemetry()
+      ... else:
+      ...     False
+      False
+      >>> getTracer() is None
+      True
+
+    Cleanup.
+
+      >>> gsm.unregisterUtility(util, zope.locking.interfaces.ITokenUtility)
+      True
+      >>> gsm.unregisterAdapter(TokenBroker, (zope.interface.Interface,),
+      ...    zope.locking.interfaces.ITokenBroker)
+      True
+      >>> gsm.unregisterAdapter(AttributeAnnotations)
+      True
+      >>> gsm.unregisterHandler(removeEndedTokens)
+      True
+
+    """
+    zope.interface.implements(interfaces.ITracer)
+
+    def __init__(self):
+        self.finished = []
+
+    def startSpan(self, name, parent, attributes):
+        return RecordedSpan(self, name, parent, attributes)
+
+
+class OpenTelemetrySpan(object):
+    zope.interface.implements(interfaces.ISpan)
+
+    def __init__(self, span):
+        self.span = span
+
+    def setAttribute(self, key, value):
+        self.span.set_attribute(key, value)
+
+    def end(self):
+        self.span.end()
+
+
+class OpenTelemetryTracer(object):
+    """
+    Starts the spans with an OpenTelemetry tracer, by default the one of the
+    global tracer provider.
+    """
+    zope.interface.implements(interfaces.ITracer)
+
+    def __init__(self, tracer = None):
+        if tracer is None:
+            tracer = oteltrace.get_tracer("z3c.davapp.zopelocking")
+        self.tracer = tracer
+
+    def startSpan(self, name, parent, attributes):
+        context = None
+        if parent is not None:
+            context = oteltrace.set_span_in_context(parent.span)
+        return OpenTelemetrySpan(self.tracer.start_span(
+            name, context = context, attributes = attributes))